@@ -1,7 +1,8 @@
 """
 ASGI config for Frs project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``,
+which serves Django over HTTP and the kiosk camera WebSockets (face.kiosk).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -13,4 +14,23 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Frs.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from face.kiosk import kiosk_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Django for HTTP; WebSockets are the kiosk camera streams"""
+    if scope['type'] == 'websocket':
+        await kiosk_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
+
+
+# Warm up the face models in the background, including on every face analysis
+# thread and attendance job worker; /healthz/ready answers 503 until this has finished
+from face import cv  # noqa: E402
+from face.async_views import inference_executor, inference_workers  # noqa: E402
+from face.views import attendance_queue  # noqa: E402
+
+cv.start_warm_up(inference_executor, inference_workers, job_queues=[attendance_queue])
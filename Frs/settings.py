@@ -138,6 +138,87 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = "palavalasaanitha1@gmail.com"  # Update with actual email
 EMAIL_HOST_PASSWORD = "gbgx yuev vjzu gdyk"  # Update with actual password
+# Outbox sent by `manage.py send_outbox`: emails per batch (one SMTP connection), most
+# emails sent per minute across all workers, and retries of a failed email, waiting
+# EMAIL_OUTBOX_RETRY_SECONDS and doubling up to EMAIL_OUTBOX_MAX_RETRY_SECONDS
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_PER_MINUTE = 20
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_SECONDS = 60
+EMAIL_OUTBOX_MAX_RETRY_SECONDS = 3600
+# Seconds the worker waits before checking an empty outbox again
+EMAIL_OUTBOX_POLL_SECONDS = 5
+# Background HOD attendance reports (api/hod/send-attendance-report/), per process
+REPORT_JOB_WORKERS = 1
+REPORT_JOB_QUEUE_SIZE = 20
+
+
+# Face recognition
+# Uploaded images are downscaled so their long edge is at most this many pixels
+FACE_MAX_IMAGE_DIMENSION = 1280
+# Uploaded images larger than this are rejected before decoding
+FACE_MAX_IMAGE_BYTES = 8 * 1024 * 1024
+# Seconds before a worker reloads its in-memory face index from the database
+FACE_INDEX_TTL = 300
+# Face templates kept per user; matching uses the closest one
+FACE_MAX_TEMPLATES = 5
+# Successful attendance captures within the 'refresh' tolerance of a template (see FACE_MATCH_TOLERANCES)
+# and of at least this quality (0-1) become new templates
+FACE_TEMPLATE_MIN_QUALITY = 0.5
+# Encoding for new face data: 'mesh' (raw 1434-float landmarks) or 'aligned_pca', the compact
+# aligned encoding projected through the basis fitted by `manage.py fit_face_basis`
+FACE_ENCODING_MODEL = 'mesh'
+# Normalized match distances of each encoding model: 'verify' (attendance against the user's templates),
+# 'identify' (group photo and kiosk roster matches), 'duplicate' (a new registration matching another
+# user) and 'refresh' (see above). Set from genuine and impostor pairs of 26 people, 231 captures, with
+# a basis fitted on half of them and measured on the other half:
+#   mesh:        genuine p50 0.034, p99 0.098; impostor p1 0.023, p50 0.057, max 0.168
+#   aligned_pca: genuine p50 0.0038, p99 0.0097; impostor min 0.0049, p1 0.0069, p50 0.0151
+# The raw mesh cannot tell people apart: 'verify' at 0.12 still accepts most other faces. Use
+# aligned_pca, and re-measure on your own faces with `manage.py fit_face_basis`.
+FACE_MATCH_TOLERANCES = {
+    'mesh': {'verify': 0.12, 'identify': 0.12, 'duplicate': 0.009, 'refresh': 0.02},
+    'aligned_pca': {'verify': 0.008, 'identify': 0.008, 'duplicate': 0.0045, 'refresh': 0.004},
+}
+FACE_ENCODING_BASIS = BASE_DIR / 'face_models' / 'face_basis.npz'
+# Storage dtype of aligned_pca encodings: 'float32', 'float16' or 'int8'
+FACE_ENCODING_DTYPE = 'float16'
+# 1:N identification (group photos): a face matches a student within the 'identify' tolerance, and only
+# if that is at most FACE_IDENTIFY_RATIO times its distance to the next closest student
+FACE_IDENTIFY_RATIO = 0.8
+# Classroom photos (api/v2/attendance/group/): photos per request, long edge in pixels, faces per photo
+FACE_GROUP_MAX_PHOTOS = 5
+FACE_GROUP_MAX_IMAGE_DIMENSION = 2560
+FACE_GROUP_MAX_FACES = 100
+# Kiosk door cameras (ws/kiosk/<session_id>/ on the ASGI app): an unidentified face is encoded again
+# every FACE_KIOSK_RETRY_FRAMES frames, at most FACE_KIOSK_MAX_ATTEMPTS times; identified students are
+# written every FACE_KIOSK_FLUSH_SECONDS or once FACE_KIOSK_BATCH_SIZE are waiting
+FACE_KIOSK_MAX_ATTEMPTS = 3
+FACE_KIOSK_RETRY_FRAMES = 5
+FACE_KIOSK_FLUSH_SECONDS = 2.0
+FACE_KIOSK_BATCH_SIZE = 20
+# Liveness: reject a face whose mean high frequency log-magnitude (128px face crop) exceeds this
+FACE_LIVENESS_FFT_THRESHOLD = 140.0
+# UNIX socket of the local inference service (manage.py run_inference_server); None runs inference in-process
+FACE_INFERENCE_SOCKET = None
+FACE_INFERENCE_TIMEOUT = 10.0
+# After the inference service fails, analyze in-process for this many seconds before retrying it
+FACE_INFERENCE_RETRY_SECONDS = 30
+# Threads per worker process analyzing faces for the async API views; None uses the CPU count
+FACE_ASYNC_INFERENCE_WORKERS = None
+# Add a Server-Timing header with per-stage face pipeline timings to every response
+FACE_SERVER_TIMING = DEBUG
+# Clients allowed to read /api/metrics/
+FACE_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# Background attendance verification (api/v2/attendance/submit/), per process
+FACE_JOB_WORKERS = 2
+FACE_JOB_QUEUE_SIZE = 200
+# Most submissions for one session that may be queued or running at once
+FACE_JOB_SESSION_LIMIT = 50
+# Longest a job status request may long-poll (?wait=), in seconds; each wait holds a server worker
+FACE_JOB_MAX_WAIT = 5
+# Queued or running jobs that have not progressed for this long (their worker restarted) are failed
+FACE_JOB_STALE_SECONDS = 120
 
 
 # Internationalization
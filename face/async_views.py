@@ -0,0 +1,291 @@
+"""
+Async versions of the hot mobile API endpoints.
+
+Under ASGI (e.g. `uvicorn Frs.asgi:application`) these run on the event loop:
+face analysis, encoding and template matching go to a sized thread pool,
+upload parsing and other blocking calls to sync_to_async, ORM access uses
+Django's async queries and confirmation emails go to the outbox, so a worker
+can keep many mobile requests in flight while inference is running.
+"""
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.http import JsonResponse
+
+from .encoders import active_encoder
+from .enrollment import load_templates, enroll, refresh_from_attendance, capture_quality
+from .face_index import face_index
+from .models import User, Role, AttendanceSession, AttendanceRecord, FaceImage
+from .utils import analyze_image, send_attendance_email
+from .views import _read_face_upload, _check_attendance_capture
+
+
+# CPU-bound face analysis; at most this many frames are analyzed at once per worker process
+inference_workers = getattr(settings, 'FACE_ASYNC_INFERENCE_WORKERS', None) or os.cpu_count() or 2
+inference_executor = ThreadPoolExecutor(max_workers=inference_workers, thread_name_prefix='face-analysis')
+
+
+def async_csrf_exempt(view_func):
+    """
+    csrf_exempt for coroutine views. Django 4.2's decorator wraps the view in
+    a plain function, which hides that it is async.
+    """
+    view_func.csrf_exempt = True
+    return view_func
+
+
+async def _request_user(request):
+    """The authenticated user of the request, or None"""
+    if hasattr(request, 'auser'):
+        user = await request.auser()
+    else:
+        user = await sync_to_async(get_user)(request)
+    return user if user.is_authenticated else None
+
+
+async def _role_name(user):
+    if not user.role_id:
+        return None
+    return await Role.objects.filter(id=user.role_id).values_list('name', flat=True).afirst()
+
+
+async def _infer(func, *args):
+    """Run CPU-bound face work on the inference pool, keeping the request's stage timings"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(inference_executor, context.run, func, *args)
+
+
+async def _analyze(image_bytes):
+    return await _infer(analyze_image, image_bytes)
+
+
+@async_csrf_exempt
+async def api_register_face(request):
+    """API endpoint for registering user's face"""
+    return await _register_face(request, allow_base64=True)
+
+@async_csrf_exempt
+async def api_register_face_v2(request):
+    """API endpoint for registering user's face from a binary image upload"""
+    return await _register_face(request, allow_base64=False)
+
+async def _register_face(request, allow_base64):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+
+    try:
+        # Check if user is authenticated
+        user = await _request_user(request)
+        if user is None:
+            return JsonResponse({'success': False, 'message': 'Authentication required'})
+
+        image_bytes, data = await sync_to_async(_read_face_upload)(request, allow_base64)
+
+        if not image_bytes:
+            return JsonResponse({'success': False, 'message': 'Image data is required'})
+
+        # Decode, detect, mesh and encode the frame once for both liveness and encoding
+        analysis = await _analyze(image_bytes)
+
+        if analysis is None:
+            return JsonResponse({'success': False, 'message': 'Invalid image data'})
+
+        # Check if image is from a live camera (not a static photo)
+        if not analysis.is_live:
+            return JsonResponse({'success': False, 'message': 'Only live face capture is allowed. Static images, photos of screens, or blurry images are not permitted. Please use the device camera directly.', 'liveness_stage': analysis.liveness_stage})
+
+        face_encoding = analysis.encoding
+
+        if face_encoding is None:
+            return JsonResponse({'success': False, 'message': 'No face detected in the image. Please try again with better lighting and positioning.'})
+
+        # Check if this face is already registered by another user (within the 'duplicate' tolerance)
+        matches = await sync_to_async(face_index.nearest)(face_encoding, k=1, exclude_user_id=user.id)
+        if matches:
+            matched_user_id, distance = matches[0]
+            print(f"Duplicate face check matched user {matched_user_id} at distance {distance:.4f}")
+            roll_number = await User.objects.filter(id=matched_user_id).values_list('roll_number', flat=True).afirst()
+            if roll_number is not None:
+                return JsonResponse({
+                    'success': False,
+                    'message': f'This face is already registered to another user ({roll_number}). Each face can only be registered once.'
+                })
+            await sync_to_async(face_index.remove)(matched_user_id)
+
+        # Save face encoding and image to user profile
+        user.face_encoding = await _infer(active_encoder().serialize, face_encoding)
+        user.face_image = await sync_to_async(FaceImage.store)(bytes(image_bytes))
+        await user.asave()
+        await sync_to_async(enroll)(user, face_encoding, capture_quality(analysis))
+        await sync_to_async(face_index.update)(user.id, face_encoding)
+
+        return JsonResponse({'success': True, 'message': 'Face registered successfully!'})
+
+    except Exception as e:
+        print(f"Error registering face: {str(e)}")
+        return JsonResponse({'success': False, 'message': f'Error registering face: {str(e)}'})
+
+@async_csrf_exempt
+async def api_mark_attendance(request):
+    """API endpoint for marking attendance"""
+    return await _mark_attendance(request, allow_base64=True)
+
+@async_csrf_exempt
+async def api_mark_attendance_v2(request):
+    """API endpoint for marking attendance from a binary image upload"""
+    return await _mark_attendance(request, allow_base64=False)
+
+async def _mark_attendance(request, allow_base64):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+
+    try:
+        # Check if user is authenticated
+        user = await _request_user(request)
+        if user is None:
+            return JsonResponse({'success': False, 'message': 'Authentication required'})
+
+        image_bytes, data = await sync_to_async(_read_face_upload)(request, allow_base64)
+        latitude = data.get('latitude')
+        longitude = data.get('longitude')
+        session_id = data.get('session_id')
+
+        if not image_bytes:
+            return JsonResponse({'success': False, 'message': 'Image data is required'})
+
+        # Check if session ID is provided
+        if not session_id:
+            return JsonResponse({'success': False, 'message': 'Session ID is required'})
+
+        # Get the specified session
+        try:
+            active_session = await AttendanceSession.objects.select_related('location_constraint').aget(id=session_id, is_active=True)
+        except AttendanceSession.DoesNotExist:
+            return JsonResponse({'success': False, 'message': 'No active attendance session found with the provided ID.'})
+
+        # Check if user has already marked attendance for this session
+        if await AttendanceRecord.objects.filter(user=user, session=active_session).aexists():
+            return JsonResponse({'success': False, 'message': 'You have already marked attendance for this session.'})
+
+        # Check if user has registered their face
+        if not user.face_encoding:
+            return JsonResponse({'success': False, 'message': 'Please register your face before marking attendance.'})
+
+        analysis = await _analyze(image_bytes)
+        templates = await sync_to_async(load_templates)(user)
+
+        # Encoding the capture for the templates is face work too
+        error, distance = await _infer(_check_attendance_capture, user, active_session, analysis, templates, latitude, longitude)
+        if error:
+            return JsonResponse(error)
+
+        # Create attendance record
+        attendance_record = await AttendanceRecord.objects.acreate(
+            user=user,
+            session=active_session,
+            latitude=float(latitude) if latitude else None,
+            longitude=float(longitude) if longitude else None,
+            verification_method='face'
+        )
+
+        # Learn the capture as an extra template when the match was confident
+        await sync_to_async(refresh_from_attendance)(user, templates, analysis, distance)
+
+        # Queue attendance confirmation email
+        await sync_to_async(send_attendance_email)(user, attendance_record)
+
+        return JsonResponse({
+            'success': True,
+            'message': 'Attendance marked successfully!',
+            'timestamp': attendance_record.timestamp.isoformat()
+        })
+
+    except Exception as e:
+        print(f"Error processing attendance: {str(e)}")
+        return JsonResponse({'success': False, 'message': f'Error processing attendance: {str(e)}'})
+
+@async_csrf_exempt
+async def api_user_info(request):
+    """API endpoint for user information"""
+    # Check if user is authenticated
+    user = await _request_user(request)
+    if user is None:
+        return JsonResponse({'success': False, 'message': 'Authentication required'})
+
+    try:
+        return JsonResponse({
+            'success': True,
+            'user': {
+                'roll_number': user.roll_number,
+                'email': user.email,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'role': await _role_name(user),
+                'face_registered': bool(user.face_encoding)
+            }
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
+
+@async_csrf_exempt
+async def api_get_active_sessions(request):
+    """API endpoint to get active sessions only"""
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+
+    try:
+        # Check if user is authenticated
+        user = await _request_user(request)
+        if user is None:
+            return JsonResponse({'success': False, 'message': 'Authentication required'})
+
+        # Get only active sessions ordered by start time
+        sessions = AttendanceSession.objects.filter(is_active=True).select_related('faculty', 'location_constraint').order_by('-start_time')
+
+        # For students, only show sessions targeted to their level, year, and department
+        user_role = (await _role_name(user) or '').lower()
+        if user_role == 'student':
+            if user.level:
+                sessions = sessions.filter(level=user.level)
+            if user.year:
+                sessions = sessions.filter(target_year=user.year)
+            if user.department:
+                sessions = sessions.filter(department=user.department)
+
+        sessions_data = []
+        async for session in sessions:
+            sessions_data.append({
+                'id': session.id,
+                'name': session.name,
+                'start_time': session.start_time.isoformat() if session.start_time else None,
+                'end_time': session.end_time.isoformat() if session.end_time else None,
+                'is_active': session.is_active,
+                'faculty': {
+                    'id': session.faculty.id,
+                    'name': f"{session.faculty.first_name} {session.faculty.last_name}".strip()
+                } if session.faculty else None,
+                'location_constraint': {
+                    'id': session.location_constraint.id,
+                    'name': session.location_constraint.name,
+                    'latitude': str(session.location_constraint.latitude),
+                    'longitude': str(session.location_constraint.longitude),
+                    'radius': str(session.location_constraint.radius)
+                },
+                'target_year': session.target_year,
+                'level': session.level,
+                'department': session.department
+            })
+
+        return JsonResponse({
+            'success': True,
+            'sessions': sessions_data
+        })
+
+    except Exception as e:
+        return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
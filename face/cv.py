@@ -0,0 +1,179 @@
+"""
+Lazily loaded computer vision stack.
+
+numpy, OpenCV and MediaPipe take seconds and hundreds of MB to import, which
+every management command, migration and admin page would otherwise pay just
+for importing face.views. Face modules import them from here instead:
+
+    from .cv import np, cv2, mp
+
+and the real module is imported on first attribute access, i.e. on the first
+face call, or up front by warm_up() / start_warm_up().
+"""
+import importlib
+import threading
+import time
+
+
+class LazyModule:
+    """Stand-in for a module that imports it on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+np = LazyModule('numpy')
+cv2 = LazyModule('cv2')
+mp = LazyModule('mediapipe')
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+_warm_up_error = None
+_ready = threading.Event()
+
+# Delay before retrying a failed warm-up, doubled after each failure up to the maximum
+WARM_UP_RETRY_SECONDS = 5
+WARM_UP_MAX_RETRY_SECONDS = 300
+
+
+def is_loaded():
+    """Whether the whole CV stack has been imported"""
+    return np.is_loaded and cv2.is_loaded and mp.is_loaded
+
+
+def is_ready():
+    """Whether the background warm-up started by start_warm_up() has succeeded"""
+    return _ready.is_set()
+
+
+def warm_up_error():
+    """The error of the last failed warm-up attempt, while it is being retried"""
+    return _warm_up_error
+
+
+def _synthetic_frame():
+    """A camera-sized JPEG with a bright face-like oval on a textured background"""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(60, 200, size=(480, 640, 3), dtype=np.uint8)
+    cv2.ellipse(frame, (320, 240), (110, 150), 0, 0, 360, (150, 170, 210), -1)
+    cv2.circle(frame, (280, 200), 12, (40, 40, 40), -1)
+    cv2.circle(frame, (360, 200), 12, (40, 40, 40), -1)
+    cv2.ellipse(frame, (320, 310), (40, 15), 0, 0, 180, (60, 60, 140), -1)
+    return cv2.imencode('.jpg', frame)[1].tobytes()
+
+
+def warm_up(build_models=True, in_process=None):
+    """
+    Import the CV stack now and, unless build_models is False, push a
+    synthetic frame through decoding, liveness, detection, the face mesh and
+    encoding on the calling thread, so the first face request pays for none
+    of it. When FACE_INFERENCE_SOCKET is set (and in_process is not True) the
+    frame goes to the inference service instead and MediaPipe is not loaded.
+    Returns the time taken in seconds.
+    """
+    from django.conf import settings
+
+    start = time.perf_counter()
+    if in_process is None:
+        in_process = not getattr(settings, 'FACE_INFERENCE_SOCKET', None)
+    for module in (np, cv2, mp) if in_process else (np, cv2):
+        module._load()
+    if build_models:
+        from .utils import analyze_face, analyze_image, decode_image_bytes, face_model_pool
+
+        frame = _synthetic_frame()
+        if in_process:
+            image, _ = decode_image_bytes(frame)
+            analyze_face(image)
+            analyze_face(image, check_liveness=False)
+            # The mesh only runs on detected faces, so build and run it directly
+            face_model_pool.mesh().process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        else:
+            analyze_image(frame)
+    return time.perf_counter() - start
+
+
+def warm_up_threads(executor, workers, in_process=None):
+    """Run warm_up() once on each of the executor's worker threads"""
+    barrier = threading.Barrier(workers)
+
+    def build():
+        warm_up(in_process=in_process)
+        # Hold this thread until every worker has one task, so each warms up once
+        barrier.wait()
+
+    for future in [executor.submit(build) for _ in range(workers)]:
+        future.result()
+
+
+def start_warm_up(executor=None, workers=0, job_queues=()):
+    """
+    Warm up in a background thread, then also on each thread of `executor`
+    if given, and on the worker threads of each of `job_queues`, which are
+    started for it. is_ready() turns True once that succeeds. A failed
+    warm-up is retried with a growing delay, and warm_up_error() reports it
+    meanwhile; requests still load models on first use. Only the first call
+    in a process starts a warm-up; later calls return False.
+    """
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return False
+        _warm_up_started = True
+
+    def initialize(errors):
+        try:
+            warm_up()
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    def attempt():
+        seconds = warm_up()
+        if executor is not None and workers:
+            warm_up_threads(executor, workers)
+        for job_queue in job_queues:
+            # Only the first attempt starts the threads; later ones return at once
+            errors = []
+            job_queue.start(initializer=lambda: initialize(errors)).wait()
+            if errors:
+                raise errors[0]
+        return seconds
+
+    def run():
+        global _warm_up_error
+        delay = WARM_UP_RETRY_SECONDS
+        while True:
+            try:
+                seconds = attempt()
+            except Exception as e:
+                _warm_up_error = str(e) or e.__class__.__name__
+                print(f"Face model warm-up failed, retrying in {delay}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, WARM_UP_MAX_RETRY_SECONDS)
+                continue
+            _warm_up_error = None
+            print(f"Face models warmed up in {seconds:.2f}s")
+            _ready.set()
+            return
+
+    threading.Thread(target=run, name='face-warm-up', daemon=True).start()
+    return True
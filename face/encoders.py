@@ -0,0 +1,288 @@
+"""
+Face encoders: how the landmarks of an analyzed face become the vector that is
+stored and compared.
+
+analyze_face() always produces the raw mesh vector: the 478 refined FaceMesh
+landmarks flattened to 1434 floats (model FACE_MODEL_MEDIAPIPE_MESH). The
+aligned encoder (model FACE_MODEL_ALIGNED_PCA) removes head position, size
+and rotation from a stable subset of those landmarks with a Procrustes fit to
+a canonical shape, then projects the aligned shape through a PCA basis fitted
+offline by `manage.py fit_face_basis`, giving 64-128 dims that can be stored
+as float32, float16 or int8.
+
+FACE_ENCODING_MODEL selects the encoder for new encodings. Stored raw mesh
+encodings are converted to the active encoder when they are loaded, so both
+versions keep matching while `manage.py reencode_faces` rewrites them. Vectors
+of either model are scaled so that the normalized distance used by matching
+(Euclidean distance / sqrt(dimension)) is the RMS landmark displacement. The
+aligned displacement leaves out position, size and rotation, so it is far
+smaller for everyone: each model has its own FACE_MATCH_TOLERANCES, measured
+on genuine and impostor pairs (see match_tolerance()).
+"""
+import os
+import threading
+
+from django.conf import settings
+
+from .cv import np, mp
+from .utils import (
+    FACE_MODEL_ALIGNED_PCA, FACE_MODEL_MEDIAPIPE_MESH, pack_face_encoding, unpack_face_encoding,
+)
+
+
+MESH = 'mesh'
+ALIGNED_PCA = 'aligned_pca'
+
+# Refined FaceMesh landmarks, and the raw vector they flatten to
+MESH_LANDMARKS = 478
+MESH_DIMENSION = MESH_LANDMARKS * 3
+
+BASIS_FORMAT = 1
+
+# Normalized distances below which two encodings of a model count as the same
+# face: 'verify' is the 1:1 attendance check against a user's templates,
+# 'identify' the 1:N roster match of group photos and kiosks, 'duplicate' the
+# check that a new registration is not another user's face and 'refresh' how
+# close an attendance capture must be to become a template. Overridden by
+# settings.FACE_MATCH_TOLERANCES; `manage.py fit_face_basis` reports the
+# distances to set them from.
+MATCH_TOLERANCES = {
+    MESH: {'verify': 0.12, 'identify': 0.12, 'duplicate': 0.009, 'refresh': 0.02},
+    ALIGNED_PCA: {'verify': 0.008, 'identify': 0.008, 'duplicate': 0.0045, 'refresh': 0.004},
+}
+
+
+def stable_landmarks():
+    """
+    Indices of the mesh landmarks that move little with expression: all but
+    the irises (gaze), the eye contours (blinks) and the lips (speech)
+    """
+    connections = mp.solutions.face_mesh_connections
+    moving = set()
+    for group in (connections.FACEMESH_IRISES, connections.FACEMESH_LEFT_EYE,
+                  connections.FACEMESH_RIGHT_EYE, connections.FACEMESH_LIPS):
+        for start, end in group:
+            moving.update((start, end))
+    return np.array([i for i in range(MESH_LANDMARKS) if i not in moving], dtype=np.int64)
+
+
+def align_landmarks(points, reference):
+    """
+    Align each landmark set in points (M x N x 3) to reference (N x 3,
+    centered) with the similarity transform (translation, rotation and
+    uniform scale) that minimizes the squared distance between them.
+    """
+    centered = points - points.mean(axis=1, keepdims=True)
+    # Orthogonal Procrustes: SVD of each set's 3 x 3 cross-covariance with the reference
+    u, s, vt = np.linalg.svd(np.swapaxes(centered, 1, 2) @ reference)
+    # Where the best fit would be a reflection, flip the weakest axis instead
+    sign = np.sign(np.linalg.det(u @ vt))
+    u[:, :, -1] *= sign[:, None]
+    s[:, -1] *= sign
+    rotation = u @ vt
+    sq_norms = np.maximum(np.einsum('mij,mij->m', centered, centered), 1e-12)
+    scale = s.sum(axis=1) / sq_norms
+    return scale[:, None, None] * (centered @ rotation)
+
+
+class FaceBasis:
+    """
+    A fitted aligned-landmark PCA basis, stored as an .npz artifact.
+
+    basis_id is written into every encoding projected through the basis, so
+    encodings from a refitted basis are never compared with older ones.
+    """
+
+    def __init__(self, basis_id, indices, reference, mean, components, explained_variance_ratio):
+        self.basis_id = int(basis_id)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.reference = np.asarray(reference, dtype=np.float64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+        self.explained_variance_ratio = np.asarray(explained_variance_ratio, dtype=np.float64)
+        # Scale projections so distance / sqrt(dimension) is the RMS aligned landmark displacement
+        self.scale = np.sqrt(len(self.components) / self.components.shape[1])
+
+    @property
+    def dimension(self):
+        return len(self.components)
+
+    @classmethod
+    def fit(cls, raw_encodings, indices, components, basis_id, iterations=10):
+        """
+        Fit a basis to raw mesh encodings (M x 1434): generalized Procrustes
+        alignment of the landmark subset, then PCA of the aligned shapes.
+        """
+        points = np.asarray(raw_encodings, dtype=np.float64).reshape(len(raw_encodings), MESH_LANDMARKS, 3)[:, indices]
+        centered = points - points.mean(axis=1, keepdims=True)
+        # Keep the canonical shape at the captures' mean size, in landmark units
+        size = np.mean(np.linalg.norm(centered, axis=(1, 2)))
+
+        reference = centered[0] * (size / np.linalg.norm(centered[0]))
+        for _ in range(iterations):
+            aligned = align_landmarks(points, reference)
+            updated = aligned.mean(axis=0)
+            updated *= size / np.linalg.norm(updated)
+            converged = np.linalg.norm(updated - reference) < 1e-9 * size
+            reference = updated
+            if converged:
+                break
+
+        shapes = align_landmarks(points, reference).reshape(len(points), -1)
+        mean = shapes.mean(axis=0)
+        _, singular_values, vt = np.linalg.svd(shapes - mean, full_matrices=False)
+        variance = singular_values ** 2
+        ratio = variance / variance.sum() if variance.sum() > 0 else variance
+        return cls(basis_id, indices, reference, mean, vt[:components], ratio[:components])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['format']) != BASIS_FORMAT:
+                raise ValueError(f"Unsupported face basis format {int(data['format'])}")
+            return cls(
+                data['basis_id'], data['indices'], data['reference'], data['mean'],
+                data['components'], data['explained_variance_ratio'],
+            )
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write next to the target and rename, so running workers never read a partial file
+        temporary = f'{path}.tmp.npz'
+        np.savez(
+            temporary, format=BASIS_FORMAT, basis_id=self.basis_id, indices=self.indices,
+            reference=self.reference, mean=self.mean, components=self.components,
+            explained_variance_ratio=self.explained_variance_ratio,
+        )
+        os.replace(temporary, path)
+
+    def project(self, raw_encodings):
+        """Encode raw mesh encodings (M x 1434) into M x dimension float32 vectors"""
+        raw_encodings = np.asarray(raw_encodings, dtype=np.float64)
+        if raw_encodings.ndim != 2 or raw_encodings.shape[1] != MESH_DIMENSION:
+            raise ValueError(f"Expected raw mesh encodings of dimension {MESH_DIMENSION}, got {raw_encodings.shape}")
+        points = raw_encodings.reshape(len(raw_encodings), MESH_LANDMARKS, 3)[:, self.indices]
+        shapes = align_landmarks(points, self.reference).reshape(len(points), -1)
+        return ((shapes - self.mean) @ self.components.T * self.scale).astype(np.float32)
+
+
+class Encoder:
+    """Turns raw mesh captures into one model's vectors, and reads stored ones back"""
+
+    name = None
+    model_id = None
+    basis_id = 0
+    dtype = 'float32'
+
+    @property
+    def key(self):
+        return self.model_id, self.basis_id
+
+    def encode_many(self, raw_encodings):
+        raise NotImplementedError
+
+    def encode(self, raw_encoding):
+        """Encode one raw mesh vector from analyze_face()"""
+        return self.encode_many(np.asarray(raw_encoding).reshape(1, -1))[0]
+
+    def serialize(self, raw_encoding):
+        """Encode a raw capture into this model's storage format"""
+        return pack_face_encoding(self.encode(raw_encoding), self.model_id, self.dtype, self.basis_id)
+
+    def deserialize_many(self, blobs):
+        """
+        Read stored encodings as vectors of this model. Raw mesh encodings are
+        converted; empty, malformed or unconvertible blobs give None.
+        """
+        vectors = [None] * len(blobs)
+        convert = []
+        for i, blob in enumerate(blobs):
+            if not blob:
+                continue
+            try:
+                vector, model_id, basis_id = unpack_face_encoding(blob)
+            except ValueError as e:
+                print(f"Error decoding face encoding: {e}")
+                continue
+            if (model_id, basis_id) == self.key:
+                vectors[i] = vector
+            elif model_id == FACE_MODEL_MEDIAPIPE_MESH and len(vector) == MESH_DIMENSION:
+                convert.append((i, vector))
+        if convert:
+            encoded = self.encode_many(np.stack([vector for _, vector in convert]))
+            for (i, _), vector in zip(convert, encoded):
+                vectors[i] = vector
+        return vectors
+
+    def deserialize(self, blob):
+        return self.deserialize_many([blob])[0]
+
+
+class MeshEncoder(Encoder):
+    """The raw mesh vector, as produced by analyze_face()"""
+
+    name = MESH
+    model_id = FACE_MODEL_MEDIAPIPE_MESH
+
+    def encode_many(self, raw_encodings):
+        return np.asarray(raw_encodings, dtype=np.float32)
+
+
+class AlignedEncoder(Encoder):
+    """Aligned landmarks projected through a fitted FaceBasis"""
+
+    name = ALIGNED_PCA
+    model_id = FACE_MODEL_ALIGNED_PCA
+
+    def __init__(self, basis, dtype='float16'):
+        self.basis = basis
+        self.basis_id = basis.basis_id
+        self.dtype = dtype
+
+    def encode_many(self, raw_encodings):
+        return self.basis.project(raw_encodings)
+
+
+mesh_encoder = MeshEncoder()
+
+_active_lock = threading.Lock()
+_active = (None, mesh_encoder)
+
+
+def active_encoder():
+    """
+    The encoder selected by FACE_ENCODING_MODEL. The basis file is reloaded
+    when it changes; if it cannot be loaded, new encodings fall back to the raw
+    mesh, which can still be converted once the basis is available.
+    """
+    global _active
+    if getattr(settings, 'FACE_ENCODING_MODEL', MESH) != ALIGNED_PCA:
+        return mesh_encoder
+
+    path = str(settings.FACE_ENCODING_BASIS)
+    dtype = getattr(settings, 'FACE_ENCODING_DTYPE', 'float16')
+    try:
+        signature = (path, os.path.getmtime(path), dtype)
+    except OSError:
+        signature = (path, None, dtype)
+    with _active_lock:
+        if _active[0] != signature:
+            encoder = mesh_encoder
+            try:
+                encoder = AlignedEncoder(FaceBasis.load(path), dtype)
+            except Exception as e:
+                print(f"Could not load face basis {path}, using the raw mesh encoding: {e}")
+            _active = (signature, encoder)
+        return _active[1]
+
+
+def match_tolerance(kind, encoder=None):
+    """
+    The tolerance of kind ('verify', 'identify', 'duplicate' or 'refresh',
+    see MATCH_TOLERANCES) for distances between encodings of encoder, by
+    default the active one
+    """
+    encoder = encoder or active_encoder()
+    return getattr(settings, 'FACE_MATCH_TOLERANCES', MATCH_TOLERANCES)[encoder.name][kind]
@@ -0,0 +1,139 @@
+"""
+Face templates: the set of encodings a user is matched against.
+
+Each user holds up to FACE_MAX_TEMPLATES FaceTemplate rows. Registering a face
+adds an enrollment template, and confident attendance matches from the
+liveness-checked API add attendance templates, so a user enrolled under one
+lighting condition or angle also matches under others.
+User.face_encoding keeps the latest enrollment for the duplicate-face index.
+Templates are stored and compared with the active encoder (see encoders).
+"""
+from django.conf import settings
+from django.db import transaction
+
+from .cv import np
+from .encoders import active_encoder, match_tolerance
+from .models import FaceTemplate
+from .utils import best_face_distance
+
+
+ENROLLMENT = 'enrollment'
+ATTENDANCE = 'attendance'
+
+
+def capture_quality(analysis):
+    """
+    Score an analyzed capture from 0 (poor) to 1 (good) by sharpness and
+    exposure, using whichever of the two the analysis measured
+    """
+    scores = []
+    if analysis.blur_variance is not None:
+        scores.append(min(analysis.blur_variance / 500.0, 1.0))
+    if analysis.mean_brightness is not None:
+        scores.append(max(0.0, 1.0 - abs(analysis.mean_brightness - 128.0) / 128.0))
+    return float(np.mean(scores)) if scores else 0.0
+
+
+class Templates:
+    """A user's decoded templates as one K x D matrix plus the row ids"""
+
+    def __init__(self, ids, matrix, encoder):
+        self.ids = ids
+        self.matrix = matrix
+        self.encoder = encoder
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1] if self.matrix is not None else 0
+
+    def encode(self, capture):
+        """Encode a raw capture from analyze_face() for comparison with the templates"""
+        return self.encoder.encode(capture)
+
+    def closest(self, encoding):
+        """(row, normalized distance) of the template closest to an encoded capture"""
+        return best_face_distance(self.matrix, encoding)
+
+
+def load_templates(user):
+    """
+    Load a user's templates. Users registered before templates existed fall
+    back to their single face_encoding (with a template id of None).
+    """
+    encoder = active_encoder()
+    rows = list(FaceTemplate.objects.filter(user=user).values_list('id', 'encoding'))
+    ids = []
+    encodings = []
+    for (template_id, _), encoding in zip(rows, encoder.deserialize_many([stored for _, stored in rows])):
+        if encoding is not None:
+            ids.append(template_id)
+            encodings.append(encoding)
+
+    if not encodings and user.face_encoding:
+        encoding = encoder.deserialize(user.face_encoding)
+        if encoding is not None:
+            ids.append(None)
+            encodings.append(encoding)
+
+    # Templates of another dimension cannot be compared with the rest
+    if encodings:
+        dimension = len(encodings[-1])
+        keep = [i for i, e in enumerate(encodings) if len(e) == dimension]
+        ids = [ids[i] for i in keep]
+        encodings = [encodings[i] for i in keep]
+    matrix = np.stack(encodings).astype(np.float32, copy=False) if encodings else None
+    return Templates(ids, matrix, encoder)
+
+
+def _max_templates():
+    return max(1, getattr(settings, 'FACE_MAX_TEMPLATES', 5))
+
+
+@transaction.atomic
+def enroll(user, encoding, quality, source=ENROLLMENT):
+    """
+    Store a raw capture as a new template for the user, evicting one if the user is at
+    FACE_MAX_TEMPLATES: the lowest quality attendance template first, then
+    the oldest enrollment.
+    """
+    template = FaceTemplate.objects.create(
+        user=user, encoding=active_encoder().serialize(encoding), quality=quality, source=source
+    )
+    existing = list(
+        FaceTemplate.objects.filter(user=user).exclude(id=template.id).values_list('id', 'source', 'quality', 'created_at')
+    )
+    excess = len(existing) + 1 - _max_templates()
+    if excess > 0:
+        # Eviction order: attendance by lower quality then age, then enrollments by age
+        existing.sort(key=lambda row: (0, row[2], row[3]) if row[1] == ATTENDANCE else (1, 0, row[3]))
+        FaceTemplate.objects.filter(id__in=[row[0] for row in existing[:excess]]).delete()
+    return template
+
+
+def refresh_from_attendance(user, templates, analysis, distance):
+    """
+    Add a successful attendance capture as a template when it matched with
+    high confidence and is of good quality. At the cap, it only replaces an
+    attendance template of lower quality; enrollment templates are kept.
+    Returns the new template, or None.
+    """
+    if analysis.encoding is None or distance > match_tolerance('refresh', templates.encoder):
+        return None
+    quality = capture_quality(analysis)
+    if quality < getattr(settings, 'FACE_TEMPLATE_MIN_QUALITY', 0.5):
+        return None
+
+    if len(templates) >= _max_templates():
+        if not FaceTemplate.objects.filter(user=user, source=ATTENDANCE, quality__lt=quality).exists():
+            return None
+    if None in templates.ids:
+        # Keep the pre-template encoding once the user starts collecting templates
+        FaceTemplate.objects.create(user=user, encoding=bytes(user.face_encoding), source=ENROLLMENT)
+    return enroll(user, analysis.encoding, quality, source=ATTENDANCE)
+
+
+def clear_templates(user):
+    FaceTemplate.objects.filter(user=user).delete()
@@ -0,0 +1,180 @@
+import threading
+import time
+
+from django.conf import settings
+
+from .cv import np
+from .encoders import active_encoder, match_tolerance
+from .metrics import stage_timer
+
+
+LOAD_CHUNK_SIZE = 1000
+
+
+class FaceIndex:
+    """
+    In-memory index of every enrolled face encoding.
+
+    Encodings are kept as rows of one contiguous float32 matrix with a parallel
+    array of user ids, so "which users are within tolerance of this face" is a
+    single matrix-vector product instead of a Python loop over users. Rows are
+    in the space of the active encoder (see encoders.active_encoder); update()
+    and nearest() take raw captures from analyze_face() and encode them.
+
+    The index is per process. It is updated in place when a worker registers
+    or deletes a face and fully reloaded from the database after
+    FACE_INDEX_TTL seconds, which picks up changes made by other workers.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'FACE_INDEX_TTL', 300)
+        self._lock = threading.RLock()
+        # Arrays are allocated by the first load(), keeping numpy out of import time
+        self._rows = {}
+        self._size = 0
+        self._loaded_at = None
+        self._encoder = None
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return self._size
+
+    def _reset(self, dimension):
+        self._matrix = np.empty((0, dimension), dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._user_ids = np.empty(0, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+
+    def load(self):
+        """(Re)build the index from every user with a stored face encoding"""
+        from .models import User
+
+        encoder = active_encoder()
+        rows = User.objects.exclude(face_encoding__isnull=True).values_list('id', 'face_encoding')
+        user_ids = []
+        encodings = []
+
+        def add(chunk):
+            # Raw mesh encodings are converted to the active encoder a chunk at a time
+            for (user_id, _), encoding in zip(chunk, encoder.deserialize_many([stored for _, stored in chunk])):
+                if encoding is not None:
+                    user_ids.append(user_id)
+                    encodings.append(encoding)
+
+        chunk = []
+        for row in rows.iterator(chunk_size=LOAD_CHUNK_SIZE):
+            chunk.append(row)
+            if len(chunk) >= LOAD_CHUNK_SIZE:
+                add(chunk)
+                chunk = []
+        add(chunk)
+
+        with self._lock:
+            if encodings:
+                # Keep only the dominant dimension; other shapes can never match
+                dims, counts = np.unique([len(e) for e in encodings], return_counts=True)
+                dimension = int(dims[np.argmax(counts)])
+                keep = [i for i, e in enumerate(encodings) if len(e) == dimension]
+                self._reset(dimension)
+                self._matrix = np.ascontiguousarray(np.stack([encodings[i] for i in keep]), dtype=np.float32)
+                self._user_ids = np.array([user_ids[i] for i in keep], dtype=np.int64)
+                self._sq_norms = np.einsum('ij,ij->i', self._matrix, self._matrix)
+                self._size = len(keep)
+                self._rows = {int(user_id): row for row, user_id in enumerate(self._user_ids)}
+            else:
+                self._reset(0)
+            self._loaded_at = time.monotonic()
+            self._encoder = encoder
+
+    def _ensure_loaded(self):
+        if (self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+                or self._encoder is not active_encoder()):
+            self.load()
+
+    def _grow(self):
+        capacity = max(16, len(self._matrix) * 2)
+        matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        user_ids = np.empty(capacity, dtype=np.int64)
+        user_ids[:self._size] = self._user_ids[:self._size]
+        self._matrix, self._sq_norms, self._user_ids = matrix, sq_norms, user_ids
+
+    def update(self, user_id, encoding):
+        """Insert or replace the encoding for a user from a raw capture"""
+        if encoding is None:
+            self.remove(user_id)
+            return
+        with self._lock:
+            self._ensure_loaded()
+            encoding = self._encoder.encode(encoding)
+            if self._size == 0 and self._matrix.shape[1] != len(encoding):
+                self._reset(len(encoding))
+            if self._matrix.shape[1] != len(encoding):
+                print(f"Face index dimension {self._matrix.shape[1]} does not match encoding {len(encoding)}; not indexed")
+                self.remove(user_id)
+                return
+
+            row = self._rows.get(int(user_id))
+            if row is None:
+                if self._size == len(self._matrix):
+                    self._grow()
+                row = self._size
+                self._size += 1
+                self._rows[int(user_id)] = row
+                self._user_ids[row] = user_id
+            self._matrix[row] = encoding
+            self._sq_norms[row] = float(np.dot(encoding, encoding))
+
+    def remove(self, user_id):
+        """Drop a user's encoding from the index, if present"""
+        with self._lock:
+            row = self._rows.pop(int(user_id), None)
+            if row is None:
+                return
+            last = self._size - 1
+            if row != last:
+                # Move the last row into the hole to keep the matrix contiguous
+                self._matrix[row] = self._matrix[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._user_ids[row] = self._user_ids[last]
+                self._rows[int(self._user_ids[row])] = row
+            self._size = last
+
+    def nearest(self, encoding, k=1, tolerance=None, exclude_user_id=None):
+        """
+        Return up to k (user_id, normalized_distance) pairs within tolerance
+        of a raw capture, closest first; by default the encoder's 'duplicate'
+        tolerance. Distances are normalized the same way as compare_faces.
+        """
+        with stage_timer('match.index'), self._lock:
+            self._ensure_loaded()
+            if tolerance is None:
+                tolerance = match_tolerance('duplicate', self._encoder)
+            encoding = self._encoder.encode(encoding)
+            if not self._size or self._matrix.shape[1] != len(encoding):
+                return []
+            matrix = self._matrix[:self._size]
+            sq_norms = self._sq_norms[:self._size]
+            user_ids = self._user_ids[:self._size].copy()
+
+            # ||a - q||^2 = ||a||^2 - 2 a.q + ||q||^2, one BLAS gemv for all rows
+            sq_distances = sq_norms - 2.0 * (matrix @ encoding) + np.dot(encoding, encoding)
+
+        distances = np.sqrt(np.maximum(sq_distances, 0.0)) / np.sqrt(len(encoding))
+        if exclude_user_id is not None:
+            distances[user_ids == exclude_user_id] = np.inf
+
+        candidates = np.flatnonzero(distances <= tolerance)
+        if not len(candidates):
+            return []
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(distances[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(distances[candidates])]
+        return [(int(user_ids[i]), float(distances[i])) for i in candidates]
+
+
+face_index = FaceIndex()
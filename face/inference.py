@@ -0,0 +1,221 @@
+"""
+Local inference service for the face pipeline.
+
+A single `manage.py run_inference_server` process owns the MediaPipe models and
+answers analyze/encode/liveness requests from Django workers over a UNIX domain
+socket, so the web workers never load the models themselves.
+
+Wire format (all integers little-endian):
+
+    request   magic b'FRQ1' | op u8 | pad 3 | payload length u32 | image bytes
+    response  magic b'FRS1' | status u8 | is_live u8 | face count u16
+              | face box 4 x i32 | blur, brightness, color variance, high freq 4 x f32
+              | stage length u16 | reason length u16 | encoding length u32
+              | stage utf-8 | reason utf-8 | encoding blob (utils.pack_face_encoding)
+
+Statistics that were not computed are sent as NaN, a missing face box as -1s.
+"""
+import math
+import os
+import socket
+import socketserver
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+REQUEST_MAGIC = b'FRQ1'
+RESPONSE_MAGIC = b'FRS1'
+REQUEST_HEADER = struct.Struct('<4sB3xI')
+RESPONSE_HEADER = struct.Struct('<4sBBH4i4fHHI')
+
+OP_ANALYZE = 1   # liveness cascade and encoding
+OP_ENCODE = 2    # encoding only, no liveness checks
+OP_LIVENESS = 3  # liveness cascade only, no encoding returned
+OPS = (OP_ANALYZE, OP_ENCODE, OP_LIVENESS)
+
+STATUS_OK = 0
+STATUS_INVALID_IMAGE = 1
+STATUS_ERROR = 2
+
+MAX_PAYLOAD_BYTES = 32 * 1024 * 1024
+
+
+class InferenceError(Exception):
+    """The inference service could not be reached or failed to answer"""
+
+
+def _recv_exact(sock, size):
+    """Read exactly size bytes into a fresh buffer, returning a memoryview over it"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionError("Inference socket closed mid-message")
+        received += count
+    return view
+
+
+def _optional_float(value):
+    return float('nan') if value is None else float(value)
+
+
+def encode_request(op, image_bytes):
+    return REQUEST_HEADER.pack(REQUEST_MAGIC, op, len(image_bytes))
+
+
+def encode_response(status, analysis=None, encoding_blob=b''):
+    """Serialize an analysis (or a bare status) into a response message"""
+    if analysis is None:
+        return RESPONSE_HEADER.pack(RESPONSE_MAGIC, status, 0, 0, -1, -1, -1, -1,
+                                    math.nan, math.nan, math.nan, math.nan, 0, 0, 0)
+    stage = analysis.liveness_stage.encode()
+    reason = analysis.liveness_reason.encode()
+    face_box = analysis.face_box or (-1, -1, -1, -1)
+    header = RESPONSE_HEADER.pack(
+        RESPONSE_MAGIC, status, int(bool(analysis.is_live)), analysis.face_count, *face_box,
+        _optional_float(analysis.blur_variance), _optional_float(analysis.mean_brightness),
+        _optional_float(analysis.color_variance), _optional_float(analysis.high_freq_energy),
+        len(stage), len(reason), len(encoding_blob),
+    )
+    return b''.join((header, stage, reason, encoding_blob))
+
+
+def read_response(sock):
+    """
+    Read one response. Returns (status, fields) where fields is a dict of the
+    decoded values, with the encoding still in its packed storage format.
+    """
+    header = RESPONSE_HEADER.unpack(_recv_exact(sock, RESPONSE_HEADER.size))
+    (magic, status, is_live, face_count, x, y, width, height,
+     blur, brightness, color_variance, high_freq, stage_length, reason_length, encoding_length) = header
+    if magic != RESPONSE_MAGIC:
+        raise InferenceError("Unexpected response from inference service")
+    body = _recv_exact(sock, stage_length + reason_length + encoding_length) if stage_length + reason_length + encoding_length else memoryview(b'')
+
+    def optional(value):
+        return None if math.isnan(value) else value
+
+    return status, {
+        'is_live': bool(is_live),
+        'face_count': face_count,
+        'face_box': None if x < 0 else (x, y, width, height),
+        'blur_variance': optional(blur),
+        'mean_brightness': optional(brightness),
+        'color_variance': optional(color_variance),
+        'high_freq_energy': optional(high_freq),
+        'liveness_stage': bytes(body[:stage_length]).decode(),
+        'liveness_reason': bytes(body[stage_length:stage_length + reason_length]).decode(),
+        'encoding_blob': bytes(body[stage_length + reason_length:]) if encoding_length else None,
+    }
+
+
+class InferenceClient:
+    """
+    Client for the inference service. Each thread keeps one persistent
+    connection, re-established transparently after errors.
+    """
+
+    def __init__(self, socket_path, timeout=10.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _discard_connection(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def request(self, op, image_bytes):
+        """Send one image and return (status, fields); raises InferenceError on failure"""
+        try:
+            sock = self._connection()
+            sock.sendall(encode_request(op, image_bytes))
+            sock.sendall(image_bytes)
+            return read_response(sock)
+        except (OSError, ConnectionError, struct.error) as e:
+            self._discard_connection()
+            raise InferenceError(str(e)) from e
+
+
+class _InferenceHandler(socketserver.BaseRequestHandler):
+    """Serves requests on one client connection until it closes"""
+
+    def handle(self):
+        while True:
+            try:
+                header = _recv_exact(self.request, REQUEST_HEADER.size)
+            except ConnectionError:
+                return
+            magic, op, length = REQUEST_HEADER.unpack(header)
+            if magic != REQUEST_MAGIC or length > MAX_PAYLOAD_BYTES:
+                self.request.sendall(encode_response(STATUS_ERROR))
+                return
+            payload = _recv_exact(self.request, length)
+            if op not in OPS:
+                # The payload has been read, so the connection stays usable
+                self.request.sendall(encode_response(STATUS_ERROR))
+                continue
+            response = self.server.executor.submit(self.server.process, op, payload).result()
+            self.request.sendall(response)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    UNIX socket server running the face pipeline on a fixed pool of inference
+    threads. Connection threads only do I/O; at most `workers` frames are
+    analyzed at once, each inference thread reusing its own pooled models.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='face-inference')
+        super().__init__(socket_path, _InferenceHandler)
+        os.chmod(socket_path, 0o660)
+
+    def warm_up(self, workers):
+        """Build the models on every inference thread before accepting requests"""
+        from .cv import warm_up_threads
+        warm_up_threads(self.executor, workers, in_process=True)
+
+    @staticmethod
+    def process(op, payload):
+        from .utils import analyze_face, decode_image_bytes, pack_face_encoding
+
+        try:
+            image, _ = decode_image_bytes(payload)
+            if image is None:
+                return encode_response(STATUS_INVALID_IMAGE)
+            analysis = analyze_face(image, check_liveness=op != OP_ENCODE)
+            encoding_blob = b''
+            if op != OP_LIVENESS and analysis.encoding is not None:
+                encoding_blob = pack_face_encoding(analysis.encoding)
+            return encode_response(STATUS_OK, analysis, encoding_blob)
+        except Exception as e:
+            print(f"Inference request failed: {e}")
+            return encode_response(STATUS_ERROR)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -0,0 +1,133 @@
+import math
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+from . import metrics
+
+
+class QueueFull(Exception):
+    """The work queue cannot take another job; retry after retry_after seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class KeyLimitReached(QueueFull):
+    """Too many jobs are already queued or running for the same key"""
+
+
+class JobQueue:
+    """
+    Bounded in-process work queue served by a fixed number of daemon threads.
+
+    submit() never blocks: it raises QueueFull when the queue is at capacity
+    and KeyLimitReached when `per_key_limit` jobs with the same key (e.g. the
+    attendance session) are already queued or running. Worker threads start on
+    the first submission, or on start(), so they are created after a pre-fork
+    server forks.
+
+    Stage timings recorded while a job runs are published under `name`.
+    """
+
+    def __init__(self, name, handler, maxsize, workers, per_key_limit=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.per_key_limit = per_key_limit
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._threads = []
+        self._done = {}
+        self._average_duration = 1.0
+        self._initializing = 0
+        self._initialized = threading.Event()
+
+    def _start(self, initializer=None):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._work, args=(initializer,), name=f'{self.name}-{len(self._threads)}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def start(self, initializer=None):
+        """
+        Start the worker threads now rather than on the first submission, each
+        running initializer() once before it takes jobs (e.g. to warm up
+        per-thread models). Returns an Event set once every initializer has
+        finished, or straight away if the workers were already running.
+        """
+        with self._lock:
+            if not self._threads and initializer is not None:
+                self._initializing = self.workers
+                self._start(initializer)
+            else:
+                self._start()
+                self._initialized.set()
+        return self._initialized
+
+    def retry_after(self):
+        """Seconds until the current backlog is expected to have drained"""
+        backlog = self._queue.qsize() + self.workers
+        return max(1, math.ceil(backlog * self._average_duration / self.workers))
+
+    def submit(self, key, job_id, *args):
+        """Queue handler(job_id, *args); raises QueueFull or KeyLimitReached"""
+        with self._lock:
+            self._start()
+            if self.per_key_limit and self._in_flight.get(key, 0) >= self.per_key_limit:
+                raise KeyLimitReached('Too many submissions in progress', self.retry_after())
+            try:
+                self._queue.put_nowait((key, job_id, args))
+            except queue.Full:
+                raise QueueFull('Work queue is full', self.retry_after())
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            self._done[job_id] = threading.Event()
+
+    def wait(self, job_id, timeout):
+        """
+        Wait up to timeout seconds for a job submitted to this process.
+        Returns False straight away for jobs this process does not know about.
+        """
+        event = self._done.get(job_id)
+        if event is None:
+            return False
+        return event.wait(timeout)
+
+    def _work(self, initializer=None):
+        if initializer is not None:
+            try:
+                initializer()
+            except Exception as e:
+                print(f"{self.name} worker initializer failed: {e}")
+            with self._lock:
+                self._initializing -= 1
+                if not self._initializing:
+                    self._initialized.set()
+        while True:
+            key, job_id, args = self._queue.get()
+            token = metrics.begin_request()
+            start = time.perf_counter()
+            try:
+                close_old_connections()
+                self.handler(job_id, *args)
+            except Exception as e:
+                print(f"{self.name} job {job_id} failed: {e}")
+            finally:
+                duration = time.perf_counter() - start
+                metrics.end_request(token, self.name, duration)
+                close_old_connections()
+                self._average_duration = 0.8 * self._average_duration + 0.2 * duration
+                with self._lock:
+                    self._in_flight[key] -= 1
+                    if not self._in_flight[key]:
+                        del self._in_flight[key]
+                    event = self._done.pop(job_id, None)
+                if event is not None:
+                    event.set()
+                self._queue.task_done()
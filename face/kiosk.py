@@ -0,0 +1,395 @@
+"""
+Kiosk mode: 1:N identification of students walking past a fixed door camera.
+
+A kiosk device, logged in as the session's faculty (or an admin), opens a
+WebSocket to /ws/kiosk/<session_id>/ on the ASGI app and streams camera frames
+as binary JPEG messages. Each frame gets one detection pass; a FaceTracker
+follows faces from frame to frame by box overlap, so a person walking past is
+encoded and identified against the session roster once rather than on every
+frame. Identified students are marked present in batches.
+
+The roster's templates are loaded when the first kiosk of a session connects
+and stay pinned in memory while any kiosk of that session is connected.
+Frames that arrive while the previous one is still being analyzed replace
+each other, so a slow server drops frames instead of falling behind.
+
+Server messages are JSON text:
+    {"type": "ready", "session_id": 1, "roster_size": 60}
+    {"type": "faces", "faces": [{"track": 3, "box": [x, y, w, h], "status": "pending" | "identified" | "unknown",
+                                 "roll_number": "...", "name": "..."}]}
+    {"type": "marked", "students": [{"roll_number": "...", "name": "..."}]}
+    {"type": "error", "message": "..."}
+The client may send {"type": "ping"} and gets {"type": "pong"}.
+"""
+import asyncio
+import contextvars
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.http import parse_cookie
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .encoders import match_tolerance
+from .models import AttendanceRecord, AttendanceSession, Role, User
+from .roster import Roster, assign, mark_present
+from .utils import _box_iou, _to_rgb, decode_image_bytes, detect_faces, encode_detected_face, send_attendance_emails
+
+
+KIOSK_PATH = re.compile(r'^/ws/kiosk/(?P<session_id>\d+)/?$')
+
+PENDING = 'pending'
+IDENTIFIED = 'identified'
+UNKNOWN = 'unknown'
+
+
+class Track:
+    """One face followed across frames"""
+
+    def __init__(self, track_id, box, frame):
+        self.id = track_id
+        self.box = box
+        self.last_seen = frame
+        self.status = PENDING
+        self.user_id = None
+        self.attempts = 0
+        self.next_attempt = frame
+
+
+class FaceTracker:
+    """
+    Greedy IoU tracker: each detected box continues the track whose last box
+    overlaps it most (at least iou_threshold); other boxes start new tracks.
+    Tracks not seen for max_missed frames are dropped.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=10):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.tracks = {}
+        self.frame = 0
+        self._next_id = 1
+
+    def update(self, boxes):
+        """Advance one frame; returns the track of each box, in order"""
+        self.frame += 1
+        pairs = sorted(
+            ((_box_iou(track.box, box), track_id, i) for track_id, track in self.tracks.items() for i, box in enumerate(boxes)),
+            reverse=True,
+        )
+        assigned = [None] * len(boxes)
+        used = set()
+        for iou, track_id, i in pairs:
+            if iou < self.iou_threshold:
+                break
+            if track_id in used or assigned[i] is not None:
+                continue
+            used.add(track_id)
+            assigned[i] = self.tracks[track_id]
+
+        for i, box in enumerate(boxes):
+            if assigned[i] is None:
+                assigned[i] = self.tracks[self._next_id] = Track(self._next_id, box, self.frame)
+                self._next_id += 1
+            assigned[i].box = box
+            assigned[i].last_seen = self.frame
+
+        for track_id in [t for t, track in self.tracks.items() if self.frame - track.last_seen > self.max_missed]:
+            del self.tracks[track_id]
+        return assigned
+
+
+class PinnedRoster:
+    """A session's roster plus the students already marked, shared by its kiosks"""
+
+    def __init__(self, session):
+        self.session_id = session.id
+        self.roster = Roster.for_session(session)
+        self.students = {
+            student['id']: (student['roll_number'], f"{student['first_name']} {student['last_name']}".strip())
+            for student in User.objects.filter(id__in=self.roster.user_ids.tolist()).values('id', 'roll_number', 'first_name', 'last_name')
+        }
+        self.marked = set(AttendanceRecord.objects.filter(session=session).values_list('user_id', flat=True))
+        self._lock = threading.Lock()
+        self.connections = 0
+
+    def claim(self, user_id):
+        """Reserve a student for marking; False if already marked or claimed by another kiosk"""
+        with self._lock:
+            if user_id in self.marked:
+                return False
+            self.marked.add(user_id)
+            return True
+
+    def release(self, user_ids):
+        """Give up claims whose attendance could not be written, so they can be claimed again"""
+        with self._lock:
+            self.marked.difference_update(user_ids)
+
+    def mark(self, user_ids):
+        """
+        Write attendance for claimed students in one statement.
+        Returns the records created by this call, leaving out students marked
+        meanwhile by another path, or None if the session is no longer active.
+        """
+        session = AttendanceSession.objects.filter(id=self.session_id, is_active=True).first()
+        if session is None:
+            return None
+        return mark_present(session, user_ids, 'kiosk')
+
+
+_pinned = {}
+_pinned_lock = threading.Lock()
+
+
+def acquire_roster(session):
+    """The pinned roster of a session, loading it for the session's first kiosk"""
+    with _pinned_lock:
+        pinned = _pinned.get(session.id)
+        if pinned is None:
+            pinned = _pinned[session.id] = PinnedRoster(session)
+        pinned.connections += 1
+        return pinned
+
+
+def release_roster(pinned):
+    """Unpin a session's roster once its last kiosk has disconnected"""
+    with _pinned_lock:
+        pinned.connections -= 1
+        if pinned.connections <= 0 and _pinned.get(pinned.session_id) is pinned:
+            del _pinned[pinned.session_id]
+
+
+class KioskConnection:
+    """One kiosk's WebSocket: frame intake, analysis and batched marking"""
+
+    def __init__(self, send, pinned):
+        self.send = send
+        self.pinned = pinned
+        self.tracker = FaceTracker()
+        self.pending = []
+        self.frame = None
+        self.frame_ready = asyncio.Event()
+        self.closed = False
+        self.max_attempts = getattr(settings, 'FACE_KIOSK_MAX_ATTEMPTS', 3)
+        self.retry_frames = getattr(settings, 'FACE_KIOSK_RETRY_FRAMES', 5)
+        self.batch_size = getattr(settings, 'FACE_KIOSK_BATCH_SIZE', 20)
+        self.flush_seconds = getattr(settings, 'FACE_KIOSK_FLUSH_SECONDS', 2.0)
+
+    async def send_json(self, message):
+        if not self.closed:
+            await self.send({'type': 'websocket.send', 'text': json.dumps(message)})
+
+    async def receive_frames(self, receive):
+        """Keep only the latest frame; the processor picks it up when it is free"""
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                break
+            if event.get('bytes'):
+                self.frame = event['bytes']
+                self.frame_ready.set()
+            elif event.get('text'):
+                try:
+                    message = json.loads(event['text'])
+                except ValueError:
+                    message = {}
+                if message.get('type') == 'ping':
+                    await self.send_json({'type': 'pong'})
+        self.closed = True
+        self.frame_ready.set()
+
+    async def process_frames(self):
+        from .async_views import inference_executor
+
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.frame_ready.wait()
+            self.frame_ready.clear()
+            if self.closed:
+                return
+            frame, self.frame = self.frame, None
+            if frame is None:
+                continue
+            context = contextvars.copy_context()
+            faces, claimed = await loop.run_in_executor(inference_executor, context.run, self.analyze, frame)
+            if faces is None:
+                await self.send_json({'type': 'error', 'message': 'Invalid image data'})
+                continue
+            self.pending.extend(claimed)
+            await self.send_json({'type': 'faces', 'faces': faces})
+            if len(self.pending) >= self.batch_size:
+                await self.flush()
+
+    async def flush_periodically(self):
+        while not self.closed:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def flush(self):
+        user_ids, self.pending = self.pending, []
+        if not user_ids:
+            return
+        try:
+            records = await sync_to_async(self.pinned.mark)(user_ids)
+        except Exception as e:
+            print(f"Error marking kiosk attendance: {e}")
+            # Let any kiosk claim these students again, and retry them with the next batch
+            self.pinned.release(user_ids)
+            self.pending.extend(user_ids)
+            return
+        if records is None:
+            await self.send_json({'type': 'error', 'message': 'The attendance session has ended'})
+            await self.close()
+            return
+        await sync_to_async(send_attendance_emails)(records)
+        await self.send_json({'type': 'marked', 'students': [self.describe(record.user_id) for record in records]})
+
+    async def close(self):
+        if not self.closed:
+            await self.send({'type': 'websocket.close', 'code': 1000})
+            self.closed = True
+            self.frame_ready.set()
+
+    def describe(self, user_id):
+        roll_number, name = self.pinned.students.get(user_id, (None, ''))
+        return {'roll_number': roll_number, 'name': name}
+
+    def analyze(self, frame):
+        """
+        Detect the faces of one frame, advance the tracker and identify the
+        tracks that need it. Runs on an inference thread. Returns the frame's
+        faces (None for an undecodable frame) and the newly claimed students.
+        """
+        token = metrics.begin_request()
+        start = time.perf_counter()
+        claimed = []
+        try:
+            image, _ = decode_image_bytes(frame)
+            if image is None:
+                return None, claimed
+            rgb_image = _to_rgb(image)
+            boxes = [box for _, box in detect_faces(rgb_image)]
+            tracks = self.tracker.update(boxes)
+
+            # Encode only new tracks, and unidentified ones again every few frames
+            due = [
+                track for track in tracks
+                if track.status != IDENTIFIED and track.attempts < self.max_attempts and self.tracker.frame >= track.next_attempt
+            ]
+            encoded = []
+            for track in due:
+                track.attempts += 1
+                track.next_attempt = self.tracker.frame + self.retry_frames
+                face = encode_detected_face(image, rgb_image, track.box)
+                if face is not None and face.encoding is not None:
+                    encoded.append((track, face.encoding))
+                elif track.attempts >= self.max_attempts:
+                    track.status = UNKNOWN
+
+            if encoded:
+                roster = self.pinned.roster
+                matched = set()
+                for row, column, _ in assign(roster.distances([encoding for _, encoding in encoded]), match_tolerance('identify', roster.encoder)):
+                    track = encoded[row][0]
+                    track.status = IDENTIFIED
+                    track.user_id = int(roster.user_ids[column])
+                    matched.add(track.id)
+                    if self.pinned.claim(track.user_id):
+                        claimed.append(track.user_id)
+                for track, _ in encoded:
+                    if track.id not in matched and track.attempts >= self.max_attempts:
+                        track.status = UNKNOWN
+
+            faces = [
+                {'track': track.id, 'box': list(track.box), 'status': track.status,
+                 **(self.describe(track.user_id) if track.user_id else {})}
+                for track in tracks
+            ]
+            return faces, claimed
+        finally:
+            metrics.end_request(token, 'kiosk_frame', time.perf_counter() - start)
+
+
+def _origin_allowed(headers):
+    """Browsers send Origin on WebSocket handshakes; refuse cross-site ones (native apps send none)"""
+    origin = headers.get('origin')
+    if not origin:
+        return True
+    if origin in getattr(settings, 'CORS_ALLOWED_ORIGINS', []):
+        return True
+    return urlsplit(origin).netloc == headers.get('host')
+
+
+async def _scope_user(headers):
+    """The user logged in with the session cookie of a WebSocket handshake, or None"""
+    session_key = parse_cookie(headers.get('cookie', '')).get(settings.SESSION_COOKIE_NAME)
+    if not session_key:
+        return None
+    store = import_string(f'{settings.SESSION_ENGINE}.SessionStore')(session_key)
+    user = await sync_to_async(get_user)(SimpleNamespace(session=store))
+    return user if user.is_authenticated else None
+
+
+async def _authorize(scope):
+    """Returns (session, None) for an allowed kiosk, or (None, reason)"""
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    if not _origin_allowed(headers):
+        return None, 'Cross-origin kiosk connections are not allowed'
+    user = await _scope_user(headers)
+    if user is None:
+        return None, 'Authentication required'
+    role = await Role.objects.filter(id=user.role_id).values_list('name', flat=True).afirst() if user.role_id else None
+    role = (role or '').lower()
+    if role not in ['faculty', 'admin']:
+        return None, 'Faculty or Administrator privileges required'
+    session_id = int(KIOSK_PATH.match(scope['path']).group('session_id'))
+    session = await AttendanceSession.objects.filter(id=session_id, is_active=True).afirst()
+    if session is None:
+        return None, 'No active attendance session found with the provided ID.'
+    if role == 'faculty' and session.faculty_id != user.id:
+        return None, 'You are not authorized to mark attendance for this session'
+    return session, None
+
+
+async def kiosk_application(scope, receive, send):
+    """ASGI application for kiosk WebSockets"""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if not KIOSK_PATH.match(scope['path']):
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    session, reason = await _authorize(scope)
+    if session is None:
+        print(f"Kiosk connection refused: {reason}")
+        # Closing before accepting answers the handshake with HTTP 403
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+
+    pinned = await sync_to_async(acquire_roster)(session)
+    try:
+        await send({'type': 'websocket.accept'})
+        connection = KioskConnection(send, pinned)
+        await connection.send_json({'type': 'ready', 'session_id': session.id, 'roster_size': len(pinned.roster)})
+
+        receiver = asyncio.create_task(connection.receive_frames(receive))
+        flusher = asyncio.create_task(connection.flush_periodically())
+        try:
+            await connection.process_frames()
+        finally:
+            receiver.cancel()
+            flusher.cancel()
+            # Write whatever was identified since the last batch
+            connection.closed = True
+            await connection.flush()
+    finally:
+        await sync_to_async(release_roster)(pinned)
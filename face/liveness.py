@@ -0,0 +1,216 @@
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .cv import np, cv2
+from .metrics import record_stage
+
+
+# Cascade tiers, in the order analyze_face reaches them
+FRAME = 'frame'          # whole-frame statistics, before face detection
+FACE = 'face'            # after detection, before the face mesh
+LANDMARKS = 'landmarks'  # after the face mesh
+
+
+class LivenessFrame:
+    """Image planes shared by every check in one cascade run"""
+
+    def __init__(self, image, gray):
+        self.image = image
+        self.gray = gray
+
+    @property
+    def is_color(self):
+        return len(self.image.shape) == 3 and self.image.shape[2] == 3
+
+
+class LivenessCheck:
+    """
+    One step of the liveness cascade.
+
+    Subclasses set name and tier and implement run(), which records its
+    statistic on the FaceAnalysis and returns a rejection reason, or None if
+    the frame passes. cost is an exponentially weighted moving average of the
+    check's measured run time and decides its position within its tier.
+    """
+    name = ''
+    tier = FRAME
+    initial_cost = 0.001
+
+    def __init__(self):
+        self.cost = self.initial_cost
+
+    def observe(self, duration):
+        self.cost = 0.8 * self.cost + 0.2 * duration
+
+    def run(self, analysis, frame):
+        raise NotImplementedError
+
+
+class BrightnessCheck(LivenessCheck):
+    """Reject frames that are far too dark or too bright to be a live capture"""
+    name = 'brightness'
+    initial_cost = 0.0001
+
+    def run(self, analysis, frame):
+        analysis.mean_brightness = float(cv2.mean(frame.gray)[0])
+        if analysis.mean_brightness < 30 or analysis.mean_brightness > 220:
+            return f"Unnatural brightness ({analysis.mean_brightness}), potentially not live"
+        return None
+
+
+class ColorVarianceCheck(LivenessCheck):
+    """Reject frames with very low colour variance, typical of screen photos"""
+    name = 'color_variance'
+    initial_cost = 0.0005
+
+    def run(self, analysis, frame):
+        if not frame.is_color:
+            return None
+        _, stddev = cv2.meanStdDev(frame.image)
+        analysis.color_variance = float(np.mean(stddev ** 2))
+        if analysis.color_variance < 100:
+            return f"Low color variance ({analysis.color_variance}), likely screen photo"
+        return None
+
+
+class BlurCheck(LivenessCheck):
+    """Reject very blurry frames using the variance of the Laplacian"""
+    name = 'laplacian'
+    initial_cost = 0.003
+
+    def run(self, analysis, frame):
+        _, stddev = cv2.meanStdDev(cv2.Laplacian(frame.gray, cv2.CV_64F))
+        analysis.blur_variance = float(stddev[0][0] ** 2)
+        if analysis.blur_variance < 50:
+            return f"Image too blurry (variance: {analysis.blur_variance}), likely not live"
+        return None
+
+
+class FaceDetectedCheck(LivenessCheck):
+    """Reject frames in which no face was detected"""
+    name = 'detection'
+    tier = FACE
+    initial_cost = 0.00001
+
+    def run(self, analysis, frame):
+        if not analysis.detections:
+            return "No faces detected for liveness check"
+        return None
+
+
+class SingleFaceCheck(LivenessCheck):
+    """Reject frames with several faces, common when photographing a screen"""
+    name = 'multiple_faces'
+    tier = FACE
+    initial_cost = 0.00001
+
+    def run(self, analysis, frame):
+        if analysis.face_count > 1:
+            return f"Multiple faces detected ({analysis.face_count}), likely not live"
+        return None
+
+
+class MoireCheck(LivenessCheck):
+    """
+    Reject faces whose spectrum carries too much high frequency energy, a sign
+    of Moire patterns from photographing a screen.
+
+    The FFT runs on the face region downsampled to a fixed size, so its cost
+    does not depend on the capture resolution; the energy is the mean
+    log-magnitude outside the low frequency disc.
+    """
+    name = 'fft'
+    tier = FACE
+    initial_cost = 0.001
+    roi_size = 128
+
+    def run(self, analysis, frame):
+        if not analysis.face_box:
+            return None
+        x, y, width, height = analysis.face_box
+        if width <= 0 or height <= 0:
+            return None
+        roi = cv2.resize(frame.gray[y:y+height, x:x+width], (self.roi_size, self.roi_size), interpolation=cv2.INTER_AREA)
+
+        spectrum = np.fft.fftshift(np.fft.fft2(roi.astype(np.float32)))
+        magnitude_spectrum = 20 * np.log(np.abs(spectrum) + 1)
+        center = (self.roi_size // 2, self.roi_size // 2)
+        mask = np.ones_like(magnitude_spectrum)
+        cv2.circle(mask, center, self.roi_size // 8, 0, -1)
+        analysis.high_freq_energy = float(np.sum(magnitude_spectrum * mask) / np.sum(mask))
+
+        threshold = getattr(settings, 'FACE_LIVENESS_FFT_THRESHOLD', 140.0)
+        if analysis.high_freq_energy > threshold:
+            return f"High frequency energy ({analysis.high_freq_energy}), likely screen photo"
+        return None
+
+
+class LandmarksCheck(LivenessCheck):
+    """Reject faces on which the face mesh found no landmarks"""
+    name = 'landmarks'
+    tier = LANDMARKS
+    initial_cost = 0.00001
+
+    def run(self, analysis, frame):
+        if analysis.landmarks is None:
+            return "No face landmarks detected"
+        return None
+
+
+DEFAULT_CHECKS = (
+    BrightnessCheck,
+    ColorVarianceCheck,
+    BlurCheck,
+    FaceDetectedCheck,
+    SingleFaceCheck,
+    MoireCheck,
+    LandmarksCheck,
+)
+
+
+class LivenessCascade:
+    """
+    Ordered set of liveness checks that stops at the first rejection.
+
+    analyze_face runs one tier at a time so expensive work (detection, the
+    face mesh) is only done for frames that passed every cheaper check.
+    Within a tier, checks run cheapest first by measured cost.
+    """
+
+    def __init__(self, checks=None):
+        self._lock = threading.Lock()
+        self.checks = list(checks) if checks is not None else self._configured_checks()
+
+    @staticmethod
+    def _configured_checks():
+        paths = getattr(settings, 'FACE_LIVENESS_CHECKS', None)
+        classes = [import_string(path) for path in paths] if paths else DEFAULT_CHECKS
+        return [check_class() for check_class in classes]
+
+    def register(self, check):
+        """Add a check to the cascade"""
+        with self._lock:
+            self.checks = self.checks + [check]
+
+    def run(self, tier, analysis, frame):
+        """
+        Run every check of one tier. Returns None if the frame passed, or the
+        rejection reason after recording the rejecting check on the analysis.
+        """
+        checks = sorted((check for check in self.checks if check.tier == tier), key=lambda check: check.cost)
+        for check in checks:
+            start = time.perf_counter()
+            reason = check.run(analysis, frame)
+            duration = time.perf_counter() - start
+            check.observe(duration)
+            record_stage(f'liveness.{check.name}', duration)
+            if reason:
+                analysis.liveness_stage = check.name
+                return reason
+        return None
+
+
+liveness_cascade = LivenessCascade()
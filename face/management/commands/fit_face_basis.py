@@ -0,0 +1,149 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...cv import np
+from ...encoders import ALIGNED_PCA, MATCH_TOLERANCES, FaceBasis, MESH_DIMENSION, stable_landmarks
+from ...models import User, FaceTemplate
+from ...utils import FACE_MODEL_MEDIAPIPE_MESH, analyze_face, decode_image_bytes, unpack_face_encoding
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# Pairs of different users sampled to measure impostor distances
+IMPOSTOR_PAIRS = 20000
+
+
+class Command(BaseCommand):
+    help = 'Fit the aligned-landmark PCA basis used by the aligned_pca face encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--components',
+            type=int,
+            default=64,
+            help='Dimension of the fitted encoding (default 64)',
+        )
+        parser.add_argument(
+            '--images',
+            type=str,
+            help='Directory of face images to fit on in addition to the stored raw mesh encodings',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            default=str(settings.FACE_ENCODING_BASIS),
+            help='Path of the basis artifact to write (defaults to FACE_ENCODING_BASIS)',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Replace an existing basis. Encodings made with it stop matching until users re-register',
+        )
+
+    def stored_encodings(self):
+        """(user id, raw mesh encoding) of every user and template"""
+        blobs = list(User.objects.exclude(face_encoding__isnull=True).values_list('id', 'face_encoding').iterator())
+        blobs += list(FaceTemplate.objects.values_list('user_id', 'encoding').iterator())
+        for user_id, blob in blobs:
+            try:
+                vector, model_id, _ = unpack_face_encoding(blob)
+            except ValueError:
+                continue
+            if model_id == FACE_MODEL_MEDIAPIPE_MESH and len(vector) == MESH_DIMENSION:
+                yield user_id, vector
+
+    def report_distances(self, basis, user_ids, encodings):
+        """
+        Print the distances between projected encodings of the same user
+        (genuine) and of different users (impostor), and how the configured
+        aligned_pca tolerances split them
+        """
+        user_ids = np.asarray(user_ids)
+        vectors = basis.project(encodings).astype(np.float64)
+        normalized = lambda a, b: np.linalg.norm(vectors[a] - vectors[b], axis=1) / np.sqrt(basis.dimension)
+
+        first, second = [], []
+        for user_id in np.unique(user_ids):
+            rows = np.flatnonzero(user_ids == user_id)
+            for i in range(len(rows)):
+                first.extend([rows[i]] * (len(rows) - i - 1))
+                second.extend(rows[i + 1:])
+        genuine = normalized(np.array(first, dtype=np.int64), np.array(second, dtype=np.int64))
+
+        rng = np.random.default_rng(0)
+        a, b = rng.integers(0, len(vectors), size=(2, IMPOSTOR_PAIRS))
+        different = user_ids[a] != user_ids[b]
+        impostor = normalized(a[different], b[different])
+
+        if not len(genuine) or not len(impostor):
+            self.stdout.write('Not enough users with several stored encodings to measure match distances')
+            return
+        percentiles = (1, 5, 50, 95, 99)
+        for label, distances in (('genuine', genuine), ('impostor', impostor)):
+            values = ', '.join(f'p{p} {value:.4f}' for p, value in zip(percentiles, np.percentile(distances, percentiles)))
+            self.stdout.write(f'{label.capitalize()} distances ({len(distances)} pairs): {values}')
+        tolerances = getattr(settings, 'FACE_MATCH_TOLERANCES', MATCH_TOLERANCES)[ALIGNED_PCA]
+        for kind, tolerance in tolerances.items():
+            self.stdout.write(
+                f'  {kind} {tolerance}: rejects {np.mean(genuine > tolerance):.1%} of genuine pairs, '
+                f'accepts {np.mean(impostor <= tolerance):.2%} of impostor pairs'
+            )
+
+    def image_encodings(self, directory):
+        for name in sorted(os.listdir(directory)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            with open(os.path.join(directory, name), 'rb') as f:
+                image, _ = decode_image_bytes(f.read())
+            if image is None:
+                self.stdout.write(self.style.WARNING(f'Skipping {name}: not a decodable image'))
+                continue
+            analysis = analyze_face(image, check_liveness=False)
+            if analysis.encoding is None:
+                self.stdout.write(self.style.WARNING(f'Skipping {name}: no face landmarks found'))
+                continue
+            yield analysis.encoding
+
+    def handle(self, *args, **options):
+        output = options['output']
+        components = options['components']
+        previous = None
+        if os.path.exists(output):
+            if not options['force']:
+                raise CommandError(
+                    f'{output} already exists. Encodings made with it will no longer match after refitting; '
+                    'pass --force to replace it'
+                )
+            previous = FaceBasis.load(output)
+
+        stored = list(self.stored_encodings())
+        encodings = [vector for _, vector in stored]
+        self.stdout.write(f'Found {len(encodings)} stored raw mesh encodings')
+        if options['images']:
+            from_images = list(self.image_encodings(options['images']))
+            self.stdout.write(f'Encoded {len(from_images)} faces from {options["images"]}')
+            encodings += from_images
+
+        if len(encodings) <= components:
+            raise CommandError(
+                f'Fitting {components} components needs more than {components} faces, found {len(encodings)}. '
+                'Pass --images with more face images or lower --components'
+            )
+
+        # Basis ids are u16 and 0 means "no basis"
+        basis_id = previous.basis_id % 65535 + 1 if previous else 1
+        basis = FaceBasis.fit(encodings, stable_landmarks(), components, basis_id)
+        basis.save(output)
+
+        self.stdout.write(
+            f'{len(basis.indices)} stable landmarks, {basis.dimension} components explaining '
+            f'{basis.explained_variance_ratio.sum():.1%} of the aligned shape variance'
+        )
+        # Set FACE_MATCH_TOLERANCES from these: the basis was fitted on the same faces, so treat them as optimistic
+        if stored:
+            self.report_distances(basis, [user_id for user_id, _ in stored], encodings[:len(stored)])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote face basis {basis_id} to {output}. '
+            "Set FACE_ENCODING_MODEL = 'aligned_pca' and run `manage.py reencode_faces`"
+        ))
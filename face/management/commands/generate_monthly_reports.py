@@ -1,99 +1,99 @@
-from django.core.management.base import BaseCommand
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.utils import timezone
-from django.contrib.auth import get_user_model
-from ...models import AttendanceSession, AttendanceRecord, MonthlyReport
-from ...utils import send_monthly_report_email
-from datetime import datetime, timedelta
-import calendar
 
-User = get_user_model()
+from ...monthly import compute_month, month_start, parse_months, queue_month_emails, save_month
+
+
+def _compute(month):
+    started = time.perf_counter()
+    totals = compute_month(month)
+    return totals, time.perf_counter() - started
+
+
+def _compute_in_worker(month):
+    """Compute one month in a worker thread, closing the thread's own database connection afterwards"""
+    try:
+        return _compute(month)
+    finally:
+        connections.close_all()
+
 
 class Command(BaseCommand):
-    help = 'Generate monthly attendance reports and send emails'
+    help = 'Generate monthly attendance reports for every user'
 
     def add_arguments(self, parser):
         parser.add_argument(
-            '--month',
+            '--months', '--month',
+            dest='months',
             type=str,
-            help='Month to generate reports for (YYYY-MM format)',
+            help='Months to generate reports for: YYYY-MM, a range YYYY-MM:YYYY-MM, or a comma separated list (defaults to the previous month)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Months computed in parallel',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Compute the reports and print timings without saving them',
+        )
+        parser.add_argument(
+            '--email',
+            action='store_true',
+            help='Queue each user\'s report email in the outbox (sent once per user and month)',
         )
 
     def handle(self, *args, **options):
-        # Determine the month to generate reports for
-        if options['month']:
+        # Determine the months to generate reports for
+        if options['months']:
             try:
-                year, month = map(int, options['month'].split('-'))
-                report_date = timezone.datetime(year, month, 1)
+                months = parse_months(options['months'])
             except ValueError:
-                self.stdout.write(
-                    self.style.ERROR('Invalid month format. Use YYYY-MM')
-                )
-                return
+                raise CommandError('Invalid month format. Use YYYY-MM, YYYY-MM:YYYY-MM or a comma separated list')
         else:
             # Default to previous month
-            today = timezone.now().date()
-            first_day_current_month = today.replace(day=1)
-            report_date = first_day_current_month - timedelta(days=1)
-            report_date = report_date.replace(day=1)
-        
+            today = timezone.localdate()
+            months = [month_start(today.replace(day=1) - timedelta(days=1))]
+
+        workers = max(1, min(options['workers'], len(months)))
         self.stdout.write(
-            f'Generating monthly reports for {report_date.strftime("%B %Y")}'
+            f'Generating monthly reports for {", ".join(month.strftime("%B %Y") for month in months)}'
         )
-        
-        # Get all users
-        users = User.objects.all()
-        
-        for user in users:
-            # Get all sessions in the report month
-            start_date = report_date.replace(day=1)
-            last_day = calendar.monthrange(report_date.year, report_date.month)[1]
-            end_date = report_date.replace(day=last_day) + timedelta(days=1)
-            
-            # Get sessions in the month
-            sessions = AttendanceSession.objects.filter(
-                start_time__gte=start_date,
-                start_time__lt=end_date
-            )
-            
-            total_sessions = sessions.count()
-            
-            # Get attendance records for the user in these sessions
-            attended_sessions = AttendanceRecord.objects.filter(
-                user=user,
-                session__in=sessions
-            ).count()
-            
-            # Calculate attendance percentage
-            if total_sessions > 0:
-                attendance_percentage = (attended_sessions / total_sessions) * 100
-            else:
-                attendance_percentage = 0.0
-            
-            # Create or update the monthly report
-            report, created = MonthlyReport.objects.update_or_create(
-                user=user,
-                month=report_date,
-                defaults={
-                    'total_sessions': total_sessions,
-                    'attended_sessions': attended_sessions,
-                    'attendance_percentage': attendance_percentage
-                }
-            )
-            
-            # Send email report
-            if send_monthly_report_email(user, report):
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'Successfully sent report to {user.email}'
-                    )
-                )
-            else:
-                self.stdout.write(
-                    self.style.ERROR(
-                        f'Failed to send report to {user.email}'
-                    )
-                )
-        
+
+        started = time.perf_counter()
+        if workers == 1:
+            results = map(_compute, months)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='monthly_report')
+            results = executor.map(_compute_in_worker, months)
+        try:
+            # Months are saved one at a time as they finish, from this thread
+            for month, (totals, compute_seconds) in zip(months, results):
+                save_seconds = 0.0
+                if not options['dry_run']:
+                    saving = time.perf_counter()
+                    save_month(month, totals)
+                    save_seconds = time.perf_counter() - saving
+                line = f'{month.strftime("%B %Y")}: {len(totals)} users, computed in {compute_seconds:.2f}s'
+                if options['dry_run']:
+                    line += ' (dry run, not saved)'
+                else:
+                    line += f', saved in {save_seconds:.2f}s'
+                    if options['email']:
+                        line += f', {queue_month_emails(month)} emails queued'
+                self.stdout.write(line)
+        finally:
+            if workers > 1:
+                executor.shutdown()
+
         self.stdout.write(
-            self.style.SUCCESS('Monthly reports generation completed')
-        )
\ No newline at end of file
+            self.style.SUCCESS(f'Monthly reports generation completed in {time.perf_counter() - started:.2f}s')
+        )
+
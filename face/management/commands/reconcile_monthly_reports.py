@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...monthly import find_drift, month_start, parse_months, repair_drift
+
+
+class Command(BaseCommand):
+    help = 'Find monthly reports that drifted from the attendance records and repair them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', '--month',
+            dest='months',
+            type=str,
+            help='Months to check: YYYY-MM, a range YYYY-MM:YYYY-MM, or a comma separated list (defaults to the current month)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report drifted reports without repairing them',
+        )
+
+    def handle(self, *args, **options):
+        if options['months']:
+            try:
+                months = parse_months(options['months'])
+            except ValueError:
+                raise CommandError('Invalid month format. Use YYYY-MM, YYYY-MM:YYYY-MM or a comma separated list')
+        else:
+            months = [month_start(timezone.localdate())]
+
+        total_drifted = total_repaired = 0
+        for month in months:
+            started = time.perf_counter()
+            drift = find_drift(month)
+            for report, (total, attended) in drift[:20]:
+                self.stdout.write(
+                    f'  {report.user_id}: {report.attended_sessions}/{report.total_sessions} stored, {attended}/{total} expected'
+                )
+            if len(drift) > 20:
+                self.stdout.write(f'  ... and {len(drift) - 20} more')
+            repaired = 0 if options['dry_run'] else repair_drift(drift)
+            total_drifted += len(drift)
+            total_repaired += repaired
+            self.stdout.write(
+                f'{month.strftime("%B %Y")}: {len(drift)} drifted, {repaired} repaired in {time.perf_counter() - started:.2f}s'
+            )
+
+        style = self.style.SUCCESS if total_drifted == total_repaired else self.style.WARNING
+        self.stdout.write(style(f'Reconciliation completed: {total_drifted} drifted, {total_repaired} repaired'))
@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...encoders import MeshEncoder, active_encoder
+from ...models import User, FaceTemplate
+from ...utils import pack_face_encoding, unpack_face_encoding
+
+
+class Command(BaseCommand):
+    help = 'Rewrite stored raw mesh face encodings in the active FACE_ENCODING_MODEL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows converted and saved per batch (default 500)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the encodings that would be rewritten without saving them',
+        )
+
+    def reencode(self, model, field, encoder, batch_size, dry_run):
+        """Convert every row of model whose encoding is not yet in the active encoder's model"""
+        rewritten = skipped = 0
+        batch = []
+
+        def flush():
+            nonlocal rewritten, skipped
+            vectors = encoder.deserialize_many([getattr(row, field) for row in batch])
+            with transaction.atomic():
+                for row, vector in zip(batch, vectors):
+                    if vector is None:
+                        skipped += 1
+                        continue
+                    rewritten += 1
+                    if dry_run:
+                        continue
+                    # Only replace the encoding that was converted, in case the user re-registered meanwhile
+                    model.objects.filter(pk=row.pk, **{field: getattr(row, field)}).update(
+                        **{field: pack_face_encoding(vector, encoder.model_id, encoder.dtype, encoder.basis_id)}
+                    )
+            batch.clear()
+
+        rows = model.objects.exclude(**{f'{field}__isnull': True}).only('pk', field)
+        for row in rows.iterator(chunk_size=batch_size):
+            try:
+                _, model_id, basis_id = unpack_face_encoding(getattr(row, field))
+            except ValueError:
+                skipped += 1
+                continue
+            if (model_id, basis_id) == encoder.key:
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        return rewritten, skipped
+
+    def handle(self, *args, **options):
+        encoder = active_encoder()
+        if isinstance(encoder, MeshEncoder):
+            raise CommandError(
+                "The active encoder is the raw mesh. Fit a basis with `manage.py fit_face_basis` "
+                "and set FACE_ENCODING_MODEL = 'aligned_pca' first"
+            )
+
+        batch_size = max(1, options['batch_size'])
+        for model, field in ((User, 'face_encoding'), (FaceTemplate, 'encoding')):
+            rewritten, skipped = self.reencode(model, field, encoder, batch_size, options['dry_run'])
+            action = 'Would rewrite' if options['dry_run'] else 'Rewrote'
+            self.stdout.write(
+                f'{action} {rewritten} {model.__name__} encodings to basis {encoder.basis_id} '
+                f'({skipped} could not be converted)'
+            )
+
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                'Done. Workers pick up the new encodings when their face index next reloads (FACE_INDEX_TTL)'
+            ))
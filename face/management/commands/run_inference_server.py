@@ -0,0 +1,48 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...inference import InferenceServer
+
+
+class Command(BaseCommand):
+    help = 'Run the local face inference service that Django workers call over a UNIX socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            type=str,
+            default=getattr(settings, 'FACE_INFERENCE_SOCKET', None),
+            help='Path of the UNIX socket to listen on (defaults to FACE_INFERENCE_SOCKET)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of frames analyzed concurrently (defaults to the CPU count)',
+        )
+
+    def handle(self, *args, **options):
+        socket_path = options['socket']
+        if not socket_path:
+            self.stdout.write(
+                self.style.ERROR('No socket path given. Pass --socket or set FACE_INFERENCE_SOCKET')
+            )
+            return
+
+        workers = max(1, options['workers'])
+        server = InferenceServer(socket_path, workers)
+
+        self.stdout.write(f'Loading face models on {workers} inference threads')
+        server.warm_up(workers)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Inference service listening on {socket_path}')
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
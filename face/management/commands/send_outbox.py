@@ -0,0 +1,55 @@
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...outbox import send_batch
+
+
+class Command(BaseCommand):
+    help = 'Send the emails queued in the outbox in batches over one connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 50),
+            help='Emails claimed and sent per batch (defaults to EMAIL_OUTBOX_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--poll-seconds',
+            type=float,
+            default=getattr(settings, 'EMAIL_OUTBOX_POLL_SECONDS', 5),
+            help='Seconds to wait when no email is due (defaults to EMAIL_OUTBOX_POLL_SECONDS)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Send the emails that are due now and exit instead of running as a worker',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        connection = get_connection()
+        total_sent = total_failed = 0
+        try:
+            while True:
+                close_old_connections()
+                sent, failed = send_batch(connection, batch_size)
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    self.stdout.write(f'Sent {sent} emails, {failed} failed')
+                    continue
+                # Nothing due, or this minute's allowance is used up: release the SMTP connection while idle
+                connection.close()
+                if options['once']:
+                    break
+                time.sleep(options['poll_seconds'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+        self.stdout.write(self.style.SUCCESS(f'Outbox worker stopped: {total_sent} sent, {total_failed} failed'))
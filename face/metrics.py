@@ -0,0 +1,137 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+
+# Upper bounds (seconds) of the duration histogram buckets
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Endpoint label used for stages timed outside of a request (jobs, commands)
+BACKGROUND_ENDPOINT = 'background'
+
+_current_timings = contextvars.ContextVar('face_stage_timings', default=None)
+
+
+class Histogram:
+    """Cumulative duration histogram with fixed buckets, safe to update from many threads"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+
+class MetricsRegistry:
+    """Histograms of face pipeline stage durations, keyed by (endpoint, stage)"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, stage, duration):
+        key = (endpoint, stage)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(duration)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def render_prometheus(self):
+        """Render every histogram in the Prometheus text exposition format"""
+        lines = [
+            '# HELP face_stage_duration_seconds Time spent in each face pipeline stage',
+            '# TYPE face_stage_duration_seconds histogram',
+        ]
+        with self._lock:
+            items = sorted(self._histograms.items())
+        for (endpoint, stage), histogram in items:
+            counts, count, total = histogram.snapshot()
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'face_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'face_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'face_stage_duration_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'face_stage_duration_seconds_count{{{labels}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class stage_timer:
+    """
+    Context manager timing one stage of the face pipeline.
+
+    Inside a request the duration is attached to the request and published by
+    RequestTimingMiddleware under the endpoint's URL name; outside a request it
+    is recorded straight away under the 'background' endpoint.
+    """
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def record_stage(stage, duration):
+    """Record an already measured stage duration (seconds)"""
+    timings = _current_timings.get()
+    if timings is None:
+        registry.observe(BACKGROUND_ENDPOINT, stage, duration)
+    else:
+        timings.append((stage, duration))
+
+
+def begin_request():
+    """Start collecting stage timings for the current request; returns a reset token"""
+    return _current_timings.set([])
+
+
+def end_request(token, endpoint, total_duration):
+    """
+    Publish the current request's stage timings under its endpoint and stop
+    collecting. Returns the list of (stage, seconds) recorded during the request.
+    """
+    timings = _current_timings.get() or []
+    _current_timings.reset(token)
+    for stage, duration in timings:
+        registry.observe(endpoint, stage, duration)
+    registry.observe(endpoint, 'total', total_duration)
+    return timings
+
+
+def server_timing_header(timings, total_duration):
+    """Format stage timings as a Server-Timing header value (durations in ms)"""
+    totals = {}
+    for stage, duration in timings:
+        totals[stage] = totals.get(stage, 0.0) + duration
+    entries = [f'{stage};dur={duration * 1000:.1f}' for stage, duration in totals.items()]
+    entries.append(f'total;dur={total_duration * 1000:.1f}')
+    return ', '.join(entries)
@@ -1,16 +1,52 @@
+import re
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
 from django.shortcuts import redirect
 from django.contrib import messages
-import re
 
-class RoleBasedAccessMiddleware:
+from . import metrics
+
+class AsyncCapableMiddleware:
     """
-    Simplified middleware for access control
+    Base for middleware that runs natively in both WSGI and ASGI stacks, so the
+    async API views are not forced back onto a thread
     """
+    sync_capable = True
+    async_capable = True
     
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
+class RoleBasedAccessMiddleware(AsyncCapableMiddleware):
+    """
+    Simplified middleware for access control
+    """
+    
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # If user is not authenticated, redirect to login
+        if not self._is_public(request.path) and not request.user.is_authenticated:
+            return redirect('face:login')
+        return self.get_response(request)
+    
+    async def __acall__(self, request):
+        if not self._is_public(request.path):
+            # Loading the user is a database query, which must not run on the event loop
+            if hasattr(request, 'auser'):
+                is_authenticated = (await request.auser()).is_authenticated
+            else:
+                is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+            if not is_authenticated:
+                return redirect('face:login')
+        return await self.get_response(request)
+    
+    @staticmethod
+    def _is_public(requested_path):
+        """Whether the path is served without a logged in user"""
         # Paths that are always accessible
         always_accessible = [
             '/login/',
@@ -20,44 +56,34 @@ class RoleBasedAccessMiddleware:
             '/static/',
             '/media/',
             '/favicon.ico',
+            '/healthz/',  # Load balancer probes
             '^$',  # Home page
         ]
         
         # Check if the path is always accessible
-        requested_path = request.path
         is_always_accessible = any(
             re.match(path, requested_path) or requested_path.startswith(path)
             for path in always_accessible
         )
         
-        # If path is always accessible, allow access
-        if is_always_accessible:
-            response = self.get_response(request)
-            return response
-        
-        # If user is not authenticated, redirect to login
-        if not request.user.is_authenticated:
-            # Don't redirect for API endpoints
-            if requested_path.startswith('/api/'):
-                response = self.get_response(request)
-                return response
-            return redirect('face:login')
-        
-        # For authenticated users, allow access to most pages
-        response = self.get_response(request)
-        return response
+        # API endpoints check authentication themselves and are never redirected
+        return is_always_accessible or requested_path.startswith('/api/')
 
-class SecurityHeadersMiddleware:
+class SecurityHeadersMiddleware(AsyncCapableMiddleware):
     """
     Middleware to add security headers
     """
     
-    def __init__(self, get_response):
-        self.get_response = get_response
-
     def __call__(self, request):
-        response = self.get_response(request)
-        
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self._add_headers(self.get_response(request))
+    
+    async def __acall__(self, request):
+        return self._add_headers(await self.get_response(request))
+    
+    @staticmethod
+    def _add_headers(response):
         # Add security headers
         response["X-Frame-Options"] = "DENY"
         response["X-Content-Type-Options"] = "nosniff"
@@ -66,22 +92,46 @@ class SecurityHeadersMiddleware:
         
         return response
 
-class RequestTimingMiddleware:
+class RequestTimingMiddleware(AsyncCapableMiddleware):
     """
-    Middleware to log request processing time
+    Middleware to log request processing time and publish face pipeline stage timings
     """
     
-    def __init__(self, get_response):
-        self.get_response = get_response
-
     def __call__(self, request):
-        import time
-        start_time = time.time()
-        response = self.get_response(request)
-        duration = time.time() - start_time
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start_time = time.perf_counter()
+        token = metrics.begin_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            duration, timings = self._finish(request, token, start_time)
+        return self._report(request, response, duration, timings)
+    
+    async def __acall__(self, request):
+        start_time = time.perf_counter()
+        token = metrics.begin_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            duration, timings = self._finish(request, token, start_time)
+        return self._report(request, response, duration, timings)
+    
+    @staticmethod
+    def _finish(request, token, start_time):
+        duration = time.perf_counter() - start_time
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.url_name if match and match.url_name else 'unresolved'
+        return duration, metrics.end_request(token, endpoint, duration)
+    
+    @staticmethod
+    def _report(request, response, duration, timings):
+        # Optionally expose the stage breakdown to clients and browser dev tools
+        if getattr(settings, 'FACE_SERVER_TIMING', False):
+            response['Server-Timing'] = metrics.server_timing_header(timings, duration)
         
         # Log slow requests (more than 1 second)
         if duration > 1.0:
             print(f"Slow request: {request.path} took {duration:.2f}s")
         
-        return response
\ No newline at end of file
+        return response
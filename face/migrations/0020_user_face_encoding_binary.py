@@ -0,0 +1,76 @@
+import base64
+import struct
+
+from django.db import migrations, models
+
+
+# Mirrors face.utils.FACE_ENCODING_HEADER at the time of this migration
+HEADER = struct.Struct('<2sBBBxH')
+MAGIC = b'FE'
+VERSION = 1
+DTYPE_FLOAT32 = 1
+MODEL_MEDIAPIPE_MESH = 1
+BATCH_SIZE = 500
+
+
+def base64_to_binary(apps, schema_editor):
+    """Convert base64 float32 encodings into the versioned binary format"""
+    User = apps.get_model('face', 'User')
+    batch = []
+    rows = User.objects.exclude(face_encoding__isnull=True).exclude(face_encoding='').only('id', 'face_encoding')
+    for user in rows.iterator(chunk_size=BATCH_SIZE):
+        try:
+            raw = base64.b64decode(user.face_encoding)
+        except Exception:
+            raw = b''
+        # encode_face always produced float32 vectors
+        if raw and len(raw) % 4 == 0:
+            user.face_encoding_data = HEADER.pack(MAGIC, VERSION, DTYPE_FLOAT32, MODEL_MEDIAPIPE_MESH, len(raw) // 4) + raw
+        else:
+            user.face_encoding_data = None
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, ['face_encoding_data'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['face_encoding_data'])
+
+
+def binary_to_base64(apps, schema_editor):
+    """Convert binary encodings back into base64 strings of the raw vector"""
+    User = apps.get_model('face', 'User')
+    batch = []
+    rows = User.objects.exclude(face_encoding_data__isnull=True).only('id', 'face_encoding_data')
+    for user in rows.iterator(chunk_size=BATCH_SIZE):
+        blob = bytes(user.face_encoding_data)
+        user.face_encoding = base64.b64encode(blob[HEADER.size:]).decode() if len(blob) > HEADER.size else None
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, ['face_encoding'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['face_encoding'])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("face", "0019_attendancesession_department_attendancesession_level"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="face_encoding_data",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(base64_to_binary, binary_to_base64),
+        migrations.RemoveField(
+            model_name="user",
+            name="face_encoding",
+        ),
+        migrations.RenameField(
+            model_name="user",
+            old_name="face_encoding_data",
+            new_name="face_encoding",
+        ),
+    ]
@@ -0,0 +1,86 @@
+import base64
+import hashlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BATCH_SIZE = 200
+
+
+def move_images_to_store(apps, schema_editor):
+    """Move base64 face images off the user row into the content-addressed store"""
+    User = apps.get_model('face', 'User')
+    FaceImage = apps.get_model('face', 'FaceImage')
+    batch = []
+    rows = User.objects.exclude(face_image__isnull=True).exclude(face_image='').only('id', 'face_image')
+    for user in rows.iterator(chunk_size=BATCH_SIZE):
+        image_data = user.face_image
+        if image_data.startswith('data:image'):
+            image_data = image_data.split(',')[1]
+        try:
+            raw = base64.b64decode(image_data)
+        except Exception:
+            continue
+        digest = hashlib.sha256(raw).hexdigest()
+        FaceImage.objects.get_or_create(sha256=digest, defaults={'data': raw})
+        user.face_image_ref_id = digest
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, ['face_image_ref'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['face_image_ref'])
+
+
+def move_images_to_user(apps, schema_editor):
+    """Inline stored face images back onto the user row as base64"""
+    User = apps.get_model('face', 'User')
+    batch = []
+    rows = User.objects.exclude(face_image_ref__isnull=True).select_related('face_image_ref')
+    for user in rows.iterator(chunk_size=BATCH_SIZE):
+        user.face_image = base64.b64encode(bytes(user.face_image_ref.data)).decode()
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, ['face_image'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['face_image'])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("face", "0020_user_face_encoding_binary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FaceImage",
+            fields=[
+                ("sha256", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("data", models.BinaryField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="face_image_ref",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="users",
+                to="face.faceimage",
+            ),
+        ),
+        migrations.RunPython(move_images_to_store, move_images_to_user),
+        migrations.RemoveField(
+            model_name="user",
+            name="face_image",
+        ),
+        migrations.RenameField(
+            model_name="user",
+            old_name="face_image_ref",
+            new_name="face_image",
+        ),
+    ]
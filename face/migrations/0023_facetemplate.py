@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BATCH_SIZE = 500
+
+
+def copy_encodings_to_templates(apps, schema_editor):
+    """Give every user with a registered face one enrollment template"""
+    User = apps.get_model('face', 'User')
+    FaceTemplate = apps.get_model('face', 'FaceTemplate')
+    batch = []
+    rows = User.objects.exclude(face_encoding__isnull=True).values_list('id', 'face_encoding')
+    for user_id, encoding in rows.iterator(chunk_size=BATCH_SIZE):
+        # Quality was not recorded for existing registrations
+        batch.append(FaceTemplate(user_id=user_id, encoding=bytes(encoding), quality=0.0, source='enrollment'))
+        if len(batch) >= BATCH_SIZE:
+            FaceTemplate.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        FaceTemplate.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("face", "0022_attendancejob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FaceTemplate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("encoding", models.BinaryField()),
+                ("quality", models.FloatField(default=0.0)),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[
+                            ("enrollment", "Enrollment"),
+                            ("attendance", "Attendance Capture"),
+                        ],
+                        default="enrollment",
+                        max_length=20,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="face_templates",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(copy_encodings_to_templates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('face', '0024_attendancerecord_group_photo'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attendancerecord',
+            name='verification_method',
+            field=models.CharField(choices=[('face', 'Face Recognition'), ('manual', 'Manual Verification'), ('group_photo', 'Group Photo'), ('kiosk', 'Kiosk Camera')], default='face', max_length=20),
+        ),
+    ]
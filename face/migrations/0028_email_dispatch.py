@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:56
+
+import datetime
+import json
+import os
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+TRACKING_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'email_tracking.json')
+
+
+def import_email_tracking(apps, schema_editor):
+    """Record the last report date of each user in face/email_tracking.json as a dispatch"""
+    User = apps.get_model('face', 'User')
+    EmailDispatch = apps.get_model('face', 'EmailDispatch')
+    try:
+        with open(TRACKING_FILE) as f:
+            tracking_data = json.load(f)
+    except (OSError, ValueError):
+        return
+    dates = {}
+    for user_key, date_str in tracking_data.items():
+        try:
+            dates[int(user_key)] = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            continue
+    existing = set(User.objects.filter(id__in=dates).values_list('id', flat=True))
+    EmailDispatch.objects.bulk_create(
+        [EmailDispatch(user_id=user_id, report_date=report_date, kind='attendance_report') for user_id, report_date in dates.items() if user_id in existing],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('face', '0027_email_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailDispatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report_date', models.DateField()),
+                ('kind', models.CharField(choices=[('attendance_report', 'Attendance Report')], default='attendance_report', max_length=30)),
+                ('batch', models.UUIDField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='email_dispatches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'report_date', 'kind')},
+            },
+        ),
+        migrations.RunPython(import_email_tracking, migrations.RunPython.noop),
+    ]
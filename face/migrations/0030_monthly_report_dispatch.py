@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('face', '0029_report_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emaildispatch',
+            name='kind',
+            field=models.CharField(choices=[('attendance_report', 'Attendance Report'), ('monthly_report', 'Monthly Report')], default='attendance_report', max_length=30),
+        ),
+    ]
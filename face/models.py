@@ -1,5 +1,9 @@
+import base64
+import hashlib
+import uuid
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 class Role(models.Model):
     """Model representing user roles"""
@@ -9,13 +13,36 @@ class Role(models.Model):
     def __str__(self):
         return self.name
 
+class FaceImage(models.Model):
+    """Captured face photo, stored once per distinct content and keyed by its SHA-256"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()  # Raw image bytes as uploaded (JPEG/PNG)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    @classmethod
+    def store(cls, data):
+        """Return the stored image for these bytes, saving it if it is new"""
+        data = bytes(data)
+        image, _ = cls.objects.get_or_create(sha256=hashlib.sha256(data).hexdigest(), defaults={'data': data})
+        return image
+    
+    @property
+    def content_type(self):
+        return 'image/png' if bytes(self.data[:4]) == b'\x89PNG' else 'image/jpeg'
+    
+    def to_base64(self):
+        return base64.b64encode(self.data).decode()
+    
+    def __str__(self):
+        return self.sha256
+
 class User(AbstractUser):
     """Custom user model with roll number as username"""
     roll_number = models.CharField(max_length=20, unique=True)
     email = models.EmailField(unique=True)
     role = models.ForeignKey(Role, on_delete=models.SET_NULL, null=True, blank=True)
-    face_encoding = models.TextField(blank=True, null=True)  # Store face encoding as string
-    face_image = models.TextField(blank=True, null=True)  # Store face image as base64 string
+    face_encoding = models.BinaryField(blank=True, null=True)  # Versioned binary encoding, see utils.pack_face_encoding
+    face_image = models.ForeignKey(FaceImage, on_delete=models.SET_NULL, null=True, blank=True, related_name='users')  # Loaded only when accessed
     is_active = models.BooleanField(default=True)
     
     # New fields for student year, department, and level
@@ -40,6 +67,21 @@ class User(AbstractUser):
     def __str__(self):
         return f"{self.roll_number} - {self.get_full_name()}"
 
+class FaceTemplate(models.Model):
+    """Model for one enrolled face encoding; each user may hold several"""
+    SOURCE_CHOICES = [
+        ('enrollment', 'Enrollment'),
+        ('attendance', 'Attendance Capture'),
+    ]
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='face_templates')
+    encoding = models.BinaryField()  # Versioned binary encoding, see utils.pack_face_encoding
+    quality = models.FloatField(default=0.0)  # 0-1 capture quality at enrollment, see enrollment.capture_quality
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='enrollment')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.user.roll_number} - {self.source} - {self.quality:.2f}"
+
 class LocationConstraint(models.Model):
     """Model for defining location boundaries for attendance"""
     name = models.CharField(max_length=100)
@@ -62,10 +104,22 @@ class AttendanceSession(models.Model):
     target_year = models.CharField(max_length=1, choices=User.YEAR_CHOICES, blank=True, null=True)  # Add target year field
     level = models.CharField(max_length=2, choices=User.LEVEL_CHOICES, blank=True, null=True)  # Add level field
     department = models.CharField(max_length=100, blank=True, null=True)  # Add department field
+    roster_taken_at = models.DateTimeField(null=True, blank=True)  # When roster_entries were frozen, see roster.materialize_roster
     
     def __str__(self):
         return f"{self.name} - {self.start_time.strftime('%Y-%m-%d %H:%M')}"
 
+class SessionRosterEntry(models.Model):
+    """Model for one student expected in a session, frozen when the session starts"""
+    session = models.ForeignKey(AttendanceSession, on_delete=models.CASCADE, related_name='roster_entries')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='roster_entries')
+    
+    class Meta:
+        unique_together = ('session', 'user')
+    
+    def __str__(self):
+        return f"{self.session.name} - {self.user.roll_number}"
+
 class AttendanceRecord(models.Model):
     """Model for individual attendance records"""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -77,7 +131,9 @@ class AttendanceRecord(models.Model):
         max_length=20,
         choices=[
             ('face', 'Face Recognition'),
-            ('manual', 'Manual Verification')
+            ('manual', 'Manual Verification'),
+            ('group_photo', 'Group Photo'),
+            ('kiosk', 'Kiosk Camera')
         ],
         default='face'
     )
@@ -88,6 +144,50 @@ class AttendanceRecord(models.Model):
     def __str__(self):
         return f"{self.user.roll_number} - {self.session.name} - {self.timestamp}"
 
+class AttendanceJob(models.Model):
+    """Model for face attendance submissions processed in the background"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    session = models.ForeignKey(AttendanceSession, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    result = models.JSONField(null=True, blank=True)  # Same payload the synchronous endpoint returns
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+    
+    def __str__(self):
+        return f"{self.user.roll_number} - {self.session.name} - {self.status}"
+
+class ReportJob(models.Model):
+    """Model for an HOD attendance report sent to a department in the background"""
+    STATUS_CHOICES = AttendanceJob.STATUS_CHOICES
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    requested_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='report_jobs')
+    department = models.CharField(max_length=100)
+    report_date = models.DateField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    total_users = models.IntegerField(default=0)
+    processed_users = models.IntegerField(default=0)  # Users whose report was queued, skipped or failed so far
+    result = models.JSONField(null=True, blank=True)  # Same payload the synchronous endpoint returned
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+    
+    def __str__(self):
+        return f"{self.department} - {self.report_date} - {self.status}"
+
 class MonthlyReport(models.Model):
     """Model for storing monthly attendance reports"""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -101,4 +201,48 @@ class MonthlyReport(models.Model):
         unique_together = ('user', 'month')
     
     def __str__(self):
-        return f"{self.user.roll_number} - {self.month.strftime('%B %Y')} - {self.attendance_percentage}%"
\ No newline at end of file
+        return f"{self.user.roll_number} - {self.month.strftime('%B %Y')} - {self.attendance_percentage}%"
+
+class EmailOutbox(models.Model):
+    """Model for an email queued by the views and sent by `manage.py send_outbox`"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # Also the lease of a claimed email, see outbox.claim
+    claim = models.UUIDField(null=True, blank=True)  # Worker batch currently sending the email
+    report_job = models.ForeignKey(ReportJob, on_delete=models.SET_NULL, null=True, blank=True, related_name='emails')
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+    
+    def __str__(self):
+        return f"{self.recipient} - {self.subject} - {self.status}"
+
+
+class EmailDispatch(models.Model):
+    """Model for a report email sent to a user, so each report is sent at most once per user and date"""
+    KIND_CHOICES = [
+        ('attendance_report', 'Attendance Report'),
+        ('monthly_report', 'Monthly Report'),
+    ]
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='email_dispatches')
+    report_date = models.DateField()
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES, default='attendance_report')
+    batch = models.UUIDField(null=True, blank=True)  # The outbox.claim_dispatches call that recorded it
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('user', 'report_date', 'kind')
+    
+    def __str__(self):
+        return f"{self.user.roll_number} - {self.kind} - {self.report_date}"
\ No newline at end of file
@@ -0,0 +1,324 @@
+"""
+Monthly attendance reports.
+
+A user's total for a month counts the sessions they were expected in:
+sessions with a frozen roster that lists them, and for students, sessions
+without one that target their (level, department, year) cohort. Sessions
+they attended outside those are added to the total too, so the percentage
+never exceeds 100.
+
+compute_month() gets every user's totals from a handful of grouped
+aggregates whatever the number of users, and save_month() writes them with
+one bulk upsert. queue_month_emails() queues each user's report email once.
+
+Existing reports are then kept current incrementally (see face/signals.py):
+creating or deleting a session or an attendance record adjusts the affected
+rows with F() updates. A report that does not exist yet is computed on first
+read by monthly_report(). Changes the updates do not follow, such as a
+student moving to another department, are repaired by
+`manage.py reconcile_monthly_reports`.
+"""
+import calendar
+from datetime import date, datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db.models import Case, Count, DecimalField, Exists, F, OuterRef, Q, Value, When
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from .models import User, AttendanceSession, AttendanceRecord, MonthlyReport, SessionRosterEntry
+from .outbox import MONTHLY_REPORT, claim_dispatches, release_dispatches, enqueue_emails
+from .utils import monthly_report_email
+
+
+def month_start(value):
+    """The first day of the month of a date"""
+    return date(value.year, value.month, 1)
+
+
+def next_month(month):
+    return month_start(month + timedelta(days=32))
+
+
+def month_bounds(month):
+    """Aware datetimes of the start of the month and of the next month, in the current time zone"""
+    start = timezone.make_aware(datetime(month.year, month.month, 1))
+    last_day = calendar.monthrange(month.year, month.month)[1]
+    return start, start + timedelta(days=last_day)
+
+
+def parse_months(value):
+    """
+    Parse 'YYYY-MM', a range 'YYYY-MM:YYYY-MM' or a comma separated list of
+    both into a sorted list of month start dates. Raises ValueError.
+    """
+    months = set()
+    for part in value.split(','):
+        first, _, last = part.strip().partition(':')
+        start = datetime.strptime(first.strip(), '%Y-%m').date()
+        end = datetime.strptime(last.strip(), '%Y-%m').date() if last else start
+        if end < start:
+            raise ValueError(f'Range {part.strip()} ends before it starts')
+        month = start
+        while month <= end:
+            months.add(month)
+            month = next_month(month)
+    return sorted(months)
+
+
+def _wildcard(field):
+    """Session fields left empty target every student"""
+    return Q(**{f'session__{field}__isnull': True}) | Q(**{f'session__{field}': ''})
+
+
+def _expected():
+    """
+    Q on AttendanceRecord: the record's user was expected in its session, on
+    the session's frozen roster or in the cohort a session without one targets
+    """
+    on_roster = Exists(SessionRosterEntry.objects.filter(session=OuterRef('session'), user=OuterRef('user')))
+    in_cohort = (
+        Q(user__role__name='student')
+        & (_wildcard('level') | Q(session__level=F('user__level')))
+        & (_wildcard('department') | Q(session__department=F('user__department')))
+        & (_wildcard('target_year') | Q(session__target_year=F('user__year')))
+    )
+    return (Q(session__roster_taken_at__isnull=False) & on_roster) | (Q(session__roster_taken_at__isnull=True) & in_cohort)
+
+
+def compute_month(month, users=None):
+    """
+    {user id: (total_sessions, attended_sessions)} for month, for every user
+    or the given user queryset
+    """
+    start, end = month_bounds(month)
+    sessions = AttendanceSession.objects.filter(start_time__gte=start, start_time__lt=end)
+    roster_entries = SessionRosterEntry.objects.filter(session__in=sessions.filter(roster_taken_at__isnull=False))
+    records = AttendanceRecord.objects.filter(session__in=sessions)
+    if users is not None:
+        roster_entries = roster_entries.filter(user__in=users)
+        records = records.filter(user__in=users)
+    else:
+        users = User.objects.all()
+
+    # Sessions with a frozen roster: one count of roster entries per user
+    on_rosters = dict(roster_entries.values_list('user_id').annotate(count=Count('id')).order_by())
+
+    # Sessions without one: session counts per target, matched to each cohort of students
+    targets = list(sessions.filter(roster_taken_at__isnull=True).values_list('level', 'department', 'target_year').annotate(count=Count('id')).order_by())
+    cohort_totals = {}
+    for level, department, year in users.filter(role__name='student').values_list('level', 'department', 'year').distinct().order_by():
+        cohort_totals[(level, department, year)] = sum(
+            count for target_level, target_department, target_year, count in targets
+            if (not target_level or target_level == level)
+            and (not target_department or target_department == department)
+            and (not target_year or target_year == year)
+        )
+
+    # Attended sessions, and how many of them the user was expected in; the rest add to the total
+    attended = {
+        user_id: (count, count - expected)
+        for user_id, count, expected in records.values_list('user_id').annotate(
+            count=Count('id'), expected=Count('id', filter=_expected())
+        ).values_list('user_id', 'count', 'expected').order_by()
+    }
+
+    totals = {}
+    for user_id, level, department, year, role in users.values_list('id', 'level', 'department', 'year', 'role__name').order_by():
+        count, unexpected = attended.get(user_id, (0, 0))
+        in_cohort = cohort_totals[(level, department, year)] if role == 'student' else 0
+        totals[user_id] = (in_cohort + on_rosters.get(user_id, 0) + unexpected, count)
+    return totals
+
+
+def percentage(total_sessions, attended_sessions):
+    if not total_sessions:
+        return Decimal('0.00')
+    # Halves round up, as ROUND() does in the incremental updates of _adjust()
+    return (Decimal(attended_sessions * 100) / Decimal(total_sessions)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def save_month(month, totals, batch_size=1000, update=True):
+    """
+    Create or update the MonthlyReport of every user in totals in bulk
+    upserts. Without update, existing reports are left as they are.
+    """
+    reports = [
+        MonthlyReport(
+            user_id=user_id, month=month, total_sessions=total, attended_sessions=attended,
+            attendance_percentage=percentage(total, attended),
+        )
+        for user_id, (total, attended) in totals.items()
+    ]
+    if update:
+        MonthlyReport.objects.bulk_create(
+            reports,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['user', 'month'],
+            update_fields=['total_sessions', 'attended_sessions', 'attendance_percentage', 'generated_at'],
+        )
+    else:
+        MonthlyReport.objects.bulk_create(reports, batch_size=batch_size, ignore_conflicts=True)
+    return len(reports)
+
+
+def queue_month_emails(month):
+    """
+    Queue the MonthlyReport email of month to every active user with an
+    email address who has not received it yet. Returns how many were queued.
+    """
+    reports = list(
+        MonthlyReport.objects.filter(month=month, user__is_active=True).exclude(user__email='')
+        .select_related('user').order_by('user_id')
+    )
+    recipient_ids = claim_dispatches([report.user_id for report in reports], month, kind=MONTHLY_REPORT)
+    emails = []
+    for report in reports:
+        if report.user_id in recipient_ids:
+            subject, message = monthly_report_email(report.user, report)
+            emails.append((subject, message, report.user.email))
+    try:
+        return enqueue_emails(emails)
+    except Exception:
+        release_dispatches(recipient_ids, month, kind=MONTHLY_REPORT)
+        raise
+
+
+def session_month(session):
+    """The month a session's reports fall in"""
+    return month_start(timezone.localtime(session.start_time).date())
+
+
+def expected_users(session):
+    """The users expected in a session: its frozen roster, or the students of the cohort it targets"""
+    if session.roster_taken_at:
+        return User.objects.filter(roster_entries__session=session)
+    users = User.objects.filter(role__name='student')
+    if session.level:
+        users = users.filter(level=session.level)
+    if session.department:
+        users = users.filter(department=session.department)
+    if session.target_year:
+        users = users.filter(year=session.target_year)
+    return users
+
+
+def _adjust(reports, attended=0, total=0):
+    """
+    Add to the counts of reports in one UPDATE, recomputing the percentage
+    from the new counts rounded as percentage() rounds it
+    """
+    attended_sessions = F('attended_sessions') + attended
+    total_sessions = F('total_sessions') + total
+    return reports.update(
+        attended_sessions=attended_sessions,
+        total_sessions=total_sessions,
+        attendance_percentage=Case(
+            When(total_sessions__gt=-total, then=Round(attended_sessions * Value(100.0) / total_sessions, 2)),
+            default=Value(Decimal('0.00')),
+            output_field=DecimalField(max_digits=5, decimal_places=2),
+        ),
+    )
+
+
+def session_added(session):
+    """A new session counts towards the total of every user expected in it"""
+    _adjust(MonthlyReport.objects.filter(month=session_month(session), user__in=expected_users(session)), total=1)
+
+
+def session_removed(session):
+    """
+    Take a session that is about to be deleted, with its attendance, out of
+    its month. Call before the delete: the roster and records are gone after.
+    """
+    reports = MonthlyReport.objects.filter(month=session_month(session))
+    attendees = AttendanceRecord.objects.filter(session=session).values('user_id')
+    _adjust(reports.filter(user__in=attendees), attended=-1, total=-1)
+    _adjust(reports.filter(user__in=expected_users(session)).exclude(user__in=attendees), total=-1)
+
+
+def _split_expected(session, user_ids):
+    expected = set(expected_users(session).filter(id__in=user_ids).values_list('id', flat=True))
+    return [user_id for user_id in user_ids if user_id in expected], [user_id for user_id in user_ids if user_id not in expected]
+
+
+def records_added(session, user_ids):
+    """
+    Count new attendance records of users in session. A session a user was
+    not expected in also adds to their total.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    reports = MonthlyReport.objects.filter(month=session_month(session))
+    expected, unexpected = _split_expected(session, user_ids)
+    if expected:
+        _adjust(reports.filter(user_id__in=expected), attended=1)
+    if unexpected:
+        _adjust(reports.filter(user_id__in=unexpected), attended=1, total=1)
+
+
+def records_removed(session, user_ids):
+    """Undo records_added() for deleted attendance records"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    reports = MonthlyReport.objects.filter(month=session_month(session))
+    expected, unexpected = _split_expected(session, user_ids)
+    if expected:
+        _adjust(reports.filter(user_id__in=expected), attended=-1)
+    if unexpected:
+        _adjust(reports.filter(user_id__in=unexpected), attended=-1, total=-1)
+
+
+def roster_changed(session, before, after):
+    """
+    Recompute the reports of users who joined or left a session's expected
+    users, given as id sets, when its roster was frozen or replaced
+    """
+    changed = set(before) ^ set(after)
+    if not changed:
+        return
+    month = session_month(session)
+    existing = MonthlyReport.objects.filter(month=month, user_id__in=changed).values('user_id')
+    totals = compute_month(month, users=User.objects.filter(id__in=existing))
+    if totals:
+        save_month(month, totals)
+
+
+def monthly_report(user, month):
+    """The user's MonthlyReport of month, computed and saved on first read"""
+    report = MonthlyReport.objects.filter(user=user, month=month).first()
+    if report is None:
+        save_month(month, compute_month(month, users=User.objects.filter(id=user.id)), update=False)
+        report = MonthlyReport.objects.get(user=user, month=month)
+    return report
+
+
+def find_drift(month):
+    """
+    Compare the stored reports of month with a full recomputation. Returns
+    [(report, (total_sessions, attended_sessions))] for reports that differ.
+    """
+    totals = compute_month(month)
+    drift = []
+    for report in MonthlyReport.objects.filter(month=month).order_by('user_id'):
+        counts = totals.get(report.user_id, (0, 0))
+        if (report.total_sessions, report.attended_sessions, report.attendance_percentage) != (*counts, percentage(*counts)):
+            drift.append((report, counts))
+    return drift
+
+
+def repair_drift(drift):
+    """
+    Overwrite drifted reports with their recomputed counts. A report changed
+    since find_drift() read it is left alone, to be checked again next time.
+    Returns how many were repaired.
+    """
+    repaired = 0
+    for report, (total, attended) in drift:
+        repaired += MonthlyReport.objects.filter(
+            id=report.id, total_sessions=report.total_sessions, attended_sessions=report.attended_sessions,
+        ).update(total_sessions=total, attended_sessions=attended, attendance_percentage=percentage(total, attended))
+    return repaired
@@ -0,0 +1,155 @@
+"""
+Email outbox: views queue emails as EmailOutbox rows instead of talking to
+the SMTP server, and `manage.py send_outbox` sends them.
+
+The worker claims due emails in batches and sends each batch over one
+connection. A failed email is retried after EMAIL_OUTBOX_RETRY_SECONDS,
+doubling with every attempt, and marked failed after EMAIL_OUTBOX_MAX_ATTEMPTS.
+At most EMAIL_OUTBOX_MAX_PER_MINUTE emails are sent in any minute, counted
+across all workers.
+
+Report emails that go out at most once per user and date are recorded in the
+EmailDispatch ledger before they are queued.
+"""
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import EmailOutbox, EmailDispatch
+
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+ATTENDANCE_REPORT = 'attendance_report'
+MONTHLY_REPORT = 'monthly_report'
+
+# A claimed email is retried after this long if its worker dies before recording the outcome
+CLAIM_SECONDS = 300
+
+
+def enqueue_email(subject, message, recipient):
+    """Queue one email; returns the EmailOutbox row, or None without a recipient"""
+    if not recipient:
+        return None
+    return EmailOutbox.objects.create(recipient=recipient, subject=subject, body=message)
+
+
+def enqueue_emails(emails, report_job=None):
+    """Queue many (subject, message, recipient) emails in one insert; returns how many were queued"""
+    rows = [
+        EmailOutbox(recipient=recipient, subject=subject, body=message, report_job=report_job)
+        for subject, message, recipient in emails if recipient
+    ]
+    EmailOutbox.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def claim_dispatches(user_ids, report_date, kind=ATTENDANCE_REPORT):
+    """
+    Record a dispatch of a report to each user that has not received it yet.
+    Returns the ids of the users recorded by this call: exactly one of several
+    concurrent calls gets each user.
+    """
+    batch = uuid.uuid4()
+    EmailDispatch.objects.bulk_create(
+        [EmailDispatch(user_id=user_id, report_date=report_date, kind=kind, batch=batch) for user_id in user_ids],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    return set(EmailDispatch.objects.filter(batch=batch).values_list('user_id', flat=True))
+
+
+def release_dispatches(user_ids, report_date, kind=ATTENDANCE_REPORT):
+    """Forget dispatches whose email could not be queued, so a later send retries them"""
+    EmailDispatch.objects.filter(user_id__in=user_ids, report_date=report_date, kind=kind).delete()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt of an email that has failed attempts times"""
+    base = _setting('EMAIL_OUTBOX_RETRY_SECONDS', 60)
+    return min(base * 2 ** (attempts - 1), _setting('EMAIL_OUTBOX_MAX_RETRY_SECONDS', 3600))
+
+
+def send_allowance(now=None):
+    """How many more emails may be sent in the current minute"""
+    now = now or timezone.now()
+    sent = EmailOutbox.objects.filter(status=SENT, sent_at__gt=now - timedelta(minutes=1)).count()
+    return max(0, _setting('EMAIL_OUTBOX_MAX_PER_MINUTE', 20) - sent)
+
+
+def claim(limit, now=None):
+    """
+    Claim up to limit due emails for this worker by pushing their
+    next_attempt_at past CLAIM_SECONDS, so other workers skip them
+    """
+    now = now or timezone.now()
+    due = EmailOutbox.objects.filter(status=PENDING, next_attempt_at__lte=now)
+    ids = list(due.order_by('next_attempt_at', 'id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    token = uuid.uuid4()
+    # Only rows still due are taken; another worker may have claimed some in between
+    due.filter(id__in=ids).update(claim=token, next_attempt_at=now + timedelta(seconds=CLAIM_SECONDS))
+    return list(EmailOutbox.objects.filter(claim=token).order_by('next_attempt_at', 'id'))
+
+
+def _record_failure(email, error, now):
+    email.attempts += 1
+    email.last_error = error
+    email.claim = None
+    if email.attempts >= _setting('EMAIL_OUTBOX_MAX_ATTEMPTS', 5):
+        email.status = FAILED
+    else:
+        email.next_attempt_at = now + timedelta(seconds=retry_delay(email.attempts))
+    email.save(update_fields=['attempts', 'last_error', 'claim', 'status', 'next_attempt_at'])
+
+
+def send_batch(connection=None, batch_size=None):
+    """
+    Send one batch of due emails over connection (opened if needed, and left
+    open for the next batch). Returns (sent, failed) counts.
+    """
+    batch_size = batch_size or _setting('EMAIL_OUTBOX_BATCH_SIZE', 50)
+    emails = claim(min(batch_size, send_allowance()))
+    if not emails:
+        return 0, 0
+
+    connection = connection or get_connection()
+    sent = failed = 0
+    try:
+        connection.open()
+    except Exception as e:
+        # The server is unreachable: every claimed email counts as a failed attempt
+        now = timezone.now()
+        with transaction.atomic():
+            for email in emails:
+                _record_failure(email, f'Could not connect: {e}', now)
+        return 0, len(emails)
+
+    for email in emails:
+        message = EmailMessage(email.subject, email.body, settings.DEFAULT_FROM_EMAIL, [email.recipient], connection=connection)
+        try:
+            connection.send_messages([message])
+            EmailOutbox.objects.filter(id=email.id).update(status=SENT, sent_at=timezone.now(), claim=None)
+            sent += 1
+        except Exception as e:
+            print(f"Error sending email to {email.recipient}: {e}")
+            _record_failure(email, str(e), timezone.now())
+            failed += 1
+            # A dropped connection is reopened for the rest of the batch
+            try:
+                connection.close()
+                connection.open()
+            except Exception:
+                pass
+    return sent, failed
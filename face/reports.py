@@ -0,0 +1,215 @@
+"""
+Per-session attendance reports.
+
+The report endpoints list, for each of many sessions, its students and which
+of them attended. load_session_attendance() loads the students and the
+attendance of all the sessions in a fixed number of queries and joins them in
+memory, however many sessions and records there are.
+
+send_department_report() builds the HOD's daily report emails for a whole
+department the same way, as a background ReportJob.
+"""
+from collections import namedtuple
+
+import pytz
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import User, AttendanceSession, AttendanceRecord, ReportJob, SessionRosterEntry
+from .outbox import claim_dispatches, release_dispatches, enqueue_emails
+from .utils import attendance_report_email
+
+
+Student = namedtuple('Student', ['id', 'roll_number', 'first_name', 'last_name'])
+
+STUDENT_FIELDS = Student._fields
+
+
+class SessionAttendance:
+    """One session's students and the attendance timestamps of everyone who attended, by user id"""
+
+    def __init__(self, session, students, attended):
+        self.session = session
+        self.students = students
+        self.attended = attended
+
+    def student_attendance(self):
+        """The report entry of each student"""
+        return [
+            {
+                'student_id': student.id,
+                'student_roll_number': student.roll_number,
+                'student_name': f"{student.first_name} {student.last_name}".strip(),
+                'is_present': student.id in self.attended,
+                'timestamp': self.attended[student.id].isoformat() if student.id in self.attended else None
+            }
+            for student in self.students
+        ]
+
+
+def _target(session):
+    return session.level, session.department, session.target_year
+
+
+def _target_filter(targets):
+    """Q matching the students of any (level, department, year) target; None matches every student"""
+    query = Q()
+    for level, department, year in targets:
+        target = Q()
+        if level:
+            target &= Q(level=level)
+        if department:
+            target &= Q(department=department)
+        if year:
+            target &= Q(year=year)
+        if not target:
+            return None
+        query |= target
+    return query
+
+
+def _matches(attributes, target):
+    """Whether a student's (level, department, year) falls in a session's target"""
+    return all(not wanted or value == wanted for value, wanted in zip(attributes, target))
+
+
+def _session_students(sessions):
+    """
+    The students of each session by session id: its frozen roster, or for
+    sessions without one the students it targets now (see roster.session_students)
+    """
+    by_session = {session.id: [] for session in sessions}
+
+    frozen = [session.id for session in sessions if session.roster_taken_at]
+    if frozen:
+        entries = SessionRosterEntry.objects.filter(session_id__in=frozen).order_by('user_id').values_list(
+            'session_id', *[f'user__{field}' for field in STUDENT_FIELDS]
+        )
+        for session_id, *student in entries:
+            by_session[session_id].append(Student(*student))
+
+    live = [session for session in sessions if not session.roster_taken_at]
+    if live:
+        targets = {_target(session) for session in live}
+        students = User.objects.filter(role__name='student')
+        query = _target_filter(targets)
+        if query is not None:
+            students = students.filter(query)
+        rows = list(students.order_by('id').values_list(*STUDENT_FIELDS, 'level', 'department', 'year'))
+        by_target = {
+            target: [Student(*row[:4]) for row in rows if _matches(row[4:], target)]
+            for target in targets
+        }
+        for session in live:
+            by_session[session.id] = by_target[_target(session)]
+    return by_session
+
+
+def load_session_attendance(sessions, students=None, visible=None):
+    """
+    Load the attendance of sessions, in order. Each session lists its own
+    students unless a queryset of students is given for all of them.
+    A queryset of visible students limits every list to the students in it.
+    """
+    sessions = list(sessions)
+    session_ids = [session.id for session in sessions]
+
+    attended = {session_id: {} for session_id in session_ids}
+    if session_ids:
+        records = AttendanceRecord.objects.filter(session_id__in=session_ids).values_list('session_id', 'user_id', 'timestamp')
+        for session_id, user_id, timestamp in records:
+            attended[session_id][user_id] = timestamp
+
+    if students is not None:
+        shared = [Student(*row) for row in students.order_by('id').values_list(*STUDENT_FIELDS)]
+        students_by_session = {session_id: shared for session_id in session_ids}
+    else:
+        students_by_session = _session_students(sessions)
+
+    if visible is not None:
+        visible_ids = set(visible.values_list('id', flat=True))
+        students_by_session = {
+            session_id: [student for student in session_students if student.id in visible_ids]
+            for session_id, session_students in students_by_session.items()
+        }
+
+    return [SessionAttendance(session, students_by_session[session.id], attended[session.id]) for session in sessions]
+
+
+def latest_sessions(sessions):
+    """The latest session of each name, in order of first appearance"""
+    by_name = {}
+    for session in sessions:
+        # If this is the first session with this name, or if this session is newer
+        if session.name not in by_name or session.start_time > by_name[session.name].start_time:
+            by_name[session.name] = session
+    return list(by_name.values())
+
+
+def send_department_report(job, chunk_size=200):
+    """
+    Queue the attendance report of job.report_date to every active user of
+    job.department who has not received it yet, recording progress on the job
+    every chunk_size users. Returns (queued, skipped, failed) user counts.
+    """
+    sessions = latest_sessions(
+        AttendanceSession.objects.filter(start_time__date=job.report_date, department=job.department).order_by('id')
+    )
+    users = list(User.objects.filter(department=job.department, is_active=True).order_by('id'))
+    ReportJob.objects.filter(id=job.id).update(total_users=len(users), updated_at=timezone.now())
+
+    # Users who already received this report are skipped
+    recipient_ids = claim_dispatches([user.id for user in users], job.report_date)
+    skipped = len(users) - len(recipient_ids)
+
+    # user id -> {session id: attendance timestamp} for every reported session
+    presence = {}
+    records = AttendanceRecord.objects.filter(session__in=sessions).values_list('user_id', 'session_id', 'timestamp')
+    for user_id, session_id, timestamp in records:
+        presence.setdefault(user_id, {})[session_id] = timestamp
+
+    local_zone = pytz.timezone('Asia/Kolkata')
+    session_rows = [(session, session.start_time.strftime("%Y-%m-%d %H:%M")) for session in sessions]
+    queued = failed = 0
+    recipients = [user for user in users if user.id in recipient_ids]
+    for start in range(0, len(recipients), chunk_size):
+        chunk = recipients[start:start + chunk_size]
+        emails, queued_ids, failed_ids = [], [], []
+        for user in chunk:
+            attended = presence.get(user.id, {})
+            attendance_data = [
+                {
+                    'session_name': session.name,
+                    'session_time': session_time,
+                    'attended': session.id in attended,
+                    # Convert timestamp to local timezone (Asia/Kolkata)
+                    'timestamp': attended[session.id].astimezone(local_zone).strftime("%Y-%m-%d %H:%M:%S") if session.id in attended else None
+                }
+                for session, session_time in session_rows
+            ]
+            try:
+                if not user.email:
+                    raise ValueError('no email address')
+                subject, message = attendance_report_email(user, job.report_date, attendance_data)
+            except Exception as e:
+                print(f"Error preparing attendance report for user {user.roll_number}: {e}")
+                failed_ids.append(user.id)
+                continue
+            emails.append((subject, message, user.email))
+            queued_ids.append(user.id)
+
+        try:
+            enqueue_emails(emails, report_job=job)
+        except Exception as e:
+            print(f"Error queueing attendance reports: {e}")
+            failed_ids.extend(queued_ids)
+            queued_ids = []
+        # Let a later report retry the users whose email could not be queued
+        if failed_ids:
+            release_dispatches(failed_ids, job.report_date)
+        queued += len(queued_ids)
+        failed += len(failed_ids)
+        ReportJob.objects.filter(id=job.id).update(processed_users=skipped + queued + failed, updated_at=timezone.now())
+
+    ReportJob.objects.filter(id=job.id).update(processed_users=len(users), updated_at=timezone.now())
+    return queued, skipped, failed
@@ -0,0 +1,220 @@
+"""
+Session rosters: 1:N identification of many faces against the students
+expected in one attendance session.
+
+Every face template of every roster student is held in one matrix, so the
+distances between F captured faces and U students are a single matrix product
+followed by a per-student minimum over that student's templates. assign()
+then pairs faces with students one-to-one.
+
+The students a session expects are frozen into SessionRosterEntry rows when
+it starts, so reports join against the same roster however students' years,
+levels or departments change later. mark_present() writes the attendance of
+many identified students at once.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .cv import np
+from .encoders import active_encoder, match_tolerance
+from .metrics import stage_timer
+from .models import User, AttendanceRecord, FaceTemplate, SessionRosterEntry
+from .monthly import expected_users, records_added, roster_changed
+
+
+def target_students(session):
+    """Students currently matching the session's level, department and year"""
+    students = User.objects.filter(role__name='student')
+    if session.level:
+        students = students.filter(level=session.level)
+    if session.department:
+        students = students.filter(department=session.department)
+    if session.target_year:
+        students = students.filter(year=session.target_year)
+    return students
+
+
+@transaction.atomic
+def materialize_roster(session, replace=False):
+    """
+    Freeze the session's target students into its roster. A session that
+    already has a roster keeps it unless replace is set.
+    """
+    if session.roster_taken_at and not replace:
+        return
+    user_ids = list(target_students(session).values_list('id', flat=True))
+    # Until a roster is frozen, the session expects exactly these students
+    before = set(expected_users(session).values_list('id', flat=True)) if session.roster_taken_at else user_ids
+    SessionRosterEntry.objects.filter(session=session).delete()
+    SessionRosterEntry.objects.bulk_create(
+        [SessionRosterEntry(session=session, user_id=user_id) for user_id in user_ids],
+        batch_size=500,
+    )
+    session.roster_taken_at = timezone.now()
+    session.save(update_fields=['roster_taken_at'])
+    roster_changed(session, before, user_ids)
+
+
+def session_students(session):
+    """
+    The students expected in a session: its frozen roster, or for sessions
+    started before rosters existed, the students it targets now
+    """
+    if session.roster_taken_at:
+        return User.objects.filter(roster_entries__session=session).order_by('id')
+    return target_students(session)
+
+
+def roster_users(session):
+    """Active students with a registered face expected in the session"""
+    return session_students(session).filter(is_active=True).exclude(face_encoding__isnull=True)
+
+
+class Roster:
+    """
+    The face templates of a set of users in the space of one encoder.
+
+    Template rows are grouped by user: the templates of user_ids[i] are rows
+    starts[i] to starts[i + 1].
+    """
+
+    def __init__(self, user_ids, starts, matrix, encoder):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.encoder = encoder
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    @classmethod
+    def for_users(cls, users):
+        """Load the templates of users, falling back to face_encoding for users without any"""
+        encoder = active_encoder()
+        users = list(users.values_list('id', 'face_encoding'))
+        user_ids = [user_id for user_id, _ in users]
+        templates = FaceTemplate.objects.filter(user_id__in=user_ids).order_by('user_id', 'id').values_list('user_id', 'encoding')
+
+        by_user = {}
+        rows = list(templates)
+        for (user_id, _), vector in zip(rows, encoder.deserialize_many([blob for _, blob in rows])):
+            if vector is not None:
+                by_user.setdefault(user_id, []).append(vector)
+        missing = [(user_id, blob) for user_id, blob in users if user_id not in by_user]
+        for (user_id, _), vector in zip(missing, encoder.deserialize_many([blob for _, blob in missing])):
+            if vector is not None:
+                by_user[user_id] = [vector]
+
+        # Keep the dominant dimension; other shapes can never match
+        dimensions = [len(vectors[0]) for vectors in by_user.values()]
+        dimension = max(set(dimensions), key=dimensions.count) if dimensions else 0
+        ids, starts, vectors = [], [], []
+        for user_id in user_ids:
+            user_vectors = [v for v in by_user.get(user_id, []) if len(v) == dimension]
+            if user_vectors:
+                ids.append(user_id)
+                starts.append(len(vectors))
+                vectors.extend(user_vectors)
+        matrix = np.stack(vectors) if vectors else np.empty((0, dimension), dtype=np.float32)
+        return cls(ids, starts, matrix, encoder)
+
+    @classmethod
+    def for_session(cls, session):
+        return cls.for_users(roster_users(session))
+
+    def distances(self, captures):
+        """
+        Normalized distances (F x U) from F raw captures to each roster user's
+        closest template
+        """
+        encodings = self.encoder.encode_many(np.asarray(captures, dtype=np.float32).reshape(len(captures), -1))
+        if not len(self) or encodings.shape[1] != self.dimension:
+            return np.full((len(encodings), len(self)), np.inf, dtype=np.float32)
+        with stage_timer('match.roster'):
+            # ||a - q||^2 = ||a||^2 - 2 a.q + ||q||^2 for every template and capture at once
+            sq_distances = self.sq_norms[None, :] - 2.0 * (encodings @ self.matrix.T) + np.einsum('ij,ij->i', encodings, encodings)[:, None]
+            template_distances = np.sqrt(np.maximum(sq_distances, 0.0)) / np.sqrt(self.dimension)
+            return np.minimum.reduceat(template_distances, self.starts, axis=1)
+
+
+def assign(distances, tolerance=None, ratio=None):
+    """
+    Pair rows (faces) with columns (users) one-to-one, closest pairs first.
+
+    A face is only considered for its users within tolerance (by default the
+    active encoder's 'identify' tolerance), and only if it is distinctive: its best distance is at most ratio times its second best
+    (a face about equally close to two students is left unmatched).
+    Returns a list of (row, column, distance).
+    """
+    if tolerance is None:
+        tolerance = match_tolerance('identify')
+    if ratio is None:
+        ratio = getattr(settings, 'FACE_IDENTIFY_RATIO', 0.8)
+    if not distances.size:
+        return []
+
+    eligible = distances <= tolerance
+    if distances.shape[1] > 1:
+        nearest_two = np.partition(distances, 1, axis=1)[:, :2]
+        eligible &= (nearest_two[:, 0] <= ratio * nearest_two[:, 1])[:, None]
+
+    rows, columns = np.nonzero(eligible)
+    order = np.argsort(distances[rows, columns], kind='stable')
+    used_rows, used_columns, pairs = set(), set(), []
+    for i in order:
+        row, column = int(rows[i]), int(columns[i])
+        if row in used_rows or column in used_columns:
+            continue
+        used_rows.add(row)
+        used_columns.add(column)
+        pairs.append((row, column, float(distances[row, column])))
+    return pairs
+
+
+def _insert_returning(session, user_ids, verification_method):
+    """PostgreSQL: insert in one statement and get back the users whose rows were inserted"""
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {quote(AttendanceRecord._meta.db_table)} "
+            f"({quote('user_id')}, {quote('session_id')}, {quote('timestamp')}, {quote('verification_method')}) "
+            f"SELECT user_id, %s, %s, %s FROM unnest(%s::bigint[]) AS user_id "
+            f"ON CONFLICT ({quote('user_id')}, {quote('session_id')}) DO NOTHING RETURNING {quote('user_id')}",
+            [session.id, timezone.now(), verification_method, user_ids],
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def mark_present(session, user_ids, verification_method):
+    """
+    Write attendance for identified students in one statement, skipping those
+    already marked, including by a concurrent request. Only the records this
+    call inserted are counted in the monthly reports and returned, with
+    their users, so each student is counted and emailed once.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return []
+    records = AttendanceRecord.objects.filter(session=session, user_id__in=user_ids)
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            inserted = _insert_returning(session, user_ids, verification_method)
+        else:
+            # Both reads are in this transaction, which sees no rows committed
+            # by others after the first read: the difference is this insert
+            existing = set(records.values_list('user_id', flat=True))
+            AttendanceRecord.objects.bulk_create(
+                [AttendanceRecord(user_id=user_id, session=session, verification_method=verification_method) for user_id in user_ids if user_id not in existing],
+                ignore_conflicts=True,
+            )
+            inserted = set(records.values_list('user_id', flat=True)) - existing
+        inserted = [user_id for user_id in user_ids if user_id in inserted]
+        records_added(session, inserted)
+    return list(records.filter(user_id__in=inserted).select_related('user'))
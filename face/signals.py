@@ -0,0 +1,63 @@
+"""
+Keep MonthlyReport rows current as sessions and attendance records come and
+go (see face/monthly.py). bulk_create() sends no signals, so bulk attendance
+writes call monthly.records_added() themselves.
+"""
+import threading
+
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import monthly
+from .models import User, AttendanceSession, AttendanceRecord
+
+
+# Sessions and users being deleted on this thread: the deletion of their
+# records is already accounted for, or does not matter
+_deleting = threading.local()
+
+
+def _deleting_ids(kind):
+    if not hasattr(_deleting, kind):
+        setattr(_deleting, kind, set())
+    return getattr(_deleting, kind)
+
+
+@receiver(post_save, sender=AttendanceSession)
+def session_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        monthly.session_added(instance)
+
+
+@receiver(pre_delete, sender=AttendanceSession)
+def session_deleting(sender, instance, **kwargs):
+    monthly.session_removed(instance)
+    _deleting_ids('sessions').add(instance.id)
+
+
+@receiver(post_delete, sender=AttendanceSession)
+def session_deleted(sender, instance, **kwargs):
+    _deleting_ids('sessions').discard(instance.id)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # The user's reports are deleted with them
+    _deleting_ids('users').add(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    _deleting_ids('users').discard(instance.id)
+
+
+@receiver(post_save, sender=AttendanceRecord)
+def record_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        monthly.records_added(instance.session, [instance.user_id])
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def record_deleted(sender, instance, **kwargs):
+    if instance.session_id not in _deleting_ids('sessions') and instance.user_id not in _deleting_ids('users'):
+        monthly.records_removed(instance.session, [instance.user_id])
@@ -1,3 +1,1349 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import JsonResponse
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import User, Role, FaceImage, LocationConstraint, AttendanceSession, AttendanceRecord, AttendanceJob, FaceTemplate, EmailOutbox, EmailDispatch, ReportJob, MonthlyReport
+from .cv import np, cv2
+from .face_index import FaceIndex
+from .jobs import JobQueue, QueueFull, KeyLimitReached
+from .kiosk import FaceTracker
+from .monthly import compute_month, find_drift, month_start, percentage, save_month
+from .outbox import enqueue_email, send_batch, claim_dispatches
+from .reports import send_department_report
+from .roster import mark_present, materialize_roster
+from .utils import (
+    FaceAnalysis, FaceModelPool, FACE_ENCODING_DTYPES, FACE_ENCODING_HEADER, FACE_ENCODING_HEADERS, FACE_ENCODING_MAGIC,
+    FACE_MODEL_ALIGNED_PCA, FACE_MODEL_MEDIAPIPE_MESH, _jpeg_dimensions, decode_face_encoding, decode_image_bytes,
+    pack_face_encoding, unpack_face_encoding,
+)
+from . import async_views, cv, encoders, enrollment, inference, kiosk, utils, views
+
+
+IMPORT_PROBE = """
+import json, os, sys, time
+os.environ['DJANGO_SETTINGS_MODULE'] = 'Frs.settings'
+start = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'loaded': [name for name in ('numpy', 'cv2', 'mediapipe', 'face_recognition') if name in sys.modules],
+}))
+"""
+
+
+class ImportTimeTests(SimpleTestCase):
+    """Starting a worker must not pay for the computer vision stack"""
+
+    # Generous wall-clock budget for django.setup() plus URLconf loading; the
+    # CV stack alone takes longer than this to import
+    budget_seconds = 2.0
+
+    def probe(self):
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_PROBE],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_cv_stack_not_imported(self):
+        self.assertEqual(self.probe()['loaded'], [])
+
+    def test_import_time_budget(self):
+        # Best of three, to ignore a cold filesystem cache
+        seconds = min(self.probe()['seconds'] for _ in range(3))
+        self.assertLess(seconds, self.budget_seconds)
+
+
+class WarmUpTests(SimpleTestCase):
+    """Workers report ready only once their face models are warm"""
+
+    def setUp(self):
+        for name, value in (('_warm_up_started', False), ('_warm_up_error', None), ('_ready', threading.Event()),
+                            ('WARM_UP_RETRY_SECONDS', 0.01)):
+            patcher = mock.patch.object(cv, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_failed_warm_up_is_retried_and_not_ready(self):
+        attempts = []
+        retried = threading.Event()
+        release = threading.Event()
+
+        def warm_up():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise RuntimeError('model file missing')
+            retried.set()
+            release.wait(5)
+            return 0.0
+
+        with mock.patch.object(cv, 'warm_up', warm_up):
+            self.assertTrue(cv.start_warm_up())
+            self.assertTrue(retried.wait(5))
+            self.assertFalse(cv.is_ready())
+            self.assertEqual(cv.warm_up_error(), 'model file missing')
+            response = views.healthz_ready(None)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(json.loads(response.content), {'ready': False, 'error': 'model file missing'})
+
+            release.set()
+            self.assertTrue(cv._ready.wait(5))
+        self.assertEqual(len(attempts), 3)
+        self.assertIsNone(cv.warm_up_error())
+        self.assertEqual(views.healthz_ready(None).status_code, 200)
+
+    def test_job_queue_initializer_failure_is_retried(self):
+        job_queue = JobQueue('warm-up-test', lambda job_id: None, maxsize=1, workers=1)
+        calls = []
+
+        def warm_up():
+            calls.append(threading.current_thread().name)
+            if len(calls) == 2:
+                raise RuntimeError('mesh failed')
+            return 0.0
+
+        with mock.patch.object(cv, 'warm_up', warm_up):
+            cv.start_warm_up(job_queues=[job_queue])
+            self.assertTrue(cv._ready.wait(5))
+        # Background thread, failed worker thread, then the background thread again
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[1], 'warm-up-test-0')
+
+
+class SessionReportTests(TestCase):
+    """Per-session reports load in a fixed number of queries and keep their JSON"""
+
+    @classmethod
+    def setUpTestData(cls):
+        student_role = Role.objects.create(name='student')
+        cls.faculty = User.objects.create_user(
+            username='f1', roll_number='f1', email='f1@example.com', password='pw', role=Role.objects.create(name='faculty'), department='CSE'
+        )
+        cls.admin = User.objects.create_user(username='a1', roll_number='a1', email='a1@example.com', password='pw', role=Role.objects.create(name='admin'))
+        cls.students = [
+            User.objects.create_user(
+                username=f's{i}', roll_number=f's{i}', email=f's{i}@example.com', first_name=f'S{i}', role=student_role,
+                level='UG', department='CSE', year=str(1 + i % 2),
+            )
+            for i in range(6)
+        ]
+        cls.location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+
+    def add_sessions(self, count):
+        now = timezone.now()
+        for i in range(count):
+            session = AttendanceSession.objects.create(
+                name=f'Session {AttendanceSession.objects.count()}', location_constraint=self.location,
+                start_time=now, end_time=now + timedelta(hours=1), faculty=self.faculty,
+                level='UG', department='CSE', target_year=str(1 + i % 2),
+            )
+            # Half the sessions have a frozen roster, the rest are read from the live filter
+            if i % 2:
+                materialize_roster(session)
+            for student in self.students[i % 3::2]:
+                AttendanceRecord.objects.create(user=student, session=session)
+
+    def get(self, user, name, *args):
+        client = Client()
+        client.force_login(user)
+        # Warm the session and user lookups so only the report's queries are counted
+        client.get(reverse('face:api_user_info'))
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse(name, args=args), {'date': timezone.localdate().isoformat()})
+        return response, len(queries)
+
+    def test_query_count_independent_of_sessions(self):
+        for name, user in (
+            ('face:api_get_hod_filtered_sessions', self.admin),
+            ('face:api_get_faculty_daily_attendance', self.faculty),
+            ('face:api_get_faculty_sessions_with_attendance', self.faculty),
+            ('face:api_get_filtered_faculty_daily_attendance', self.faculty),
+        ):
+            self.add_sessions(2)
+            _, small = self.get(user, name)
+            self.add_sessions(6)
+            response, large = self.get(user, name)
+            self.assertTrue(response.json()['success'])
+            self.assertEqual(small, large, name)
+
+    def test_faculty_reports_list_each_session_roster(self):
+        self.add_sessions(4)
+        expected = {
+            session.id: sorted(
+                (record.user_id, True) if record else (student_id, False)
+                for student_id, record in (
+                    (student.id, AttendanceRecord.objects.filter(session=session, user=student).first())
+                    for student in self.students if student.year == session.target_year
+                )
+            )
+            for session in AttendanceSession.objects.all()
+        }
+        for name, query in (
+            ('face:api_get_faculty_sessions_with_attendance', {}),
+            ('face:api_get_filtered_faculty_daily_attendance', {'date': timezone.localdate().isoformat()}),
+        ):
+            client = Client()
+            client.force_login(self.faculty)
+            response = client.get(reverse(name), query).json()
+            sessions = response['sessions'] if 'sessions' in response else [
+                session for group in response['groups'] for session in group['sessions']
+            ]
+            listed = {
+                session['id']: sorted((entry['student_id'], entry['is_present']) for entry in session['student_attendance'])
+                for session in sessions
+            }
+            self.assertEqual(listed, expected, name)
+
+        # A year filter lists only the sessions of that year
+        response = client.get(reverse('face:api_get_faculty_sessions_with_attendance'), {'target_year': '1'}).json()
+        for group in response['groups']:
+            for session in group['sessions']:
+                self.assertEqual(bool(session['student_attendance']), session['target_year'] == '1')
+
+    def test_session_attendance_matches_records(self):
+        self.add_sessions(2)
+        for session in AttendanceSession.objects.all():
+            students = User.objects.filter(role__name='student', level='UG', department='CSE', year=session.target_year).order_by('id')
+            records = {record.user_id: record.timestamp for record in AttendanceRecord.objects.filter(session=session)}
+            expected = {
+                'success': True,
+                'attendance_data': [
+                    {
+                        'student_id': student.id,
+                        'student_roll_number': student.roll_number,
+                        'student_name': student.first_name,
+                        'is_present': student.id in records,
+                        'timestamp': records[student.id].isoformat() if student.id in records else None,
+                    }
+                    for student in students
+                ],
+                'session_name': session.name,
+                'total_students': len(students),
+                'attended_students': len(records),
+            }
+            response, _ = self.get(self.faculty, 'face:api_get_faculty_session_attendance', session.id)
+            self.assertEqual(response.content, JsonResponse(expected).content)
+
+
+class FailingBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+
+@override_settings(EMAIL_OUTBOX_MAX_PER_MINUTE=100, EMAIL_OUTBOX_MAX_ATTEMPTS=2, EMAIL_OUTBOX_RETRY_SECONDS=60)
+class EmailOutboxTests(TestCase):
+    """Emails are queued by the views and sent by the outbox worker"""
+
+    def queue(self, count):
+        for i in range(count):
+            enqueue_email(f'Subject {i}', 'Body', f'user{i}@example.com')
+
+    def test_queued_email_is_sent_in_batch(self):
+        self.queue(3)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(send_batch(), (3, 0))
+        self.assertEqual([message.to for message in mail.outbox], [['user0@example.com'], ['user1@example.com'], ['user2@example.com']])
+        self.assertFalse(EmailOutbox.objects.exclude(status='sent').exists())
+        self.assertEqual(send_batch(), (0, 0))
+
+    def test_failed_email_is_retried_with_backoff(self):
+        self.queue(1)
+        self.assertEqual(send_batch(FailingBackend()), (0, 1))
+        email = EmailOutbox.objects.get()
+        self.assertEqual((email.status, email.attempts, email.claim), ('pending', 1, None))
+        self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # Not due yet
+        self.assertEqual(send_batch(), (0, 0))
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_batch(FailingBackend()), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('failed', 2))
+        self.assertIn('unexpectedly closed', email.last_error)
+
+    @override_settings(EMAIL_OUTBOX_MAX_PER_MINUTE=2)
+    def test_sending_is_throttled_per_minute(self):
+        self.queue(5)
+        self.assertEqual(send_batch(), (2, 0))
+        self.assertEqual(send_batch(), (0, 0))
+        EmailOutbox.objects.filter(status='sent').update(sent_at=timezone.now() - timedelta(minutes=2))
+        self.assertEqual(send_batch(), (2, 0))
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_worker_command_drains_outbox(self):
+        self.queue(4)
+        call_command('send_outbox', '--once', '--batch-size', '3', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 4)
+
+
+class EmailDispatchTests(TestCase):
+    """Each report is queued at most once per user and date"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.hod = User.objects.create_user(
+            username='h1', roll_number='h1', email='h1@example.com', password='pw', role=Role.objects.create(name='hod'), department='CSE'
+        )
+        student_role = Role.objects.create(name='student')
+        cls.students = [
+            User.objects.create_user(
+                username=f's{i}', roll_number=f's{i}', email=f's{i}@example.com', role=student_role, department='CSE'
+            )
+            for i in range(20)
+        ]
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        cls.session = AttendanceSession.objects.create(
+            name='Morning', location_constraint=location, start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), department='CSE',
+        )
+
+    def test_claim_dispatches_in_constant_queries(self):
+        today = timezone.localdate()
+        user_ids = [student.id for student in self.students]
+        with self.assertNumQueries(2):
+            self.assertEqual(claim_dispatches(user_ids[:5], today), set(user_ids[:5]))
+        with self.assertNumQueries(2):
+            self.assertEqual(claim_dispatches(user_ids, today), set(user_ids[5:]))
+        self.assertEqual(claim_dispatches(user_ids, today), set())
+        self.assertEqual(claim_dispatches(user_ids[:1], today - timedelta(days=1)), set(user_ids[:1]))
+
+    def send_report(self, client):
+        report_time = timezone.localtime(self.session.start_time)
+        payload = json.dumps({'date': report_time.strftime('%Y-%m-%d'), 'time': report_time.strftime('%H:%M')})
+        # Run the report job inline instead of on the worker thread
+        with mock.patch.object(views.report_queue, 'submit', lambda key, job_id: views._run_report_job(job_id)):
+            response = client.post(reverse('face:api_send_hod_attendance_report'), payload, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        return client.get(response['Location']).json()
+
+    def test_report_is_queued_once_per_user(self):
+        client = Client()
+        client.force_login(self.hod)
+        for _ in range(2):
+            status = self.send_report(client)
+            self.assertEqual(status['status'], 'succeeded')
+            self.assertEqual((status['total_users'], status['processed_users']), (21, 21))
+            self.assertEqual(status['result']['emails_sent'], 21)
+        self.assertEqual(EmailOutbox.objects.count(), 21)
+        self.assertEqual(EmailDispatch.objects.count(), 21)
+        self.assertEqual(status['delivery'], {})
+
+    def test_report_queries_independent_of_department_size(self):
+        counts = []
+        for extra in (0, 30):
+            for i in range(extra):
+                User.objects.create_user(username=f'x{i}', roll_number=f'x{i}', email=f'x{i}@example.com', department='CSE')
+            EmailDispatch.objects.all().delete()
+            job = ReportJob.objects.create(requested_by=self.hod, department='CSE', report_date=timezone.localdate(self.session.start_time))
+            with CaptureQueriesContext(connection) as queries:
+                queued, skipped, failed = send_department_report(job)
+            self.assertEqual((queued, skipped, failed), (21 + extra, 0, 0))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class MonthlyReportTests(TestCase):
+    """Monthly reports count the sessions each user was expected in"""
+
+    @classmethod
+    def setUpTestData(cls):
+        student_role = Role.objects.create(name='student')
+        cls.cse, cls.ece, cls.moved = [
+            User.objects.create_user(username=roll, roll_number=roll, email=f'{roll}@example.com', role=student_role, department=department)
+            for roll, department in (('c1', 'CSE'), ('e1', 'ECE'), ('c2', 'CSE'))
+        ]
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        start = timezone.make_aware(timezone.datetime(2026, 3, 10, 10))
+
+        def session(name, department, days=0):
+            return AttendanceSession.objects.create(
+                name=name, location_constraint=location, start_time=start + timedelta(days=days),
+                end_time=start + timedelta(days=days, hours=1), department=department,
+            )
+
+        cse, everyone, ece = session('CSE', 'CSE'), session('All', None), session('ECE', 'ECE')
+        session('April', 'CSE', days=30)
+        # c2 was in ECE when this session started, then moved to CSE
+        frozen = session('Frozen', 'ECE')
+        User.objects.filter(id=cls.moved.id).update(department='ECE')
+        materialize_roster(frozen)
+        User.objects.filter(id=cls.moved.id).update(department='CSE')
+
+        for user, attended in ((cls.cse, [cse, everyone]), (cls.ece, [cse, frozen]), (cls.moved, [frozen])):
+            for attended_session in attended:
+                AttendanceRecord.objects.create(user=user, session=attended_session)
+
+    def test_totals_follow_cohorts_and_rosters(self):
+        totals = compute_month(timezone.datetime(2026, 3, 1).date())
+        self.assertEqual(totals[self.cse.id], (2, 2))
+        # ECE, All and Frozen, plus the CSE session attended outside the cohort
+        self.assertEqual(totals[self.ece.id], (4, 2))
+        self.assertEqual(totals[self.moved.id], (3, 1))
+
+    def test_command_upserts_reports(self):
+        call_command('generate_monthly_reports', '--months', '2026-02:2026-03', stdout=io.StringIO())
+        report = MonthlyReport.objects.get(user=self.ece, month='2026-03-01')
+        self.assertEqual(str(report.attendance_percentage), '50.00')
+        self.assertEqual(MonthlyReport.objects.get(user=self.cse, month='2026-02-01').total_sessions, 0)
+
+        AttendanceRecord.objects.filter(user=self.ece).delete()
+        call_command('generate_monthly_reports', '--month', '2026-03', '--email', stdout=io.StringIO())
+        report.refresh_from_db()
+        self.assertEqual((report.attended_sessions, str(report.attendance_percentage)), (0, '0.00'))
+        self.assertEqual(MonthlyReport.objects.count(), 6)
+        self.assertEqual(EmailOutbox.objects.count(), 3)
+        call_command('generate_monthly_reports', '--month', '2026-03', '--email', stdout=io.StringIO())
+        self.assertEqual(EmailOutbox.objects.count(), 3)
+
+    def test_reports_follow_sessions_and_records(self):
+        march = timezone.datetime(2026, 3, 1).date()
+        call_command('generate_monthly_reports', '--month', '2026-03', stdout=io.StringIO())
+        location = LocationConstraint.objects.get()
+        start = timezone.make_aware(timezone.datetime(2026, 3, 20, 10))
+        extra = AttendanceSession.objects.create(
+            name='Extra', location_constraint=location, start_time=start, end_time=start + timedelta(hours=1), department='CSE',
+        )
+        # The insert, then one query to find whether the session expected the user and one update
+        with self.assertNumQueries(3):
+            record = AttendanceRecord.objects.create(user=self.ece, session=extra)
+        AttendanceRecord.objects.create(user=self.cse, session=extra)
+        record.delete()
+        AttendanceSession.objects.get(name='CSE').delete()
+
+        stored = {report.user_id: (report.total_sessions, report.attended_sessions) for report in MonthlyReport.objects.filter(month=march)}
+        self.assertEqual(stored, compute_month(march))
+        self.assertEqual(find_drift(march), [])
+        # Updated percentages are stored rounded, exactly as a full save writes them
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT user_id, total_sessions, attended_sessions, attendance_percentage FROM {MonthlyReport._meta.db_table}'
+            )
+            rows = cursor.fetchall()
+        self.assertIn((self.ece.id, 3, 1, 33.33), rows)
+        for _, total, attended, stored_percentage in rows:
+            self.assertEqual(stored_percentage, float(percentage(total, attended)))
+
+    def test_reconcile_repairs_drift(self):
+        call_command('generate_monthly_reports', '--month', '2026-03', stdout=io.StringIO())
+        # Moving department changes the sessions a student is expected in, which updates do not follow
+        User.objects.filter(id=self.cse.id).update(department='ECE')
+        march = timezone.datetime(2026, 3, 1).date()
+        self.assertEqual([report.user_id for report, _ in find_drift(march)], [self.cse.id])
+
+        call_command('reconcile_monthly_reports', '--month', '2026-03', stdout=io.StringIO())
+        self.assertEqual(find_drift(march), [])
+        # ECE and All, plus the CSE session attended outside the new cohort
+        self.assertEqual(MonthlyReport.objects.get(user=self.cse, month=march).total_sessions, 3)
+
+    def test_endpoint_reads_one_report(self):
+        client = Client()
+        client.force_login(self.ece)
+        url = reverse('face:api_calculate_monthly_attendance')
+        payload = json.dumps({'year': 2026, 'month': 3})
+        self.assertEqual(client.post(url, payload, content_type='application/json').json()['report']['attendance_percentage'], 50.0)
+        self.assertEqual(MonthlyReport.objects.count(), 1)
+        with self.assertNumQueries(3):  # session, user, report
+            response = client.post(url, payload, content_type='application/json')
+        self.assertEqual(response.json()['report']['total_sessions'], 4)
+
+
+class JobQueueTests(SimpleTestCase):
+    """The in-process work queue behind background attendance verification"""
+
+    def test_start_runs_initializer_on_every_worker(self):
+        initialized, ran_on = set(), []
+        lock = threading.Lock()
+
+        def initializer():
+            with lock:
+                initialized.add(threading.current_thread().name)
+
+        job_queue = JobQueue('test_init', lambda job_id: ran_on.append(threading.current_thread().name), maxsize=10, workers=3)
+        self.assertTrue(job_queue.start(initializer=initializer).wait(5))
+        self.assertEqual(initialized, {'test_init-0', 'test_init-1', 'test_init-2'})
+
+        job_queue.submit('key', 'job')
+        self.assertTrue(job_queue.wait('job', 5))
+        self.assertIn(ran_on[0], initialized)
+        # The workers are already running: a second start does not initialize again
+        self.assertTrue(job_queue.start(initializer=initializer).is_set())
+
+    def blocked_queue(self, **kwargs):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        job_queue = JobQueue('test_blocked', lambda job_id: release.wait(5), **kwargs)
+        return job_queue, release
+
+    def test_submit_raises_queue_full_at_capacity(self):
+        job_queue, release = self.blocked_queue(maxsize=1, workers=1)
+        job_queue.submit('a', 'running')
+        # Wait for the worker to take the first job, leaving the queue empty
+        while job_queue._queue.qsize():
+            time.sleep(0.01)
+        job_queue.submit('b', 'queued')
+        with self.assertRaises(QueueFull) as raised:
+            job_queue.submit('c', 'rejected')
+        self.assertNotIsInstance(raised.exception, KeyLimitReached)
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+        release.set()
+        self.assertTrue(job_queue.wait('queued', 5))
+        job_queue.submit('c', 'accepted')
+
+    def test_submit_limits_jobs_per_key(self):
+        job_queue, release = self.blocked_queue(maxsize=10, workers=1, per_key_limit=2)
+        job_queue.submit('session', 1)
+        job_queue.submit('session', 2)
+        with self.assertRaises(KeyLimitReached):
+            job_queue.submit('session', 3)
+        job_queue.submit('other session', 4)
+
+        release.set()
+        self.assertTrue(job_queue.wait(2, 5))
+        job_queue.submit('session', 5)
+
+
+class AttendanceSubmissionTests(TestCase):
+    """Background attendance submissions: dedupe, stale jobs and back-pressure"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.student = User.objects.create_user(
+            username='s1', roll_number='s1', email='s1@example.com', password='pw',
+            role=Role.objects.create(name='student'), face_encoding=b'encoding',
+        )
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        cls.session = AttendanceSession.objects.create(
+            name='Morning', location_constraint=location, start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), is_active=True,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.student)
+
+    def submit(self, submit=lambda *args: None):
+        with mock.patch.object(views.attendance_queue, 'submit', side_effect=submit):
+            return self.client.post(
+                reverse('face:api_submit_attendance'),
+                {'session_id': self.session.id, 'image': io.BytesIO(b'jpeg')},
+            )
+
+    def test_resubmission_gets_pending_job_back(self):
+        first = self.submit()
+        self.assertEqual(first.status_code, 202)
+        second = self.submit()
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(second.json()['job_id'], first.json()['job_id'])
+        self.assertEqual(AttendanceJob.objects.count(), 1)
+
+    def test_stale_job_is_failed_and_replaced(self):
+        stale_id = self.submit().json()['job_id']
+        AttendanceJob.objects.filter(id=stale_id).update(updated_at=timezone.now() - timedelta(minutes=10))
+
+        response = self.submit()
+        self.assertEqual(response.status_code, 202)
+        self.assertNotEqual(response.json()['job_id'], stale_id)
+        status = self.client.get(reverse('face:api_attendance_job_status', args=[stale_id])).json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertFalse(status['result']['success'])
+
+    def test_full_queue_answers_503_with_retry_after(self):
+        response = self.submit(QueueFull('Work queue is full', 7))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(response.json()['retry_after'], 7)
+        self.assertFalse(AttendanceJob.objects.exists())
+
+    def test_busy_session_answers_429_with_retry_after(self):
+        response = self.submit(KeyLimitReached('Too many submissions in progress', 3))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertFalse(AttendanceJob.objects.exists())
+
+    def test_worker_skips_job_failed_as_stale(self):
+        job_id = self.submit().json()['job_id']
+        AttendanceJob.objects.filter(id=job_id).update(updated_at=timezone.now() - timedelta(minutes=10))
+        self.client.get(reverse('face:api_attendance_job_status', args=[job_id]))
+        with mock.patch.object(views, '_verify_attendance') as verify:
+            views._run_attendance_job(job_id, b'jpeg', None, None)
+        verify.assert_not_called()
+        self.assertEqual(AttendanceJob.objects.get(id=job_id).status, 'failed')
+
+
+class FaceTrackerTests(SimpleTestCase):
+    """Kiosk faces keep their track across frames by box overlap"""
+
+    def test_overlapping_boxes_continue_their_tracks(self):
+        tracker = FaceTracker(iou_threshold=0.3, max_missed=2)
+        first = tracker.update([(0, 0, 100, 100), (300, 0, 100, 100)])
+        # Both faces moved a little, and are listed in the other order
+        second = tracker.update([(310, 5, 100, 100), (10, 5, 100, 100)])
+        self.assertEqual([track.id for track in second], [first[1].id, first[0].id])
+        self.assertEqual(second[1].box, (10, 5, 100, 100))
+
+    def test_distant_box_starts_a_new_track(self):
+        tracker = FaceTracker(iou_threshold=0.3)
+        first = tracker.update([(0, 0, 100, 100)])
+        second = tracker.update([(80, 80, 100, 100)])
+        self.assertNotEqual(second[0].id, first[0].id)
+
+    def test_each_track_continues_at_most_one_box(self):
+        tracker = FaceTracker(iou_threshold=0.3)
+        first = tracker.update([(0, 0, 100, 100)])
+        second = tracker.update([(5, 0, 100, 100), (0, 5, 100, 100)])
+        self.assertEqual(sorted(track.id == first[0].id for track in second), [False, True])
+
+    def test_missing_tracks_are_dropped(self):
+        tracker = FaceTracker(max_missed=2)
+        track = tracker.update([(0, 0, 100, 100)])[0]
+        for _ in range(3):
+            tracker.update([])
+        self.assertNotIn(track.id, tracker.tracks)
+        self.assertNotEqual(tracker.update([(0, 0, 100, 100)])[0].id, track.id)
+
+
+class KioskMarkingTests(TestCase):
+    """Kiosks claim students once and write only new attendance"""
+
+    @classmethod
+    def setUpTestData(cls):
+        student_role = Role.objects.create(name='student')
+        cls.students = [
+            User.objects.create_user(username=f's{i}', roll_number=f's{i}', email=f's{i}@example.com', role=student_role)
+            for i in range(3)
+        ]
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        cls.session = AttendanceSession.objects.create(
+            name='Morning', location_constraint=location, start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), is_active=True,
+        )
+
+    def pinned(self):
+        roster = mock.Mock(user_ids=mock.Mock(tolist=lambda: [student.id for student in self.students]))
+        with mock.patch.object(kiosk.Roster, 'for_session', return_value=roster):
+            return kiosk.PinnedRoster(self.session)
+
+    def test_claim_is_exclusive_until_released(self):
+        AttendanceRecord.objects.create(user=self.students[0], session=self.session)
+        pinned = self.pinned()
+        self.assertFalse(pinned.claim(self.students[0].id))
+        self.assertTrue(pinned.claim(self.students[1].id))
+        self.assertFalse(pinned.claim(self.students[1].id))
+        pinned.release([self.students[1].id])
+        self.assertTrue(pinned.claim(self.students[1].id))
+
+    def test_mark_returns_only_new_records(self):
+        pinned = self.pinned()
+        user_ids = [student.id for student in self.students]
+        # Marked by another path after the roster was pinned
+        AttendanceRecord.objects.create(user=self.students[0], session=self.session)
+        records = pinned.mark(user_ids)
+        self.assertEqual(sorted(record.user_id for record in records), user_ids[1:])
+        self.assertEqual(AttendanceRecord.objects.filter(session=self.session).count(), 3)
+
+        self.session.is_active = False
+        self.session.save()
+        self.assertIsNone(pinned.mark(user_ids))
+
+    async def test_failed_flush_releases_and_requeues_students(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        pinned = await sync_to_async(self.pinned)()
+        connection = kiosk.KioskConnection(send, pinned)
+        user_id = self.students[1].id
+        self.assertTrue(pinned.claim(user_id))
+        connection.pending.append(user_id)
+
+        with mock.patch.object(pinned, 'mark', side_effect=RuntimeError('database is locked')):
+            await connection.flush()
+        self.assertEqual(connection.pending, [user_id])
+        self.assertNotIn(user_id, pinned.marked)
+        self.assertEqual(sent, [])
+
+
+class GroupAttendanceTests(TestCase):
+    """Group photos mark each student once and email only the records they wrote"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.faculty = User.objects.create_user(
+            username='f1', roll_number='f1', email='f1@example.com', password='pw', role=Role.objects.create(name='faculty'),
+        )
+        student_role = Role.objects.create(name='student')
+        cls.students = [
+            User.objects.create_user(username=f's{i}', roll_number=f's{i}', email=f's{i}@example.com', role=student_role)
+            for i in range(3)
+        ]
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        cls.session = AttendanceSession.objects.create(
+            name='Morning', location_constraint=location, start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), is_active=True, faculty=cls.faculty,
+        )
+
+    def test_only_new_records_are_counted_and_emailed(self):
+        month = month_start(timezone.localdate())
+        save_month(month, compute_month(month))
+        AttendanceRecord.objects.create(user=self.students[0], session=self.session)
+
+        faces = [FaceAnalysis(face_box=(0, 0, 10, 10), encoding=np.zeros(4)) for _ in self.students]
+        roster = mock.MagicMock(user_ids=np.array([student.id for student in self.students]), encoder=encoders.mesh_encoder)
+        roster.__len__.return_value = len(self.students)
+        self.client.force_login(self.faculty)
+        with mock.patch.object(views, 'decode_image_bytes', return_value=(np.zeros((10, 10, 3), np.uint8), None)), \
+                mock.patch.object(views, 'analyze_faces', return_value=faces), \
+                mock.patch.object(views.Roster, 'for_session', return_value=roster), \
+                mock.patch.object(views, 'assign', return_value=[(i, i, 0.1) for i in range(3)]), \
+                mock.patch.object(views, 'send_attendance_emails') as send_emails:
+            response = self.client.post(
+                reverse('face:api_mark_group_attendance'), {'session_id': self.session.id, 'images': io.BytesIO(b'jpeg')},
+            ).json()
+
+        self.assertTrue(response['success'], response)
+        self.assertEqual([student['roll_number'] for student in response['marked']], ['s1', 's2'])
+        self.assertEqual([student['roll_number'] for student in response['already_marked']], ['s0'])
+        self.assertEqual(sorted(record.user_id for record in send_emails.call_args.args[0]), [s.id for s in self.students[1:]])
+        self.assertEqual(find_drift(month), [])
+
+
+class MarkPresentRaceTests(TransactionTestCase):
+    """Batch marking counts and returns only the rows it inserted, whatever writes race it"""
+
+    def test_concurrent_mark_is_not_counted_twice(self):
+        student_role = Role.objects.create(name='student')
+        students = [
+            User.objects.create_user(username=f's{i}', roll_number=f's{i}', email=f's{i}@example.com', role=student_role)
+            for i in range(3)
+        ]
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        session = AttendanceSession.objects.create(
+            name='Morning', location_constraint=location, start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), is_active=True,
+        )
+        month = month_start(timezone.localdate())
+        save_month(month, compute_month(month))
+
+        # The single-student endpoint marks one of the students between the batch's read and its insert
+        bulk_create = AttendanceRecord.objects.bulk_create
+        def racing_bulk_create(*args, **kwargs):
+            def mark_one():
+                try:
+                    AttendanceRecord.objects.create(user=students[0], session=session)
+                except Exception:
+                    pass
+                finally:
+                    connections.close_all()
+            thread = threading.Thread(target=mark_one)
+            thread.start()
+            thread.join(5)
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(AttendanceRecord.objects, 'bulk_create', racing_bulk_create):
+            records = mark_present(session, [student.id for student in students], 'kiosk')
+
+        inserted = set(AttendanceRecord.objects.filter(session=session, verification_method='kiosk').values_list('user_id', flat=True))
+        self.assertEqual({record.user_id for record in records}, inserted)
+        self.assertEqual(AttendanceRecord.objects.filter(session=session).count(), 3)
+        self.assertEqual(find_drift(month), [])
+
+
+def record_thread(func, calls):
+    """Wrap func to record its name, marked when it was called on the event loop's thread"""
+    def wrapper(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            calls.append(f'{func.__name__} on the event loop')
+        except RuntimeError:
+            calls.append(func.__name__)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class AsyncFaceViewTests(TestCase):
+    """The async face endpoints keep blocking and CPU-bound work off the event loop"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.encoding = random_encodings(1)[0]
+        cls.student = User.objects.create_user(
+            username='s1', roll_number='s1', email='s1@example.com', role=Role.objects.create(name='student'),
+            face_encoding=pack_face_encoding(cls.encoding),
+        )
+        location = LocationConstraint.objects.create(name='Campus', latitude=1, longitude=1)
+        cls.session = AttendanceSession.objects.create(
+            name='Morning', location_constraint=location, start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1), is_active=True,
+        )
+
+    def capture(self):
+        return FaceAnalysis(detections=[object()], is_live=True, encoding=self.encoding.copy())
+
+    async def test_mark_attendance_off_the_event_loop(self):
+        calls = []
+        await self.async_client.aforce_login(self.student)
+        with mock.patch.object(async_views, 'analyze_image', record_thread(lambda image_bytes: self.capture(), calls)), \
+                mock.patch.object(async_views, '_read_face_upload', record_thread(async_views._read_face_upload, calls)), \
+                mock.patch.object(async_views, '_check_attendance_capture', record_thread(async_views._check_attendance_capture, calls)):
+            response = await self.async_client.post(
+                reverse('face:api_mark_attendance_v2'), {'session_id': self.session.id, 'image': io.BytesIO(b'jpeg')},
+            )
+        self.assertTrue(response.json()['success'], response.json())
+        self.assertEqual(calls, ['_read_face_upload', '<lambda>', '_check_attendance_capture'])
+
+    async def test_register_face_off_the_event_loop(self):
+        calls = []
+        await self.async_client.aforce_login(self.student)
+        remove = mock.Mock(__name__='remove')
+        with mock.patch.object(async_views, 'analyze_image', record_thread(lambda image_bytes: self.capture(), calls)), \
+                mock.patch.object(async_views, '_read_face_upload', record_thread(async_views._read_face_upload, calls)), \
+                mock.patch.object(async_views.face_index, 'nearest', return_value=[(self.student.id + 100, 0.1)]), \
+                mock.patch.object(async_views.face_index, 'remove', record_thread(remove, calls)), \
+                mock.patch.object(async_views.face_index, 'update'):
+            response = await self.async_client.post(
+                reverse('face:api_register_face_v2'), {'image': io.BytesIO(b'jpeg')},
+            )
+        self.assertTrue(response.json()['success'], response.json())
+        # A stale index entry of a deleted user is dropped
+        remove.assert_called_once_with(self.student.id + 100)
+        self.assertEqual(calls, ['_read_face_upload', '<lambda>', 'remove'])
+
+
+class FakeGraph:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FaceModelPoolTests(SimpleTestCase):
+    """Per-thread MediaPipe graphs are reused, and released with their thread"""
+
+    def build_on_new_thread(self, pool):
+        graphs = []
+        thread = threading.Thread(target=lambda: graphs.append(pool._get('detector', FakeGraph)))
+        thread.start()
+        thread.join()
+        return graphs[0]
+
+    def test_graph_is_reused_by_its_thread(self):
+        pool = FaceModelPool()
+        graph = pool._get('detector', FakeGraph)
+        self.assertIs(pool._get('detector', FakeGraph), graph)
+
+    def test_graphs_of_finished_threads_are_closed(self):
+        pool = FaceModelPool()
+        finished = [self.build_on_new_thread(pool) for _ in range(5)]
+        # Each new thread closes the graphs of the threads that finished before it
+        self.assertTrue(all(graph.closed for graph in finished[:-1]))
+        self.assertEqual(len(pool._instances), 1)
+
+        own = pool._get('detector', FakeGraph)
+        self.assertTrue(finished[-1].closed)
+        self.assertEqual(list(pool._instances), [threading.current_thread()])
+
+        pool.close()
+        self.assertTrue(own.closed)
+        self.assertEqual(pool._instances, {})
+
+
+def random_encodings(count, seed=0):
+    """Raw mesh-sized encodings far enough apart never to match each other"""
+    return np.random.default_rng(seed).uniform(0, 1, size=(count, 1434)).astype(np.float32)
+
+
+class FaceIndexTests(TestCase):
+    """The in-memory index behind duplicate face registration checks"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.encodings = random_encodings(4)
+        cls.users = [
+            User.objects.create_user(
+                username=f'u{i}', roll_number=f'u{i}', email=f'u{i}@example.com',
+                face_encoding=pack_face_encoding(encoding),
+            )
+            for i, encoding in enumerate(cls.encodings)
+        ]
+        User.objects.create_user(username='none', roll_number='none', email='none@example.com')
+
+    def test_nearest_match_within_tolerance(self):
+        index = FaceIndex(ttl=300)
+        self.assertEqual(len(index), 4)
+        capture = self.encodings[2] + 0.005
+        [(user_id, distance)] = index.nearest(capture)
+        self.assertEqual(user_id, self.users[2].id)
+        self.assertAlmostEqual(distance, 0.005, places=4)
+
+        self.assertEqual(index.nearest(capture, tolerance=0.002), [])
+        self.assertEqual(index.nearest(capture, exclude_user_id=self.users[2].id), [])
+        # The other random faces are far away, so a wide tolerance ranks them all
+        ranked = index.nearest(capture, k=3, tolerance=10)
+        self.assertEqual(ranked[0][0], self.users[2].id)
+        self.assertEqual(len(ranked), 3)
+        self.assertEqual(ranked, sorted(ranked, key=lambda pair: pair[1]))
+
+    def test_update_and_remove(self):
+        index = FaceIndex(ttl=300)
+        new_encoding, replacement = random_encodings(2, seed=1)
+        index.update(999, new_encoding)
+        self.assertEqual(index.nearest(new_encoding), [(999, 0.0)])
+
+        # Replacing an encoding keeps one row for the user
+        index.update(999, replacement)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.nearest(new_encoding), [])
+        self.assertEqual(index.nearest(replacement)[0][0], 999)
+
+        # Removing a row from the middle moves the last one into its place
+        index.remove(self.users[0].id)
+        index.remove(self.users[0].id)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.nearest(self.encodings[0]), [])
+        for user, encoding in zip(self.users[1:], self.encodings[1:]):
+            self.assertEqual(index.nearest(encoding)[0][0], user.id)
+        self.assertEqual(index.nearest(replacement)[0][0], 999)
+
+        # An encoding of None removes the user
+        index.update(999, None)
+        self.assertEqual(index.nearest(replacement), [])
+
+    def test_reloads_from_database_after_ttl(self):
+        index = FaceIndex(ttl=300)
+        self.assertEqual(len(index), 4)
+        [encoding] = random_encodings(1, seed=2)
+        # Registered by another worker: invisible until the TTL runs out
+        other = User.objects.create_user(
+            username='other', roll_number='other', email='other@example.com', face_encoding=pack_face_encoding(encoding),
+        )
+        User.objects.filter(id=self.users[1].id).update(face_encoding=None)
+        self.assertEqual(index.nearest(encoding), [])
+
+        later = time.monotonic() + 301
+        with mock.patch('face.face_index.time.monotonic', return_value=later):
+            self.assertEqual(index.nearest(encoding), [(other.id, 0.0)])
+            self.assertEqual(index.nearest(self.encodings[1]), [])
+            self.assertEqual(len(index), 4)
+
+
+class FaceEncodingFormatTests(SimpleTestCase):
+    """The versioned binary format of stored face encodings"""
+
+    def setUp(self):
+        self.vector = np.random.default_rng(3).normal(0, 0.2, size=64).astype(np.float32)
+
+    def test_float_roundtrips(self):
+        for dtype, places in (('float32', 6), ('float64', 6), ('float16', 3)):
+            with self.subTest(dtype=dtype):
+                blob = pack_face_encoding(self.vector, FACE_MODEL_ALIGNED_PCA, dtype, basis=7)
+                self.assertEqual(len(blob), FACE_ENCODING_HEADER.size + 64 * np.dtype(dtype).itemsize)
+                self.assertEqual(blob[2], 2)
+                self.assertEqual(blob[3], [code for code, known in FACE_ENCODING_DTYPES.items() if np.dtype(known) == np.dtype(dtype)][0])
+                vector, model_id, basis = unpack_face_encoding(blob)
+                self.assertEqual((model_id, basis, vector.dtype), (FACE_MODEL_ALIGNED_PCA, 7, np.dtype(dtype)))
+                np.testing.assert_array_almost_equal(vector, self.vector, decimal=places)
+                # Float vectors are read in place, not copied
+                self.assertFalse(vector.flags.writeable)
+
+    def test_int8_quantization_error_is_bounded(self):
+        blob = pack_face_encoding(self.vector, dtype='int8')
+        self.assertEqual(len(blob), FACE_ENCODING_HEADER.size + 64)
+        vector, model_id, basis = unpack_face_encoding(blob)
+        self.assertEqual((vector.dtype, model_id, basis), (np.float32, FACE_MODEL_MEDIAPIPE_MESH, 0))
+        # Rounding to the nearest of 127 steps per peak is off by at most half a step
+        step = np.max(np.abs(self.vector)) / 127
+        self.assertLessEqual(np.max(np.abs(vector - self.vector)), step / 2 + 1e-6)
+        self.assertAlmostEqual(float(np.max(np.abs(vector))), float(np.max(np.abs(self.vector))), places=6)
+
+        zeros, _, _ = unpack_face_encoding(pack_face_encoding(np.zeros(8), dtype='int8'))
+        np.testing.assert_array_equal(zeros, np.zeros(8))
+
+    def test_reads_version_1_headers(self):
+        header = FACE_ENCODING_HEADERS[1].pack(FACE_ENCODING_MAGIC, 1, 1, FACE_MODEL_MEDIAPIPE_MESH, 64)
+        vector, model_id, basis = unpack_face_encoding(header + self.vector.astype('<f4').tobytes())
+        self.assertEqual((model_id, basis), (FACE_MODEL_MEDIAPIPE_MESH, 0))
+        np.testing.assert_array_equal(vector, self.vector)
+
+    def test_rejects_malformed_blobs(self):
+        blob = pack_face_encoding(self.vector)
+        malformed = {
+            'too short': b'FE',
+            'bad magic': b'XX' + blob[2:],
+            'unknown version': blob[:2] + bytes([9]) + blob[3:],
+            'unknown dtype': blob[:3] + bytes([99]) + blob[4:],
+            'truncated header': blob[:10],
+            'truncated vector': blob[:-4],
+            'trailing bytes': blob + b'\0\0\0\0',
+            'legacy JSON': json.dumps(self.vector.tolist()).encode(),
+        }
+        for name, bad in malformed.items():
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    unpack_face_encoding(bad)
+                self.assertIsNone(decode_face_encoding(bad))
+
+
+def encoded_image(width, height, extension='.jpg'):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:, :width // 2] = (40, 120, 200)
+    return cv2.imencode(extension, image)[1].tobytes()
+
+
+class ImageDecodingTests(SimpleTestCase):
+    """Captured images are decoded no larger than needed"""
+
+    def test_jpeg_dimensions_from_header(self):
+        self.assertEqual(_jpeg_dimensions(encoded_image(320, 240)), (320, 240))
+        self.assertEqual(_jpeg_dimensions(encoded_image(17, 1000)), (17, 1000))
+        # Fill bytes before a marker are skipped
+        jpeg = encoded_image(64, 48)
+        self.assertEqual(_jpeg_dimensions(jpeg[:2] + b'\xff\xff' + jpeg[2:]), (64, 48))
+
+    def test_jpeg_dimensions_rejects_other_input(self):
+        jpeg = encoded_image(320, 240)
+        start_of_frame = jpeg.index(b'\xff\xc0')
+        for name, data in {
+            'png': encoded_image(320, 240, '.png'),
+            'empty': b'',
+            'random': bytes(range(256)),
+            'only the start marker': jpeg[:2],
+            'truncated before the frame header': jpeg[:start_of_frame],
+            'truncated inside the frame header': jpeg[:start_of_frame + 6],
+            'garbage after the start marker': jpeg[:2] + b'\x00' * 20,
+        }.items():
+            with self.subTest(name):
+                self.assertIsNone(_jpeg_dimensions(data))
+
+    def decode(self, width, height, max_dimension=100):
+        flags = []
+        imdecode = utils.cv2.imdecode
+
+        def recording_imdecode(buffer, flag):
+            flags.append(flag)
+            return imdecode(buffer, flag)
+
+        with mock.patch.object(utils.cv2, 'imdecode', recording_imdecode):
+            image, scale = decode_image_bytes(encoded_image(width, height), max_dimension=max_dimension)
+        return image, scale, flags[0]
+
+    def test_reduced_decode_never_undershoots_the_bound(self):
+        for long_edge, flag in (
+            (100, 'IMREAD_COLOR'),
+            (199, 'IMREAD_COLOR'),
+            (200, 'IMREAD_REDUCED_COLOR_2'),
+            (399, 'IMREAD_REDUCED_COLOR_2'),
+            (400, 'IMREAD_REDUCED_COLOR_4'),
+            (799, 'IMREAD_REDUCED_COLOR_4'),
+            (800, 'IMREAD_REDUCED_COLOR_8'),
+            (1600, 'IMREAD_REDUCED_COLOR_8'),
+        ):
+            with self.subTest(long_edge=long_edge):
+                image, scale, used = self.decode(long_edge, long_edge // 2)
+                self.assertEqual(used, getattr(cv2, flag))
+                self.assertEqual(max(image.shape[:2]), 100)
+                self.assertAlmostEqual(scale, 100 / long_edge, places=6)
+
+    def test_small_images_are_decoded_as_is(self):
+        image, scale, used = self.decode(80, 60)
+        self.assertEqual(used, cv2.IMREAD_COLOR)
+        self.assertEqual(image.shape[:2], (60, 80))
+        self.assertEqual(scale, 1.0)
+
+    def test_rejected_input(self):
+        self.assertEqual(decode_image_bytes(b'not an image', max_dimension=100), (None, 1.0))
+        self.assertEqual(decode_image_bytes(encoded_image(320, 240)[:200], max_dimension=100)[0], None)
+        self.assertEqual(decode_image_bytes(encoded_image(320, 240), max_dimension=100, max_bytes=100), (None, 1.0))
+
+    def test_png_uses_full_decode(self):
+        png = encoded_image(300, 200, '.png')
+        image, scale = decode_image_bytes(png, max_dimension=100)
+        self.assertEqual(image.shape[:2], (67, 100))
+        self.assertAlmostEqual(scale, 1 / 3, places=6)
+
+
+class InferenceProtocolTests(SimpleTestCase):
+    """The wire format between web workers and the inference service"""
+
+    def roundtrip(self, message):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        server.sendall(message)
+        return inference.read_response(client)
+
+    def test_response_roundtrip(self):
+        encoding_blob = pack_face_encoding(np.arange(6, dtype=np.float32))
+        analysis = FaceAnalysis(
+            detections=[object()], face_box=(10, 20, 30, 40), blur_variance=12.5, mean_brightness=100.0,
+            color_variance=3.25, high_freq_energy=0.5, is_live=True, liveness_stage='texture', liveness_reason='ok ✓',
+        )
+        status, fields = self.roundtrip(inference.encode_response(inference.STATUS_OK, analysis, encoding_blob))
+        self.assertEqual(status, inference.STATUS_OK)
+        self.assertEqual(fields, {
+            'is_live': True, 'face_count': 1, 'face_box': (10, 20, 30, 40),
+            'blur_variance': 12.5, 'mean_brightness': 100.0, 'color_variance': 3.25, 'high_freq_energy': 0.5,
+            'liveness_stage': 'texture', 'liveness_reason': 'ok ✓', 'encoding_blob': encoding_blob,
+        })
+
+    def test_missing_statistics_and_face_box(self):
+        # Rejected early by the liveness cascade: nothing after the first check was computed
+        analysis = FaceAnalysis(blur_variance=1.0, liveness_stage='blur', liveness_reason='Image too blurry')
+        status, fields = self.roundtrip(inference.encode_response(inference.STATUS_OK, analysis))
+        self.assertEqual(status, inference.STATUS_OK)
+        self.assertIsNone(fields['face_box'])
+        self.assertEqual(fields['blur_variance'], 1.0)
+        self.assertIsNone(fields['mean_brightness'])
+        self.assertIsNone(fields['high_freq_energy'])
+        self.assertIsNone(fields['encoding_blob'])
+        self.assertFalse(fields['is_live'])
+
+        status, fields = self.roundtrip(inference.encode_response(inference.STATUS_INVALID_IMAGE))
+        self.assertEqual(status, inference.STATUS_INVALID_IMAGE)
+        self.assertEqual((fields['face_count'], fields['face_box'], fields['blur_variance']), (0, None, None))
+
+    def test_unknown_op_is_rejected(self):
+        client, server_side = socket.socketpair()
+        self.addCleanup(client.close)
+        server = mock.Mock(process=mock.Mock(return_value=inference.encode_response(inference.STATUS_OK)))
+        server.executor.submit.side_effect = lambda function, *args: mock.Mock(result=lambda: function(*args))
+        handler = threading.Thread(target=inference._InferenceHandler, args=(server_side, None, server))
+        handler.start()
+
+        client.sendall(inference.encode_request(99, b'image') + b'image')
+        self.assertEqual(inference.read_response(client)[0], inference.STATUS_ERROR)
+        server.process.assert_not_called()
+        # The connection is still in step for the next request
+        client.sendall(inference.encode_request(inference.OP_ANALYZE, b'image') + b'image')
+        self.assertEqual(inference.read_response(client)[0], inference.STATUS_OK)
+        server.process.assert_called_once()
+
+        client.shutdown(socket.SHUT_WR)
+        handler.join(5)
+        server_side.close()
+
+
+@override_settings(FACE_MAX_TEMPLATES=3, FACE_ENCODING_MODEL='mesh')
+class FaceTemplateTests(TestCase):
+    """The per-user template cap and which template is evicted at it"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='t1', roll_number='t1', email='t1@example.com')
+        self.encodings = iter(random_encodings(10))
+
+    def enroll(self, quality, source=enrollment.ENROLLMENT, age_minutes=0):
+        template = enrollment.enroll(self.user, next(self.encodings), quality, source=source)
+        if age_minutes:
+            FaceTemplate.objects.filter(id=template.id).update(created_at=timezone.now() - timedelta(minutes=age_minutes))
+        return template
+
+    def remaining(self):
+        return set(FaceTemplate.objects.filter(user=self.user).values_list('id', flat=True))
+
+    def capture(self, quality):
+        """An analysis whose capture_quality() is quality"""
+        return FaceAnalysis(
+            blur_variance=quality * 500.0, mean_brightness=128.0 + (1.0 - quality) * 128.0,
+            encoding=next(self.encodings),
+        )
+
+    def test_enroll_evicts_the_oldest_enrollment_at_the_cap(self):
+        oldest = self.enroll(0.9, age_minutes=30)
+        middle = self.enroll(0.5, age_minutes=20)
+        newest = self.enroll(0.7, age_minutes=10)
+        added = self.enroll(0.6)
+        self.assertEqual(self.remaining(), {middle.id, newest.id, added.id})
+        self.assertNotIn(oldest.id, self.remaining())
+
+    def test_enroll_evicts_attendance_templates_first(self):
+        first = self.enroll(0.1, age_minutes=30)
+        better = self.enroll(0.9, source=enrollment.ATTENDANCE, age_minutes=20)
+        worse = self.enroll(0.6, source=enrollment.ATTENDANCE, age_minutes=10)
+
+        added = self.enroll(0.5)
+        self.assertEqual(self.remaining(), {first.id, better.id, added.id})
+        self.assertNotIn(worse.id, self.remaining())
+        added_again = self.enroll(0.5)
+        self.assertEqual(self.remaining(), {first.id, added.id, added_again.id})
+
+    def test_refresh_replaces_a_weaker_attendance_template(self):
+        kept = [self.enroll(0.2).id, self.enroll(0.2).id]
+        weak = self.enroll(0.6, source=enrollment.ATTENDANCE)
+
+        template = enrollment.refresh_from_attendance(
+            self.user, enrollment.load_templates(self.user), self.capture(0.8), distance=0.01,
+        )
+        self.assertIsNotNone(template)
+        self.assertEqual(template.source, enrollment.ATTENDANCE)
+        self.assertAlmostEqual(template.quality, 0.8)
+        self.assertEqual(self.remaining(), {*kept, template.id})
+        self.assertNotIn(weak.id, self.remaining())
+
+    def test_refresh_keeps_enrollments_at_the_cap(self):
+        kept = {self.enroll(0.1).id for _ in range(3)}
+        refresh = lambda quality, distance=0.01: enrollment.refresh_from_attendance(
+            self.user, enrollment.load_templates(self.user), self.capture(quality), distance,
+        )
+        self.assertIsNone(refresh(0.9))
+        self.assertEqual(self.remaining(), kept)
+
+        # Below the cap it adds, but only confident matches of good captures
+        FaceTemplate.objects.filter(id=min(kept)).delete()
+        self.assertIsNone(refresh(0.9, distance=0.5))
+        self.assertIsNone(refresh(0.3))
+        self.assertEqual(len(self.remaining()), 2)
+        self.assertIsNotNone(refresh(0.9))
+        self.assertEqual(len(self.remaining()), 3)
+
+
+def rotation_matrix(x, y, z):
+    """Rotation by Euler angles in radians"""
+    cx, sx, cy, sy, cz, sz = np.cos(x), np.sin(x), np.cos(y), np.sin(y), np.cos(z), np.sin(z)
+    return (
+        np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+        @ np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+        @ np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    )
+
+
+class AlignedEncoderTests(SimpleTestCase):
+    """Procrustes alignment and projection through a fitted basis"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(0)
+        cls.face = rng.uniform(0, 1, size=(encoders.MESH_LANDMARKS, 3))
+        cls.captures = (cls.face + rng.normal(0, 0.01, size=(40, encoders.MESH_LANDMARKS, 3))).reshape(40, -1)
+        # Every other landmark; stable_landmarks() would need MediaPipe
+        cls.indices = np.arange(0, encoders.MESH_LANDMARKS, 2)
+        cls.basis = encoders.FaceBasis.fit(cls.captures, cls.indices, components=16, basis_id=7)
+
+    def moved(self, raw_encodings, rotation, scale, translation):
+        points = np.asarray(raw_encodings).reshape(len(raw_encodings), encoders.MESH_LANDMARKS, 3)
+        return (scale * points @ rotation.T + translation).reshape(len(raw_encodings), -1)
+
+    def test_projection_shape(self):
+        projected = self.basis.project(self.captures[:5])
+        self.assertEqual(projected.shape, (5, 16))
+        self.assertEqual(projected.dtype, np.float32)
+        self.assertEqual(self.basis.dimension, 16)
+        with self.assertRaises(ValueError):
+            self.basis.project(self.captures[0])
+        with self.assertRaises(ValueError):
+            self.basis.project(self.captures[:5, :-3])
+
+    def test_alignment_removes_position_size_and_rotation(self):
+        reference = self.basis.reference
+        points = self.face[self.indices][None]
+        expected = encoders.align_landmarks(points, reference)
+        moved = points * 3.0 @ rotation_matrix(0.4, -0.3, 1.2).T + np.array([5.0, -2.0, 0.5])
+        np.testing.assert_allclose(encoders.align_landmarks(moved, reference), expected, atol=1e-9)
+        # Aligned to the canonical shape's center
+        np.testing.assert_allclose(expected[0].mean(axis=0), 0, atol=1e-12)
+
+    def test_projection_is_invariant_to_pose(self):
+        captures = self.captures[:8]
+        expected = self.basis.project(captures)
+        for rotation, scale, translation in [
+            (rotation_matrix(0.2, 0.1, -0.3), 1.0, 0.0),
+            (np.eye(3), 0.25, 0.0),
+            (np.eye(3), 1.0, np.array([100.0, -50.0, 3.0])),
+            (rotation_matrix(-0.5, 0.7, 2.5), 4.0, np.array([-1.0, 2.0, 0.1])),
+        ]:
+            projected = self.basis.project(self.moved(captures, rotation, scale, translation))
+            np.testing.assert_allclose(projected, expected, atol=1e-4)
+        # Changes of shape are kept
+        self.assertGreater(np.abs(expected[0] - expected[1]).max(), 1e-3)
+
+    def test_saved_basis_and_encoder_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'basis', 'face_basis.npz')
+            self.basis.save(path)
+            loaded = encoders.FaceBasis.load(path)
+        self.assertEqual(loaded.basis_id, 7)
+        np.testing.assert_array_equal(loaded.project(self.captures[:3]), self.basis.project(self.captures[:3]))
+
+        encoder = encoders.AlignedEncoder(loaded, 'float32')
+        vector, model_id, basis_id = unpack_face_encoding(encoder.serialize(self.captures[0]))
+        self.assertEqual((model_id, basis_id), (FACE_MODEL_ALIGNED_PCA, 7))
+        np.testing.assert_allclose(vector, self.basis.project(self.captures[:1])[0], atol=1e-6)
+        # Stored raw mesh encodings are converted on load
+        np.testing.assert_allclose(
+            encoder.deserialize(pack_face_encoding(self.captures[0].astype(np.float32))), vector, atol=1e-4,
+        )
+
+    def test_match_tolerance_per_encoder(self):
+        aligned = encoders.AlignedEncoder(self.basis, 'float16')
+        for kind in ('verify', 'identify', 'duplicate', 'refresh'):
+            self.assertEqual(encoders.match_tolerance(kind, aligned), encoders.MATCH_TOLERANCES[encoders.ALIGNED_PCA][kind])
+            self.assertEqual(encoders.match_tolerance(kind, encoders.mesh_encoder), encoders.MATCH_TOLERANCES[encoders.MESH][kind])
+        # Aligned distances are far smaller, and so are their tolerances
+        self.assertLess(encoders.match_tolerance('verify', aligned), encoders.match_tolerance('verify', encoders.mesh_encoder))
+
+        tolerances = {encoders.MESH: {'verify': 0.3}, encoders.ALIGNED_PCA: {'verify': 0.01}}
+        with self.settings(FACE_MATCH_TOLERANCES=tolerances, FACE_ENCODING_MODEL=encoders.MESH):
+            self.assertEqual(encoders.match_tolerance('verify'), 0.3)
+            self.assertEqual(encoders.match_tolerance('verify', aligned), 0.01)
+
+
+class RegisteredFacesTests(TestCase):
+    """Registered face listings leave the photos to api_get_face_image"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(
+            username='a1', roll_number='a1', email='a1@example.com', password='pw', role=Role.objects.create(name='admin'),
+        )
+        cls.image = FaceImage.store(encoded_image(32, 32))
+        cls.student = User.objects.create_user(
+            username='s1', roll_number='s1', email='s1@example.com', password='pw',
+            role=Role.objects.create(name='student'), face_encoding=b'encoding', face_image=cls.image,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def faces(self, query=''):
+        response = self.client.get(reverse('face:api_get_registered_faces') + query)
+        self.assertTrue(response.json()['success'])
+        return {face['user_id']: face for face in response.json()['faces']}
+
+    def test_images_are_left_out_by_default(self):
+        self.assertIsNone(self.faces()[self.student.id]['face_image'])
+        self.assertIsNone(self.faces('?include_images=0')[self.student.id]['face_image'])
+        self.assertEqual(self.faces('?include_images=1')[self.student.id]['face_image'], self.image.to_base64())
+
+    def test_face_image_is_fetched_on_demand(self):
+        response = self.client.get(reverse('face:api_get_face_image', args=[self.student.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response.content, bytes(self.image.data))
+        self.assertEqual(response['ETag'], f'"{self.image.sha256}"')
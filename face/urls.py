@@ -1,5 +1,5 @@
-from django.urls import path
-from . import views
+from django.urls import path, re_path
+from . import views, async_views
 
 app_name = 'face'
 
@@ -44,9 +44,18 @@ urlpatterns = [
     
     # API endpoints for Flutter app
     path('api/login/', views.api_login, name='api_login'),
-    path('api/register-face/', views.api_register_face, name='api_register_face'),
-    path('api/mark-attendance/', views.api_mark_attendance, name='api_mark_attendance'),
-    path('api/user-info/', views.api_user_info, name='api_user_info'),
+    path('api/register-face/', async_views.api_register_face, name='api_register_face'),
+    path('api/mark-attendance/', async_views.api_mark_attendance, name='api_mark_attendance'),
+    path('api/user-info/', async_views.api_user_info, name='api_user_info'),
+    path('api/metrics/', views.api_metrics, name='api_metrics'),
+    re_path(r'^healthz/ready/?$', views.healthz_ready, name='healthz_ready'),
+    
+    # Binary (multipart or raw image/jpeg) upload variants of the face endpoints
+    path('api/v2/register-face/', async_views.api_register_face_v2, name='api_register_face_v2'),
+    path('api/v2/mark-attendance/', async_views.api_mark_attendance_v2, name='api_mark_attendance_v2'),
+    path('api/v2/attendance/submit/', views.api_submit_attendance, name='api_submit_attendance'),
+    path('api/v2/attendance/jobs/<uuid:job_id>/', views.api_attendance_job_status, name='api_attendance_job_status'),
+    path('api/v2/attendance/group/', views.api_mark_group_attendance, name='api_mark_group_attendance'),
     
     # New API endpoints for enhanced features
     path('api/create-session/', views.api_create_session, name='api_create_session'),
@@ -57,7 +66,7 @@ urlpatterns = [
     path('api/delete-location-constraint/<int:location_id>/', views.api_delete_location_constraint, name='api_delete_location_constraint'),
     path('api/get-active-session/', views.api_get_active_session, name='api_get_active_session'),
     path('api/get-all-sessions/', views.api_get_all_sessions, name='api_get_all_sessions'),
-    path('api/get-active-sessions/', views.api_get_active_sessions, name='api_get_active_sessions'),
+    path('api/get-active-sessions/', async_views.api_get_active_sessions, name='api_get_active_sessions'),
     path('api/get-all-attendance-records/', views.api_get_all_attendance_records, name='api_get_all_attendance_records'),
     path('api/get-user-attendance/', views.api_get_user_attendance, name='api_get_user_attendance'),
     path('api/get-admin-dashboard-stats/', views.api_get_admin_dashboard_stats, name='api_get_admin_dashboard_stats'),
@@ -72,6 +81,7 @@ urlpatterns = [
     path('api/delete-user/<int:user_id>/', views.api_delete_user, name='api_delete_user'),
     path('api/get-registered-faces/', views.api_get_registered_faces, name='api_get_registered_faces'),
     path('api/delete-user-face/<int:user_id>/', views.api_delete_user_face, name='api_delete_user_face'),
+    path('api/face-image/<int:user_id>/', views.api_get_face_image, name='api_get_face_image'),
     path('api/calculate-monthly-attendance/', views.api_calculate_monthly_attendance, name='api_calculate_monthly_attendance'),
     path('api/get-user-monthly-reports/', views.api_get_user_monthly_reports, name='api_get_user_monthly_reports'),
     path('api/change-password/', views.api_change_password, name='api_change_password'),
@@ -82,6 +92,7 @@ urlpatterns = [
     path('api/get-faculty-attendance-records/', views.api_get_faculty_attendance_records, name='api_get_faculty_attendance_records'),
     path('api/hod/filtered-registered-faces/', views.api_get_hod_filtered_registered_faces, name='api_get_hod_filtered_registered_faces'),
     path('api/hod/send-attendance-report/', views.api_send_hod_attendance_report, name='api_send_hod_attendance_report'),
+    path('api/hod/report-jobs/<uuid:job_id>/', views.api_report_job_status, name='api_report_job_status'),
 
     # New API endpoints for Faculty functionality
     path('api/get-faculty-sessions/', views.api_get_faculty_sessions, name='api_get_faculty_sessions'),
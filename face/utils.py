@@ -1,109 +1,556 @@
 import base64
-import numpy as np
-from django.core.mail import send_mail
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
-import cv2
-import os
+import struct
+import atexit
+import threading
+import time
 from datetime import datetime, date
-import json
-import mediapipe as mp
+from dataclasses import dataclass, field
+from .cv import np, cv2, mp
+from .metrics import stage_timer
+from .outbox import enqueue_email
+from .liveness import liveness_cascade, LivenessFrame, FRAME, FACE, LANDMARKS
 
-def encode_face(image):
+
+class FaceModelPool:
     """
-    Encode a face image into a feature vector using MediaPipe
+    Process-wide pool of initialized MediaPipe face detection and face mesh graphs.
+
+    MediaPipe solution objects are not safe to share between threads, so each
+    worker thread lazily builds its own pair on first use and keeps reusing it
+    for every later request. Instances are tracked by the thread that built
+    them: those of threads that have exited are closed when the next thread
+    builds its own, and close() releases the rest when the worker shuts down.
+    """
+
+    def __init__(self, model_selection=1, min_detection_confidence=0.5):
+        self.model_selection = model_selection
+        self.min_detection_confidence = min_detection_confidence
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances = {}  # thread -> instances it built
+        self._generation = 0
+
+    def _get(self, name, factory):
+        cached = getattr(self._local, name, None)
+        if cached is not None and cached[0] == self._generation:
+            return cached[1]
+        instance = factory()
+        with self._lock:
+            # Thread-per-request servers keep starting threads; drop the graphs of finished ones
+            dead = [thread for thread in self._instances if not thread.is_alive()]
+            orphans = [orphan for thread in dead for orphan in self._instances.pop(thread)]
+            self._instances.setdefault(threading.current_thread(), []).append(instance)
+            setattr(self._local, name, (self._generation, instance))
+        self._close_all(orphans)
+        return instance
+
+    @staticmethod
+    def _close_all(instances):
+        for instance in instances:
+            try:
+                instance.close()
+            except Exception as e:
+                print(f"Error closing face model: {e}")
+
+    def detector(self):
+        """Return this thread's FaceDetection graph, building it on first use"""
+        return self._get('detector', lambda: mp.solutions.face_detection.FaceDetection(
+            model_selection=self.model_selection,
+            min_detection_confidence=self.min_detection_confidence,
+        ))
+
+    def mesh(self):
+        """Return this thread's FaceMesh graph, building it on first use"""
+        return self._get('mesh', lambda: mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=True,
+            max_num_faces=1,
+            refine_landmarks=True,
+            min_detection_confidence=self.min_detection_confidence,
+        ))
+
+    def warm_up(self):
+        """Build the calling thread's graphs ahead of the first request"""
+        self.detector()
+        self.mesh()
+
+    def close(self):
+        """
+        Release every graph built by any thread.
+
+        Threads that use the pool afterwards transparently get fresh instances.
+        Only call this when no request is being processed (e.g. worker exit).
+        """
+        with self._lock:
+            instances = [instance for built in self._instances.values() for instance in built]
+            self._instances = {}
+            self._generation += 1
+        self._close_all(instances)
+
+
+face_model_pool = FaceModelPool()
+atexit.register(face_model_pool.close)
+
+
+@dataclass
+class FaceAnalysis:
     """
+    Everything derived from a single pass over one captured frame.
+
+    Produced by analyze_face() so liveness checking and encoding share one
+    colour conversion, one face detection and one face mesh run. When the
+    liveness cascade rejects a frame, liveness_stage names the rejecting check
+    and the stages after it (possibly detection and mesh) are skipped.
+    """
+    detections: list = field(default_factory=list)
+    landmarks: object = None
+    face_box: tuple = None
+    face_crop: object = None
+    blur_variance: float = None
+    mean_brightness: float = None
+    color_variance: float = None
+    high_freq_energy: float = None
+    is_live: bool = False
+    liveness_reason: str = ''
+    liveness_stage: str = ''
+    encoding: object = None
+
+    @property
+    def face_count(self):
+        return len(self.detections)
+
+
+def _face_box(detection, width, height):
+    """Convert a MediaPipe relative bounding box into clipped pixel coordinates"""
+    bbox = detection.location_data.relative_bounding_box
+    x = max(0, int(bbox.xmin * width))
+    y = max(0, int(bbox.ymin * height))
+    box_width = min(width - x, int(bbox.width * width))
+    box_height = min(height - y, int(bbox.height * height))
+    return x, y, box_width, box_height
+
+
+def _face_landmarks(rgb_image, face_box):
+    """Run the pooled face mesh on one face box of an RGB frame; None if no mesh was found"""
+    x, y, width, height = face_box
+    if width <= 0 or height <= 0:
+        return None
+    rgb_crop = np.ascontiguousarray(rgb_image[y:y+height, x:x+width])
+    with stage_timer('face.mesh'):
+        landmarks_results = face_model_pool.mesh().process(rgb_crop)
+    if landmarks_results.multi_face_landmarks:
+        return landmarks_results.multi_face_landmarks[0]
+    return None
+
+
+def _landmark_encoding(landmarks):
+    """Flatten the landmark coordinates to create a feature vector"""
+    with stage_timer('face.encode'):
+        return np.array(
+            [c for landmark in landmarks.landmark for c in (landmark.x, landmark.y, landmark.z)],
+            dtype=np.float32,
+        )
+
+
+def analyze_face(image, check_liveness=True):
+    """
+    Run detection, landmark extraction, liveness and encoding over one frame
+    in a single pass.
+
+    The frame is converted to RGB and grayscale once, the pooled detector runs
+    once on the full frame and the pooled face mesh runs once on the face crop.
+    With check_liveness, the liveness cascade runs tier by tier around those
+    steps and the analysis stops at the first rejecting check; without it only
+    the encoding is produced. Always returns a FaceAnalysis.
+    """
+    analysis = FaceAnalysis()
+
+    def reject(reason):
+        analysis.is_live = False
+        analysis.liveness_reason = reason
+        print(reason)
+        return analysis
+
     try:
-        # Initialize MediaPipe Face Detection
-        mp_face_detection = mp.solutions.face_detection
-        mp_face_mesh = mp.solutions.face_mesh
-        
-        # Convert image to RGB if it's in BGR format (OpenCV uses BGR)
-        if len(image.shape) == 3 and image.shape[2] == 3:
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        else:
-            # If grayscale, convert to RGB
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-        
-        # Detect faces using MediaPipe
-        with mp_face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5) as face_detection:
-            results = face_detection.process(rgb_image)
-        
-        # If no faces detected, return None
-        if not results.detections:
-            print("No faces detected in the image")
-            return None
-        
-        # Use the first detected face
-        detection = results.detections[0]
-        bbox = detection.location_data.relative_bounding_box
-        
-        # Get image dimensions
-        h, w, _ = image.shape
-        
-        # Convert normalized coordinates to pixel values
-        x = int(bbox.xmin * w)
-        y = int(bbox.ymin * h)
-        width = int(bbox.width * w)
-        height = int(bbox.height * h)
-        
-        # Ensure coordinates are within image bounds
-        x = max(0, x)
-        y = max(0, y)
-        width = min(w - x, width)
-        height = min(h - y, height)
-        
-        # Extract face region
-        face_image = image[y:y+height, x:x+width]
-        
-        # Generate a simple encoding based on facial landmarks
-        # Initialize MediaPipe Face Mesh for landmark detection
-        with mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True,
-                                  min_detection_confidence=0.5) as face_mesh:
-            landmarks_results = face_mesh.process(cv2.cvtColor(face_image, cv2.COLOR_BGR2RGB))
-        
-        if not landmarks_results.multi_face_landmarks:
-            print("Could not extract face landmarks")
-            return None
-        
-        # Create a simple encoding from landmarks
-        # We'll flatten the landmark coordinates to create a feature vector
-        face_landmarks = landmarks_results.multi_face_landmarks[0]
-        encoding = []
-        for landmark in face_landmarks.landmark:
-            encoding.extend([landmark.x, landmark.y, landmark.z])
-        
-        # Convert to numpy array
-        encoding = np.array(encoding, dtype=np.float32)
-        print(f"Face encoding shape: {encoding.shape}")
-        return encoding
-        
+        if image is None or image.size == 0:
+            analysis.liveness_stage = 'input'
+            return reject("Invalid image")
+
+        with stage_timer('face.convert'):
+            if len(image.shape) == 3 and image.shape[2] == 3:
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            else:
+                gray = image if len(image.shape) == 2 else image[:, :, 0]
+        frame = LivenessFrame(image, gray)
+
+        # Cheap whole-frame checks reject dark, flat or blurry frames before any inference
+        if check_liveness:
+            reason = liveness_cascade.run(FRAME, analysis, frame)
+            if reason:
+                return reject(reason)
+
+        with stage_timer('face.convert'):
+            if frame.is_color:
+                rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            else:
+                rgb_image = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+
+        with stage_timer('face.detection'):
+            results = face_model_pool.detector().process(rgb_image)
+        analysis.detections = list(results.detections or [])
+
+        if analysis.detections:
+            # Use the first detected face
+            h, w = gray.shape[:2]
+            analysis.face_box = _face_box(analysis.detections[0], w, h)
+            x, y, width, height = analysis.face_box
+            analysis.face_crop = image[y:y+height, x:x+width]
+
+        if check_liveness:
+            reason = liveness_cascade.run(FACE, analysis, frame)
+            if reason:
+                return reject(reason)
+
+        if analysis.face_box:
+            analysis.landmarks = _face_landmarks(rgb_image, analysis.face_box)
+
+        if check_liveness:
+            reason = liveness_cascade.run(LANDMARKS, analysis, frame)
+            if reason:
+                return reject(reason)
+
+        if analysis.landmarks is not None:
+            analysis.encoding = _landmark_encoding(analysis.landmarks)
+
+        if check_liveness:
+            analysis.is_live = True
+            analysis.liveness_reason = "Liveness check passed"
+            print(analysis.liveness_reason)
+        return analysis
+
     except Exception as e:
-        print(f"Error encoding face: {e}")
+        print(f"Error analyzing face: {e}")
         import traceback
         traceback.print_exc()
+        analysis.liveness_stage = 'error'
+        return reject(f"Error analyzing face: {e}")
+
+
+def _box_iou(a, b):
+    """Intersection over union of two (x, y, width, height) boxes"""
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, x1 - x0) * max(0, y1 - y0)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def _refine_detection(rgb_image, face_box, context=2.5):
+    """
+    Detect a face again in a square window around a coarse face box.
+
+    Detection on a wide frame sees each face at low resolution, so its boxes
+    are loose; re-detecting in a window where the face is as large as in a
+    selfie gives boxes, and so mesh crops, like analyze_face() produces.
+    Returns (detection, face_box) in frame coordinates, or None.
+    """
+    h, w = rgb_image.shape[:2]
+    x, y, width, height = face_box
+    side = int(max(width, height) * context)
+    left = min(max(0, int(x + width / 2 - side / 2)), max(0, w - side))
+    top = min(max(0, int(y + height / 2 - side / 2)), max(0, h - side))
+    window = np.ascontiguousarray(rgb_image[top:top+side, left:left+side])
+    with stage_timer('face.detection'):
+        results = face_model_pool.detector().process(window)
+    if not results.detections:
+        return None
+    window_h, window_w = window.shape[:2]
+    # The face nearest the window centre is the one the coarse box found
+    def offset(detection):
+        bx, by, bw, bh = _face_box(detection, window_w, window_h)
+        return abs(bx + bw / 2 - window_w / 2) + abs(by + bh / 2 - window_h / 2)
+    detection = min(results.detections, key=offset)
+    bx, by, bw, bh = _face_box(detection, window_w, window_h)
+    return detection, (bx + left, by + top, bw, bh)
+
+
+def _to_rgb(image):
+    with stage_timer('face.convert'):
+        if len(image.shape) == 3 and image.shape[2] == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        gray = image if len(image.shape) == 2 else image[:, :, 0]
+        return cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+
+
+def detect_faces(rgb_image):
+    """
+    Coarse detection of every face in an RGB frame in one detector pass.
+    Returns (score, face_box) pairs, most confident first.
+    """
+    with stage_timer('face.detection'):
+        results = face_model_pool.detector().process(rgb_image)
+    h, w = rgb_image.shape[:2]
+    faces = [(detection.score[0], _face_box(detection, w, h)) for detection in results.detections or []]
+    return sorted(faces, key=lambda face: face[0], reverse=True)
+
+
+def encode_detected_face(image, rgb_image, face_box):
+    """
+    Refine a coarse face box from detect_faces() and mesh and encode the face.
+    Returns a FaceAnalysis (without an encoding if no mesh was found), or
+    None if re-detection finds no face there.
+    """
+    refined = _refine_detection(rgb_image, face_box)
+    if refined is None:
+        return None
+    detection, face_box = refined
+    if face_box[2] <= 0 or face_box[3] <= 0:
+        return None
+    x, y, width, height = face_box
+    face = FaceAnalysis(detections=[detection], face_box=face_box, face_crop=image[y:y+height, x:x+width])
+    face.landmarks = _face_landmarks(rgb_image, face_box)
+    if face.landmarks is not None:
+        face.encoding = _landmark_encoding(face.landmarks)
+    return face
+
+
+def analyze_faces(image, max_faces=None):
+    """
+    Detect every face in a frame (e.g. a classroom photo) and encode each one.
+
+    Detection runs once on the whole frame, then each face is re-detected in a
+    window around it and the face mesh runs on the refined box, cropped the
+    way analyze_face() crops a single face so the encodings are comparable
+    with enrolled ones. No liveness checks are made. Returns one FaceAnalysis
+    per face (at most max_faces, the most confident), largest first; faces
+    without a mesh have no encoding.
+    """
+    if image is None or image.size == 0:
+        return []
+
+    rgb_image = _to_rgb(image)
+    faces = []
+    for _, face_box in detect_faces(rgb_image)[:max_faces]:
+        face = encode_detected_face(image, rgb_image, face_box)
+        # Refined boxes of one face found twice by the coarse pass overlap; keep the most confident
+        if face is None or any(_box_iou(face.face_box, other.face_box) > 0.5 for other in faces):
+            continue
+        faces.append(face)
+    faces.sort(key=lambda face: face.face_box[2] * face.face_box[3], reverse=True)
+    return faces
+
+
+_inference_client = None
+_inference_retry_at = 0.0
+
+
+def _remote_analysis(image_bytes, check_liveness):
+    """
+    Analyze an image in the inference service configured by FACE_INFERENCE_SOCKET.
+
+    Returns a FaceAnalysis, None for an image the service could not decode, or
+    raises InferenceError if the service is unavailable. Detections and
+    landmarks are not transferred: detections holds one placeholder per face.
+    """
+    global _inference_client
+    from .inference import InferenceClient, InferenceError, OP_ANALYZE, OP_ENCODE, STATUS_OK, STATUS_INVALID_IMAGE
+
+    socket_path = getattr(settings, 'FACE_INFERENCE_SOCKET', None)
+    if _inference_client is None or _inference_client.socket_path != socket_path:
+        _inference_client = InferenceClient(socket_path, timeout=getattr(settings, 'FACE_INFERENCE_TIMEOUT', 10.0))
+
+    with stage_timer('inference.remote'):
+        status, fields = _inference_client.request(OP_ANALYZE if check_liveness else OP_ENCODE, image_bytes)
+    if status == STATUS_INVALID_IMAGE:
         return None
+    if status != STATUS_OK:
+        raise InferenceError(f"Inference service returned status {status}")
+
+    encoding_blob = fields.pop('encoding_blob')
+    face_count = fields.pop('face_count')
+    analysis = FaceAnalysis(detections=[None] * face_count, **fields)
+    if encoding_blob:
+        analysis.encoding, _, _ = unpack_face_encoding(encoding_blob)
+    return analysis
+
+
+def analyze_image(image_bytes, check_liveness=True):
+    """
+    Decode uploaded image bytes and run analyze_face on them.
+
+    When FACE_INFERENCE_SOCKET is set the work is sent to the local inference
+    service; if it cannot be reached the image is analyzed in-process and the
+    service is not retried for FACE_INFERENCE_RETRY_SECONDS.
+    Returns a FaceAnalysis, or None if the bytes are not a decodable image.
+    """
+    global _inference_retry_at
+
+    if getattr(settings, 'FACE_INFERENCE_SOCKET', None) and time.monotonic() >= _inference_retry_at:
+        from .inference import InferenceError
+        try:
+            return _remote_analysis(image_bytes, check_liveness)
+        except InferenceError as e:
+            print(f"Inference service unavailable, analyzing in-process: {e}")
+            _inference_retry_at = time.monotonic() + getattr(settings, 'FACE_INFERENCE_RETRY_SECONDS', 30)
+
+    image, _ = decode_image_bytes(image_bytes)
+    if image is None:
+        return None
+    return analyze_face(image, check_liveness=check_liveness)
+
+
+def encode_face(image):
+    """
+    Encode a face image into a feature vector using MediaPipe
+    """
+    analysis = analyze_face(image, check_liveness=False)
+    if analysis.encoding is None:
+        print("No faces detected in the image" if not analysis.detections else "Could not extract face landmarks")
+        return None
+    print(f"Face encoding shape: {analysis.encoding.shape}")
+    return analysis.encoding
+
+# JPEG start-of-frame markers carry the image dimensions (DHT, JPG and DAC share the range)
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_REDUCED_DECODE_FLAGS = (
+    (8, 'IMREAD_REDUCED_COLOR_8'),
+    (4, 'IMREAD_REDUCED_COLOR_4'),
+    (2, 'IMREAD_REDUCED_COLOR_2'),
+)
+
+
+def _jpeg_dimensions(data):
+    """
+    Read (width, height) from a JPEG header without decoding the image.
+    Returns None if the data is not a JPEG or the header cannot be parsed.
+    """
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    offset = 2
+    length = len(data)
+    while offset + 4 <= length:
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # markers without a payload
+            offset += 2
+            continue
+        segment_length = (data[offset + 2] << 8) | data[offset + 3]
+        if marker in _JPEG_SOF_MARKERS:
+            if offset + 9 > length:
+                return None
+            height = (data[offset + 5] << 8) | data[offset + 6]
+            width = (data[offset + 7] << 8) | data[offset + 8]
+            return width, height
+        offset += 2 + segment_length
+    return None
+
+
+def decode_image_bytes(image_data, max_dimension=None, max_bytes=None):
+    """
+    Decode encoded image bytes into a BGR image whose long edge is at most
+    max_dimension pixels.
+
+    Oversized JPEGs are decoded at 1/2, 1/4 or 1/8 resolution directly by the
+    codec, then area-resized to the target long edge. Payloads larger than
+    max_bytes are rejected without decoding.
+
+    Returns (image, scale) where scale maps decoded pixel coordinates back to
+    the original image (original = decoded / scale), or (None, 1.0).
+    """
+    max_dimension = max_dimension or getattr(settings, 'FACE_MAX_IMAGE_DIMENSION', 1280)
+    max_bytes = max_bytes or getattr(settings, 'FACE_MAX_IMAGE_BYTES', 8 * 1024 * 1024)
+
+    if len(image_data) > max_bytes:
+        print(f"Image payload too large ({len(image_data)} bytes, limit {max_bytes})")
+        return None, 1.0
+
+    nparr = np.frombuffer(image_data, np.uint8)
+
+    flags = cv2.IMREAD_COLOR
+    source_dimensions = _jpeg_dimensions(memoryview(nparr))
+    if source_dimensions:
+        long_edge = max(source_dimensions)
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            # Never let the codec shrink below the target size
+            if long_edge // factor >= max_dimension:
+                flags = getattr(cv2, reduced_flag)
+                break
+
+    with stage_timer('decode.image'):
+        image = cv2.imdecode(nparr, flags)
+    if image is None:
+        return None, 1.0
+
+    original_long_edge = max(source_dimensions) if source_dimensions else max(image.shape[:2])
+    decoded_long_edge = max(image.shape[:2])
+    if decoded_long_edge > max_dimension:
+        resize = max_dimension / decoded_long_edge
+        with stage_timer('decode.resize'):
+            image = cv2.resize(image, None, fx=resize, fy=resize, interpolation=cv2.INTER_AREA)
+
+    scale = max(image.shape[:2]) / original_long_edge
+    return image, scale
+
+
+def base64_to_bytes(base64_string, max_bytes=None):
+    """
+    Decode a base64 image payload (optionally a data URL) into raw bytes.
+    Returns None if the payload exceeds max_bytes or is not valid base64.
+    """
+    max_bytes = max_bytes or getattr(settings, 'FACE_MAX_IMAGE_BYTES', 8 * 1024 * 1024)
+    
+    # Remove data URL prefix if present
+    if base64_string.startswith('data:image'):
+        base64_string = base64_string.split(',')[1]
+    
+    # Reject oversized payloads before spending time decoding them
+    if len(base64_string) * 3 // 4 > max_bytes:
+        print(f"Image payload too large (limit {max_bytes} bytes)")
+        return None
+    
+    try:
+        with stage_timer('decode.base64'):
+            return base64.b64decode(base64_string)
+    except Exception as e:
+        print(f"Error decoding base64 image: {e}")
+        return None
+
+
+def image_to_base64(image, max_dimension=None, quality=80):
+    """
+    Encode an image as a base64 JPEG string, downscaled so its long edge is
+    at most max_dimension pixels. Returns None if it cannot be encoded.
+    """
+    if image is None or image.size == 0:
+        return None
+    if max_dimension and max(image.shape[:2]) > max_dimension:
+        scale = max_dimension / max(image.shape[:2])
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return base64.b64encode(buffer.tobytes()).decode('ascii') if ok else None
+
 
 def base64_to_image(base64_string):
     """
-    Convert base64 string to image
+    Convert base64 string to image, bounded to FACE_MAX_IMAGE_DIMENSION
     """
     try:
-        # Remove data URL prefix if present
-        if base64_string.startswith('data:image'):
-            base64_string = base64_string.split(',')[1]
-            
-        # Decode base64 string
-        image_data = base64.b64decode(base64_string)
-        
-        # Convert to numpy array
-        nparr = np.frombuffer(image_data, np.uint8)
+        image_data = base64_to_bytes(base64_string)
+        if image_data is None:
+            return None
         
         # Decode image
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        image, scale = decode_image_bytes(image_data)
         
         if image is not None:
-            print(f"Image shape: {image.shape}")
+            print(f"Image shape: {image.shape} (scale {scale:.3f})")
         else:
             print("Failed to decode image")
         
@@ -114,6 +561,127 @@ def base64_to_image(base64_string):
         traceback.print_exc()
         return None
 
+# Binary face encoding format stored in User.face_encoding and FaceTemplate.encoding:
+#   v1: magic b'FE' | version u8 | dtype code u8 | model id u8 | pad | dimension u16
+#   v2: the v1 fields | basis id u16 | pad u16 | scale f32
+# followed by the raw little-endian vector. The 8 and 16 byte headers keep the
+# payload aligned so it can be viewed in place with np.frombuffer. The basis id
+# names the fitted projection for models that have one (0 otherwise); int8
+# vectors are quantized and multiplied by scale when read.
+FACE_ENCODING_MAGIC = b'FE'
+FACE_ENCODING_VERSION = 2
+FACE_ENCODING_HEADERS = {
+    1: struct.Struct('<2sBBBxH'),
+    2: struct.Struct('<2sBBBxHH2xf'),
+}
+FACE_ENCODING_HEADER = FACE_ENCODING_HEADERS[FACE_ENCODING_VERSION]
+_FACE_ENCODING_PREFIX = struct.Struct('<2sB')
+
+FACE_ENCODING_DTYPES = {
+    1: '<f4',
+    2: '<f8',
+    3: '<f2',
+    4: '|i1',
+}
+
+# Model ids identify how a vector was produced; vectors from different models
+# (or, for the aligned model, different bases) are never comparable.
+FACE_MODEL_MEDIAPIPE_MESH = 1
+FACE_MODEL_ALIGNED_PCA = 2
+
+
+def pack_face_encoding(encoding, model_id=FACE_MODEL_MEDIAPIPE_MESH, dtype='float32', basis=0):
+    """
+    Serialize a face encoding into the versioned binary storage format
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    dtype_code = next(code for code, known in FACE_ENCODING_DTYPES.items() if known == dtype)
+    vector = np.asarray(encoding, dtype=np.float32).ravel()
+    scale = 1.0
+    if dtype.kind == 'i':
+        # Symmetric per-vector quantization
+        peak = float(np.max(np.abs(vector))) if len(vector) else 0.0
+        scale = peak / np.iinfo(dtype).max if peak > 0 else 1.0
+        vector = np.rint(vector / scale)
+    vector = np.ascontiguousarray(vector, dtype=dtype)
+    header = FACE_ENCODING_HEADER.pack(
+        FACE_ENCODING_MAGIC, FACE_ENCODING_VERSION, dtype_code, model_id, len(vector), basis, scale
+    )
+    return header + vector.tobytes()
+
+
+def unpack_face_encoding(blob):
+    """
+    Parse a stored face encoding, without copying float vectors.
+
+    Returns (vector, model_id, basis); float vectors are read-only views over
+    the blob, int8 vectors are dequantized to float32.
+    Raises ValueError if the blob is not in the binary storage format.
+    """
+    if len(blob) < _FACE_ENCODING_PREFIX.size:
+        raise ValueError("Face encoding blob is too short")
+    magic, version = _FACE_ENCODING_PREFIX.unpack_from(blob)
+    if magic != FACE_ENCODING_MAGIC:
+        raise ValueError("Face encoding blob has an unknown format")
+    header = FACE_ENCODING_HEADERS.get(version)
+    if header is None:
+        raise ValueError(f"Unsupported face encoding version {version}")
+    if len(blob) < header.size:
+        raise ValueError("Face encoding blob is too short")
+    if version == 1:
+        _, _, dtype_code, model_id, dimension = header.unpack_from(blob)
+        basis, scale = 0, 1.0
+    else:
+        _, _, dtype_code, model_id, dimension, basis, scale = header.unpack_from(blob)
+    if dtype_code not in FACE_ENCODING_DTYPES:
+        raise ValueError(f"Unsupported face encoding dtype code {dtype_code}")
+    dtype = np.dtype(FACE_ENCODING_DTYPES[dtype_code])
+    if len(blob) != header.size + dimension * dtype.itemsize:
+        raise ValueError("Face encoding blob length does not match its header")
+    vector = np.frombuffer(blob, dtype=dtype, count=dimension, offset=header.size)
+    if dtype.kind == 'i':
+        vector = vector.astype(np.float32) * np.float32(scale)
+    return vector, model_id, basis
+
+
+def decode_face_encoding(stored_encoding):
+    """
+    Decode a face encoding stored on a User back into a vector.
+    Returns None if the stored value is empty or malformed.
+    """
+    if not stored_encoding:
+        return None
+    try:
+        vector, _, _ = unpack_face_encoding(stored_encoding)
+        return vector
+    except Exception as e:
+        print(f"Error decoding face encoding: {e}")
+        return None
+
+def _face_distances(known_encoding, unknown_encoding):
+    """Return (normalized, raw) Euclidean distance between two encodings"""
+    # Calculate Euclidean distance between encodings
+    # For MediaPipe landmarks, we'll use a normalized distance
+    with stage_timer('match.compare'):
+        distance = np.linalg.norm(known_encoding - unknown_encoding)
+    
+    # Normalize the distance (since landmark coordinates are normalized between 0-1)
+    # The maximum possible distance would be sqrt(number_of_points * 3) 
+    # (3 for x,y,z coordinates)
+    max_possible_distance = np.sqrt(len(known_encoding) / 3 * 3)  # Simplified
+    return distance / max_possible_distance, distance
+
+def best_face_distance(known_encodings, unknown_encoding):
+    """
+    Closest match of a capture against a K x D matrix of a user's templates,
+    in one vectorized pass. Returns (row, normalized_distance), on the same
+    scale as the compare_faces tolerance.
+    """
+    with stage_timer('match.compare'):
+        distances = np.linalg.norm(known_encodings - unknown_encoding, axis=1) / np.sqrt(known_encodings.shape[1])
+    best = int(np.argmin(distances))
+    return best, float(distances[best])
+
 def compare_faces(known_encoding, unknown_encoding, tolerance=0.4):
     """
     Compare two face encodings using MediaPipe approach with stricter tolerance
@@ -129,15 +697,7 @@ def compare_faces(known_encoding, unknown_encoding, tolerance=0.4):
             print(f"Encoding shape mismatch: known {known_encoding.shape}, unknown {unknown_encoding.shape}")
             return False
             
-        # Calculate Euclidean distance between encodings
-        # For MediaPipe landmarks, we'll use a normalized distance
-        distance = np.linalg.norm(known_encoding - unknown_encoding)
-        
-        # Normalize the distance (since landmark coordinates are normalized between 0-1)
-        # The maximum possible distance would be sqrt(number_of_points * 3) 
-        # (3 for x,y,z coordinates)
-        max_possible_distance = np.sqrt(len(known_encoding) / 3 * 3)  # Simplified
-        normalized_distance = distance / max_possible_distance
+        normalized_distance, distance = _face_distances(known_encoding, unknown_encoding)
         
         # Consider faces matching if normalized distance is below tolerance
         match_result = normalized_distance <= tolerance
@@ -156,108 +716,11 @@ def is_live_capture(image):
     """
     Enhanced liveness detection to prevent spoofing with static images using MediaPipe
     """
-    try:
-        # Check if image is valid
-        if image is None or image.size == 0:
-            return False
-            
-        # Convert to grayscale
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
-            
-        # 1. Check image quality - static images often have different characteristics
-        # Calculate Laplacian variance to measure image blur
-        laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-        if laplacian_var < 50:  # Very blurry images are suspicious
-            print(f"Image too blurry (variance: {laplacian_var}), likely not live")
-            return False
-            
-        # 2. Detect faces first using MediaPipe
-        mp_face_detection = mp.solutions.face_detection
-        with mp_face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5) as face_detection:
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            results = face_detection.process(rgb_image)
-        
-        if not results.detections:
-            print("No faces detected for liveness check")
-            return False
-            
-        # 3. Check for eye regions using MediaPipe Face Mesh
-        # This is a simplified check - in production, you'd want more sophisticated blink detection
-        mp_face_mesh = mp.solutions.face_mesh
-        with mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True,
-                                  min_detection_confidence=0.5) as face_mesh:
-            landmarks_results = face_mesh.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        
-        if not landmarks_results.multi_face_landmarks:
-            print("No face landmarks detected")
-            return False
-            
-        # 4. Check for multiple faces (photos of screens often show multiple faces)
-        if len(results.detections) > 1:
-            print(f"Multiple faces detected ({len(results.detections)}), likely not live")
-            return False
-            
-        # 5. Check image metadata patterns that suggest it's a photo of a screen
-        # This is a heuristic check - screen photos often have specific color patterns
-        # Check color distribution
-        if len(image.shape) == 3:
-            # Calculate color variance
-            color_variance = np.var(image, axis=(0, 1))
-            avg_color_variance = np.mean(color_variance)
-            if avg_color_variance < 100:  # Very low color variance suggests screen photo
-                print(f"Low color variance ({avg_color_variance}), likely screen photo")
-                return False
-                
-        # 6. Check for Moire patterns (common in photos of screens)
-        # Apply FFT to detect repetitive patterns
-        try:
-            # Convert to grayscale if needed
-            if len(gray.shape) == 3:
-                gray_check = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
-            else:
-                gray_check = gray
-                
-            # Apply FFT
-            f = np.fft.fft2(gray_check)
-            fshift = np.fft.fftshift(f)
-            magnitude_spectrum = 20 * np.log(np.abs(fshift) + 1)
-            
-            # Check for high frequency patterns
-            center = (gray_check.shape[0] // 2, gray_check.shape[1] // 2)
-            radius = min(center) // 4
-            mask = np.zeros_like(magnitude_spectrum)
-            cv2.circle(mask, center, radius, 1, -1)
-            high_freq_energy = np.sum(magnitude_spectrum * (1 - mask))
-            
-            # If high frequency energy is too high, it might be a screen photo
-            if high_freq_energy > 1000000:  # Threshold determined empirically
-                print(f"High frequency energy ({high_freq_energy}), likely screen photo")
-                return False
-        except Exception as fft_error:
-            print(f"FFT check failed: {fft_error}")
-            # Continue with other checks even if FFT fails
-            
-        # 7. Check for unnatural brightness patterns
-        mean_brightness = np.mean(gray)
-        if mean_brightness < 30 or mean_brightness > 220:
-            print(f"Unnatural brightness ({mean_brightness}), potentially not live")
-            return False
-            
-        # If all checks pass, consider it a live capture
-        print("Liveness check passed")
-        return True
-    except Exception as e:
-        print(f"Error in liveness detection: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+    return analyze_face(image).is_live
 
 def send_attendance_email(user, attendance_record):
     """
-    Send attendance confirmation email to user
+    Queue an attendance confirmation email to user
     """
     try:
         subject = 'Attendance Marked Successfully'
@@ -271,21 +734,21 @@ def send_attendance_email(user, attendance_record):
         Thank you for using the Face Recognition Attendance System.
         '''
         
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            fail_silently=False,
-        )
+        enqueue_email(subject, message, user.email)
         return True
     except Exception as e:
         print(f"Error sending attendance email: {e}")
         return False
 
+def send_attendance_emails(records):
+    """Queue the confirmation emails of several attendance records at once"""
+    with transaction.atomic():
+        for record in records:
+            send_attendance_email(record.user, record)
+
 def send_user_details_email(user, action, password=None):
     """
-    Send user details email to user when created or updated by HOD
+    Queue a user details email to user when created or updated by HOD
     
     Args:
         user: User object containing user details
@@ -324,151 +787,116 @@ If you have any questions, please contact your Head of Department.
 Thank you for using the Face Recognition Attendance System.
 '''
         
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            fail_silently=False,
-        )
+        enqueue_email(subject, message, user.email)
         return True
     except Exception as e:
         print(f"Error sending user details email: {e}")
         return False
 
 
-def send_attendance_report_email(user, report_date, attendance_data):
+def attendance_report_email(user, report_date, attendance_data):
     """
-    Send attendance report email to user for a specific date
+    Render the attendance report email of user for a specific date
     
     Args:
         user: User object to send email to
         report_date: Date for which the report is generated
         attendance_data: List of attendance records for sessions on that date
+    
+    Returns:
+        (subject, message)
     """
-    try:
-        # Check if user already received an email today
-        if user_already_received_email_today(user.id, report_date):
-            print(f"User {user.email} already received an attendance report today. Skipping.")
-            return True  # Return True to indicate success (no need to send)
-        
-        subject = f'Attendance Report - {report_date.strftime("%Y-%m-%d")} - {user.department}'
-        
-        # Find the latest session based on session start time (not attendance timestamp)
-        latest_session_time = None
-        latest_session_date = None
-        if attendance_data:
-            for record in attendance_data:
-                # Use session_time instead of attendance timestamp
-                session_time_str = record['session_time']  # This is already in the right format
-                if session_time_str:
-                    # For latest session, we just need the latest session_time
-                    if latest_session_time is None or session_time_str > latest_session_time:
-                        latest_session_time = session_time_str
-                        # Extract date from session_time
-                        try:
-                            # session_time is in format "YYYY-MM-DD HH:MM"
-                            from datetime import datetime
-                            dt = datetime.strptime(session_time_str, "%Y-%m-%d %H:%M")
-                            latest_session_date = dt.date()
-                        except ValueError:
-                            pass  # Handle parsing error
-        
-        # Build attendance report message
-        message = f'''
+    subject = f'Attendance Report - {report_date.strftime("%Y-%m-%d")} - {user.department}'
+    
+    # Find the latest session based on session start time (not attendance timestamp)
+    latest_session_time = None
+    latest_session_date = None
+    if attendance_data:
+        for record in attendance_data:
+            # Use session_time instead of attendance timestamp
+            session_time_str = record['session_time']  # This is already in the right format
+            if session_time_str:
+                # For latest session, we just need the latest session_time
+                if latest_session_time is None or session_time_str > latest_session_time:
+                    latest_session_time = session_time_str
+                    # Extract date from session_time
+                    try:
+                        # session_time is in format "YYYY-MM-DD HH:MM"
+                        from datetime import datetime
+                        dt = datetime.strptime(session_time_str, "%Y-%m-%d %H:%M")
+                        latest_session_date = dt.date()
+                    except ValueError:
+                        pass  # Handle parsing error
+    
+    # Build attendance report message
+    message = f'''
 Hello {user.get_full_name() or user.roll_number},
 
 This is your attendance report for {report_date.strftime("%Y-%m-%d")} in the {user.department} department.
 
 '''
+    
+    # Add latest session information if available
+    if latest_session_time and latest_session_date:
         
-        # Add latest session information if available
-        if latest_session_time and latest_session_date:
-            
-            message += f"Latest session start date: {latest_session_date}\n\n"
-        
-        message += "Session Attendance Details:\n"
-        
-        if attendance_data:
-            for record in attendance_data:
-                status = "Attended" if record['attended'] else "Absent"
-                timestamp = record['timestamp'] if record['timestamp'] else "N/A"
-                # Show only the attendance timestamp, not the session time
-                message += f"- {record['session_name']}: {status}"
-                if record['attended']:
-                    message += f" - Marked at {timestamp}"
-                message += "\n"
-        else:
-            message += "No sessions were conducted on this date.\n"
-        
-        message += '''
+        message += f"Latest session start date: {latest_session_date}\n\n"
+    
+    message += "Session Attendance Details:\n"
+    
+    if attendance_data:
+        for record in attendance_data:
+            status = "Attended" if record['attended'] else "Absent"
+            timestamp = record['timestamp'] if record['timestamp'] else "N/A"
+            # Show only the attendance timestamp, not the session time
+            message += f"- {record['session_name']}: {status}"
+            if record['attended']:
+                message += f" - Marked at {timestamp}"
+            message += "\n"
+    else:
+        message += "No sessions were conducted on this date.\n"
+    
+    message += '''
 If you have any questions about your attendance, please contact your Head of Department.
 
 Thank you for using the Face Recognition Attendance System.
 '''
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            fail_silently=False,
-        )
-        
-        # Record that we sent an email to this user today
-        record_email_sent(user.id, report_date)
+    return subject, message
+
+def send_attendance_report_email(user, report_date, attendance_data):
+    """
+    Queue an attendance report email to user for a specific date. Callers
+    send each report once per user and date by recording it with
+    outbox.claim_dispatches first.
+    """
+    try:
+        subject, message = attendance_report_email(user, report_date, attendance_data)
+        enqueue_email(subject, message, user.email)
         
         return True
     except Exception as e:
         print(f"Error sending attendance report email to {user.email}: {e}")
         return False
 
-def user_already_received_email_today(user_id, report_date):
-    """Check if user already received an email today"""
-    try:
-        # Create a simple tracking file
-        tracking_file = os.path.join(os.path.dirname(__file__), 'email_tracking.json')
-        
-        # If file doesn't exist, user hasn't received an email
-        if not os.path.exists(tracking_file):
-            return False
-            
-        # Read the tracking data
-        with open(tracking_file, 'r') as f:
-            tracking_data = json.load(f)
-        
-        # Check if user has an entry for today
-        user_key = str(user_id)
-        today_str = report_date.strftime("%Y-%m-%d")
-        
-        if user_key in tracking_data and tracking_data[user_key] == today_str:
-            return True
-            
-        return False
-    except Exception as e:
-        print(f"Error checking email tracking: {e}")
-        return False  # If there's an error, we'll send the email to be safe
+def monthly_report_email(user, report):
+    """
+    Render the monthly attendance report email of user
+    
+    Returns:
+        (subject, message)
+    """
+    month = report.month.strftime("%B %Y")
+    subject = f'Monthly Attendance Report - {month}'
+    message = f'''
+Hello {user.get_full_name() or user.roll_number},
 
-def record_email_sent(user_id, report_date):
-    """Record that an email was sent to a user today"""
-    try:
-        # Create a simple tracking file
-        tracking_file = os.path.join(os.path.dirname(__file__), 'email_tracking.json')
-        
-        # Read existing data or create empty dict
-        if os.path.exists(tracking_file):
-            with open(tracking_file, 'r') as f:
-                tracking_data = json.load(f)
-        else:
-            tracking_data = {}
-        
-        # Update the tracking data
-        user_key = str(user_id)
-        today_str = report_date.strftime("%Y-%m-%d")
-        tracking_data[user_key] = today_str
-        
-        # Write back to file
-        with open(tracking_file, 'w') as f:
-            json.dump(tracking_data, f)
-    except Exception as e:
-        print(f"Error recording email sent: {e}")
+This is your attendance report for {month}.
+
+Sessions: {report.total_sessions}
+Attended: {report.attended_sessions}
+Attendance: {report.attendance_percentage}%
+
+If you have any questions about your attendance, please contact your Head of Department.
+
+Thank you for using the Face Recognition Attendance System.
+'''
+    return subject, message
@@ -1,21 +1,31 @@
+import io
 import json
+import time
 import base64
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django.contrib import messages
 from django.http import JsonResponse, HttpResponse
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 import pytz
 from django.db.models import Count
 from datetime import datetime, timedelta
-from .models import User, Role, LocationConstraint, AttendanceSession, AttendanceRecord, MonthlyReport
+from .models import User, Role, LocationConstraint, AttendanceSession, AttendanceRecord, AttendanceJob, ReportJob, MonthlyReport, FaceImage
 from .forms import CustomUserCreationForm
-from .utils import encode_face, base64_to_image, compare_faces, send_attendance_email, is_live_capture
-import numpy as np
-import face_recognition
+from .face_index import face_index
+from .encoders import active_encoder, match_tolerance
+from .enrollment import load_templates, enroll, refresh_from_attendance, capture_quality, clear_templates
+from .jobs import JobQueue, QueueFull, KeyLimitReached
+from .roster import Roster, assign, mark_present, materialize_roster
+from .reports import load_session_attendance, send_department_report
+from .monthly import monthly_report
+from . import cv, metrics
+from .utils import encode_face, base64_to_image, base64_to_bytes, send_attendance_email, send_attendance_emails, analyze_face, analyze_image, analyze_faces, decode_image_bytes, image_to_base64
 
 
 User = get_user_model()
@@ -274,17 +284,18 @@ def process_attendance(request):
         if unknown_encoding is None:
             return JsonResponse({'success': False, 'message': 'No face detected in the image'})
         
-        # Get user's stored face encoding
-        if not request.user.face_encoding:
+        # Get user's stored face templates
+        templates = load_templates(request.user)
+        if not len(templates):
             return JsonResponse({'success': False, 'message': 'No face registered for this user'})
+        unknown_encoding = templates.encode(unknown_encoding)
+        if templates.dimension != len(unknown_encoding):
+            return JsonResponse({'success': False, 'message': 'Error decoding stored face data. Please re-register your face.'})
         
-        # Convert stored encoding back to numpy array
-        known_encoding = np.frombuffer(base64.b64decode(request.user.face_encoding), dtype=np.float64)
-        
-        # Compare faces
-        match = compare_faces(known_encoding, unknown_encoding)
+        # Compare faces against every template
+        _, distance = templates.closest(unknown_encoding)
         
-        if not match:
+        if distance > match_tolerance('verify', templates.encoder):
             return JsonResponse({'success': False, 'message': 'Face does not match registered face'})
         
         # Check location constraints
@@ -346,51 +357,23 @@ def register_face(request):
             print(f"Received image shape: {image.shape if hasattr(image, 'shape') else 'Unknown'}")
             print(f"Received image type: {type(image)}")
             
-            # Encode face
-            face_encoding = encode_face(image)
+            # Encode face, keeping the detection results for the error message
+            analysis = analyze_face(image, check_liveness=False)
+            face_encoding = analysis.encoding
             
             if face_encoding is None:
-                # Try to detect faces with different methods for better error reporting
-                import face_recognition
-                import cv2
-                
-                # Convert to RGB if needed
-                if len(image.shape) == 3:
-                    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                else:
-                    rgb_image = image
-                
-                # Try different detection methods
-                face_locations_hog = face_recognition.face_locations(rgb_image, model="hog")
-                face_locations_cnn = face_recognition.face_locations(rgb_image, model="cnn")
-                face_locations_upsample = face_recognition.face_locations(rgb_image, number_of_times_to_upsample=2)
-                
-                error_details = []
-                if not face_locations_hog:
-                    error_details.append("HOG model found no faces")
-                else:
-                    error_details.append(f"HOG model found {len(face_locations_hog)} face(s)")
-                
-                if not face_locations_cnn:
-                    error_details.append("CNN model found no faces")
+                if not analysis.detections:
+                    details = "face detector found no faces"
                 else:
-                    error_details.append(f"CNN model found {len(face_locations_cnn)} face(s)")
-                
-                if not face_locations_upsample:
-                    error_details.append("Upsampled detection found no faces")
-                else:
-                    error_details.append(f"Upsampled detection found {len(face_locations_upsample)} face(s)")
-                
-                detailed_message = f"No face detected in the image. Please try again with better lighting and positioning. Details: {', '.join(error_details)}"
+                    details = f"face detector found {analysis.face_count} face(s) but no face landmarks could be located"
+                detailed_message = f"No face detected in the image. Please try again with better lighting and positioning. Details: {details}"
                 return JsonResponse({'success': False, 'message': detailed_message})
             
-            # Convert numpy array to bytes for storage
-            encoding_bytes = face_encoding.tobytes()
-            encoding_b64 = base64.b64encode(encoding_bytes).decode()
-            
-            # Save to user profile
-            request.user.face_encoding = encoding_b64
+            # Save to user profile and add it to the user's templates
+            request.user.face_encoding = active_encoder().serialize(face_encoding)
             request.user.save()
+            enroll(request.user, face_encoding, capture_quality(analysis))
+            face_index.update(request.user.id, face_encoding)
             
             return JsonResponse({'success': True, 'message': 'Face registered successfully!'})
             
@@ -609,6 +592,7 @@ def start_session(request, session_id):
         session.start_time = timezone.now()  # Reset start time
         session.end_time = timezone.now() + (session.end_time - session.start_time)  # Adjust end time
         session.save()
+        materialize_roster(session)
         
         messages.success(request, f'Session "{session.name}" started successfully.')
     except AttendanceSession.DoesNotExist:
@@ -831,224 +815,274 @@ def api_login(request):
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
 
-@csrf_exempt
-def api_register_face(request):
-    """API endpoint for registering user's face"""
-    if request.method != 'POST':
-        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png')
+
+def _read_face_upload(request, allow_base64=True):
+    """
+    Read the captured image and accompanying fields from a face API request.
     
-    try:
-        # Check if user is authenticated
-        if not request.user.is_authenticated:
-            return JsonResponse({'success': False, 'message': 'Authentication required'})
-        
-        data = json.loads(request.body)
-        image_data = data.get('image')
-        
-        if not image_data:
-            return JsonResponse({'success': False, 'message': 'Image data is required'})
-        
-        # Remove data URL prefix if present
-        if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
-        
-        # Convert base64 to image
-        image = base64_to_image(image_data)
-        
-        if image is None:
-            return JsonResponse({'success': False, 'message': 'Invalid image data'})
-        
-        # Check if image is from a live camera (not a static photo)
-        # This is a basic check - in a production environment, you might want more sophisticated methods
-        if not is_live_capture(image):
-            return JsonResponse({'success': False, 'message': 'Only live face capture is allowed. Static images, photos of screens, or blurry images are not permitted. Please use the device camera directly.'})
-        
-        # Encode face
-        face_encoding = encode_face(image)
-        
-        if face_encoding is None:
-            return JsonResponse({'success': False, 'message': 'No face detected in the image. Please try again with better lighting and positioning.'})
-        
-        # Debug: Check encoding shape
-        print(f"Face encoding shape: {face_encoding.shape}")
-        
-        # Check if this face is already registered by another user with stricter tolerance
-        existing_users = User.objects.exclude(id=request.user.id).exclude(face_encoding__isnull=True).exclude(face_encoding='')
-        for user in existing_users:
-            try:
-                # Convert stored encoding back to numpy array
-                known_encoding = np.frombuffer(base64.b64decode(user.face_encoding), dtype=np.float64)
-                
-                # Ensure both encodings have the same shape
-                if known_encoding.shape != face_encoding.shape:
-                    continue  # Skip this user if shapes don't match
-                
-                # Compare faces with a stricter tolerance for registration
-                match = compare_faces(known_encoding, face_encoding, tolerance=0.4)
-                
-                if match:
-                    return JsonResponse({
-                        'success': False, 
-                        'message': f'This face is already registered to another user ({user.roll_number}). Each face can only be registered once.'
-                    })
-            except Exception as e:
-                # Continue checking other users if there's an error with one
-                continue
-        
-        # Convert numpy array to bytes for storage
-        encoding_bytes = face_encoding.tobytes()
-        encoding_b64 = base64.b64encode(encoding_bytes).decode()
-        
-        # Save face encoding and image to user profile
-        request.user.face_encoding = encoding_b64
-        request.user.face_image = image_data  # Store the image data
-        request.user.save()
-        
-        return JsonResponse({'success': True, 'message': 'Face registered successfully!'})
+    Accepts multipart/form-data with an 'image' file part, a raw image/jpeg or
+    image/png body with the other fields in the query string, and, unless
+    allow_base64 is False, the legacy JSON body with a base64 'image' string.
+    
+    Returns (image_bytes, fields). image_bytes is None when no image was sent;
+    binary uploads are passed on as buffers without intermediate copies.
+    """
+    max_bytes = getattr(settings, 'FACE_MAX_IMAGE_BYTES', 8 * 1024 * 1024)
+    
+    if request.content_type == 'multipart/form-data':
+        upload = request.FILES.get('image')
+        if upload is None:
+            return None, request.POST
+        if upload.size > max_bytes:
+            raise ValueError(f'Image exceeds the {max_bytes} byte limit')
+        # Small uploads are held in memory; view the buffer instead of copying it
+        stream = getattr(upload, 'file', None)
+        if isinstance(stream, io.BytesIO):
+            return stream.getbuffer(), request.POST
+        return upload.read(), request.POST
+    
+    if request.content_type in IMAGE_CONTENT_TYPES:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if length > max_bytes:
+            raise ValueError(f'Image exceeds the {max_bytes} byte limit')
+        # Read the stream directly; request.body would apply DATA_UPLOAD_MAX_MEMORY_SIZE
+        return (request.read(length) if length else None), request.GET
+    
+    if not allow_base64:
+        raise ValueError('Send the image as multipart/form-data or as an image/jpeg request body')
+    
+    data = json.loads(request.body)
+    image_data = data.get('image')
+    return (base64_to_bytes(image_data) if image_data else None), data
+
+def _check_attendance_capture(user, session, analysis, templates, latitude, longitude):
+    """
+    Check an analyzed capture against the user's face templates (see
+    enrollment.load_templates) and the session's location constraint.
+    Returns (error payload or None, best template distance or None).
+    """
+    if analysis is None:
+        return {'success': False, 'message': 'Invalid image data'}, None
+    
+    # Enhanced liveness detection to prevent spoofing
+    if not analysis.is_live:
+        return {'success': False, 'message': 'Only live face capture is allowed. Static images, photos of screens, or blurry images are not permitted. Please use the device camera directly and ensure good lighting.', 'liveness_stage': analysis.liveness_stage}, None
+    
+    unknown_encoding = analysis.encoding
+    
+    if unknown_encoding is None:
+        return {'success': False, 'message': 'No face detected in the image. Please try again with better lighting and positioning.'}, None
+    
+    # Get user's stored face templates
+    if not len(templates):
+        return {'success': False, 'message': 'No face registered for this user'}, None
+    unknown_encoding = templates.encode(unknown_encoding)
+    
+    # Ensure the templates and the capture have the same shape
+    if templates.dimension != len(unknown_encoding):
+        return {'success': False, 'message': f'Face encoding mismatch. Stored: ({templates.dimension},), Captured: {unknown_encoding.shape}. Please re-register your face.'}, None
+    
+    # Compare against every template at once, within the encoder's verification tolerance
+    _, distance = templates.closest(unknown_encoding)
+    tolerance = match_tolerance('verify', templates.encoder)
+    print(f"Best template distance {distance:.4f} over {len(templates)} template(s)")
+    
+    if distance > tolerance:
+        return {'success': False, 'message': f'Face does not match registered face. Distance: {distance:.4f}, Threshold: {tolerance}. Please ensure you are the registered user.'}, distance
+    
+    # Check location constraints
+    if latitude and longitude and session.location_constraint:
+        location = session.location_constraint
+        location_distance = calculate_distance(
+            float(latitude), float(longitude),
+            float(location.latitude), float(location.longitude)
+        )
         
+        # Check if distance is within the allowed radius
+        if location_distance > float(location.radius):
+            return {
+                'success': False, 
+                'message': f'You are not within the allowed location for attendance. Distance: {location_distance:.2f}m, Allowed: {location.radius}m'
+            }, distance
+    
+    return None, distance
+
+def _verify_attendance(user, session, image_bytes, latitude, longitude):
+    """
+    Verify a captured face against the user's registered face and record their
+    attendance for the session. Returns the JSON payload for the client.
+    """
+    # Decode, detect, mesh and encode the frame once for both liveness and encoding
+    analysis = analyze_image(image_bytes)
+    templates = load_templates(user)
+    
+    error, distance = _check_attendance_capture(user, session, analysis, templates, latitude, longitude)
+    if error:
+        return error
+    
+    # Create attendance record
+    attendance_record = AttendanceRecord.objects.create(
+        user=user,
+        session=session,
+        latitude=float(latitude) if latitude else None,
+        longitude=float(longitude) if longitude else None,
+        verification_method='face'
+    )
+    
+    # Learn the capture as an extra template when the match was confident
+    refresh_from_attendance(user, templates, analysis, distance)
+    
+    # Send attendance confirmation email
+    from .utils import send_attendance_email
+    send_attendance_email(user, attendance_record)
+    
+    return {
+        'success': True, 
+        'message': 'Attendance marked successfully!',
+        'timestamp': attendance_record.timestamp.isoformat()
+    }
+
+def _run_attendance_job(job_id, image_bytes, latitude, longitude):
+    """Worker side of api_submit_attendance: verify the face and store the outcome on the job"""
+    job = AttendanceJob.objects.select_related('user', 'session__location_constraint').get(id=job_id)
+    # A job that waited so long it was failed as stale has been resubmitted or given up on
+    if not AttendanceJob.objects.filter(id=job_id, status='queued').update(status='running', updated_at=timezone.now()):
+        return
+    try:
+        result = _verify_attendance(job.user, job.session, image_bytes, latitude, longitude)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error registering face: {str(e)}")
-        print(f"Traceback: {error_details}")
-        return JsonResponse({'success': False, 'message': f'Error registering face: {str(e)}'})
+        print(f"Error processing attendance job {job_id}: {str(e)}")
+        result = {'success': False, 'message': f'Error processing attendance: {str(e)}'}
+    AttendanceJob.objects.filter(id=job_id).update(
+        status='succeeded' if result.get('success') else 'failed',
+        result=result,
+        updated_at=timezone.now(),
+    )
+
+attendance_queue = JobQueue(
+    'attendance_job',
+    _run_attendance_job,
+    maxsize=getattr(settings, 'FACE_JOB_QUEUE_SIZE', 200),
+    workers=getattr(settings, 'FACE_JOB_WORKERS', 2),
+    per_key_limit=getattr(settings, 'FACE_JOB_SESSION_LIMIT', 50),
+)
+
+def _fail_stale_attendance_jobs(jobs):
+    """
+    Fail queued or running jobs that have not progressed for
+    FACE_JOB_STALE_SECONDS. The queue lives in process memory, so a job whose
+    worker process restarted is never picked up again.
+    """
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'FACE_JOB_STALE_SECONDS', 120))
+    return jobs.filter(status__in=['queued', 'running'], updated_at__lt=cutoff).update(
+        status='failed',
+        result={'success': False, 'message': 'Attendance verification was interrupted. Please submit again.'},
+        updated_at=timezone.now(),
+    )
+
+def _attendance_job_payload(job):
+    payload = {'success': True, 'job_id': str(job.id), 'status': job.status}
+    if job.is_finished:
+        payload['result'] = job.result
+    return payload
 
 @csrf_exempt
-def api_mark_attendance(request):
-    """API endpoint for marking attendance"""
+def api_submit_attendance(request):
+    """
+    API endpoint for submitting attendance for background verification.
+    
+    Only the session is validated before answering 202 with a job id; the
+    face is verified by a worker thread and the outcome is read from
+    api_attendance_job_status.
+    """
     if request.method != 'POST':
         return JsonResponse({'success': False, 'message': 'Invalid request method'})
     
     try:
-        # Check if user is authenticated
         if not request.user.is_authenticated:
             return JsonResponse({'success': False, 'message': 'Authentication required'})
         
-        data = json.loads(request.body)
-        image_data = data.get('image')
-        latitude = data.get('latitude')
-        longitude = data.get('longitude')
-        session_id = data.get('session_id')  # Add session ID parameter
-        
-        # Debug logging
-        print(f"API Mark Attendance called with session_id: {session_id}")
+        image_bytes, data = _read_face_upload(request, allow_base64=False)
+        session_id = data.get('session_id')
         
-        if not image_data:
+        if not image_bytes:
             return JsonResponse({'success': False, 'message': 'Image data is required'})
         
-        # Check if session ID is provided
         if not session_id:
             return JsonResponse({'success': False, 'message': 'Session ID is required'})
         
-        # Get the specified session
         try:
             active_session = AttendanceSession.objects.get(id=session_id, is_active=True)
-            # Debug logging
-            print(f"Found session: ID={active_session.id}, Name={active_session.name}, Start={active_session.start_time}, End={active_session.end_time}")
-        except AttendanceSession.DoesNotExist:
-            print(f"Session not found or not active: session_id={session_id}")
+        except (AttendanceSession.DoesNotExist, ValueError):
             return JsonResponse({'success': False, 'message': 'No active attendance session found with the provided ID.'})
         
-        # Check if user has already marked attendance for this session
-        attendance_exists = AttendanceRecord.objects.filter(user=request.user, session=active_session).exists()
-        print(f"Attendance check: user={request.user.roll_number}, session_id={session_id}, exists={attendance_exists}")
-        if attendance_exists:
+        if AttendanceRecord.objects.filter(user=request.user, session=active_session).exists():
             return JsonResponse({'success': False, 'message': 'You have already marked attendance for this session.'})
         
-        # Check if user has registered their face
         if not request.user.face_encoding:
             return JsonResponse({'success': False, 'message': 'Please register your face before marking attendance.'})
         
-        # Remove data URL prefix if present
-        if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
-        
-        # Convert base64 to image
-        image = base64_to_image(image_data)
-        
-        if image is None:
-            return JsonResponse({'success': False, 'message': 'Invalid image data'})
-        
-        # Enhanced liveness detection to prevent spoofing
-        if not is_live_capture(image):
-            return JsonResponse({'success': False, 'message': 'Only live face capture is allowed. Static images, photos of screens, or blurry images are not permitted. Please use the device camera directly and ensure good lighting.'})
-        
-        # Encode face in captured image
-        unknown_encoding = encode_face(image)
-        
-        if unknown_encoding is None:
-            return JsonResponse({'success': False, 'message': 'No face detected in the image. Please try again with better lighting and positioning.'})
-        
-        # Get user's stored face encoding
-        if not request.user.face_encoding:
-            return JsonResponse({'success': False, 'message': 'No face registered for this user'})
+        # A resubmission while the first one is still pending gets the same job back
+        _fail_stale_attendance_jobs(AttendanceJob.objects.filter(user=request.user, session=active_session))
+        pending = AttendanceJob.objects.filter(
+            user=request.user, session=active_session, status__in=['queued', 'running']
+        ).first()
+        if pending:
+            return JsonResponse(_attendance_job_payload(pending), status=202)
         
-        # Convert stored encoding back to numpy array
+        job = AttendanceJob.objects.create(user=request.user, session=active_session)
         try:
-            known_encoding = np.frombuffer(base64.b64decode(request.user.face_encoding), dtype=np.float64)
-        except Exception as e:
-            return JsonResponse({'success': False, 'message': 'Error decoding stored face data. Please re-register your face.'})
-        
-        # Debug: Check shapes of encodings
-        print(f"Known encoding shape: {known_encoding.shape}")
-        print(f"Unknown encoding shape: {unknown_encoding.shape}")
-        
-        # Ensure both encodings have the same shape
-        if known_encoding.shape != unknown_encoding.shape:
-            return JsonResponse({'success': False, 'message': f'Face encoding mismatch. Stored: {known_encoding.shape}, Captured: {unknown_encoding.shape}. Please re-register your face.'})
-        
-        # Compare faces with stricter tolerance
-        match = compare_faces(known_encoding, unknown_encoding, tolerance=0.4)
-        
-        if not match:
-            # Calculate distance for debugging
-            try:
-                face_distances = face_recognition.face_distance([known_encoding], unknown_encoding)
-                distance = face_distances[0] if len(face_distances) > 0 else 1.0
-                return JsonResponse({'success': False, 'message': f'Face does not match registered face. Distance: {distance:.4f}, Threshold: 0.4. Please ensure you are the registered user.'})
-            except Exception as e:
-                return JsonResponse({'success': False, 'message': f'Error comparing faces: {str(e)}. Please try again.'})
-        
-        # Check location constraints
-        if latitude and longitude and active_session.location_constraint:
-            location = active_session.location_constraint
-            distance = calculate_distance(
-                float(latitude), float(longitude),
-                float(location.latitude), float(location.longitude)
+            # The upload buffer does not outlive the request, so hand the worker its own copy
+            attendance_queue.submit(active_session.id, job.id, bytes(image_bytes), data.get('latitude'), data.get('longitude'))
+        except QueueFull as e:
+            job.delete()
+            response = JsonResponse(
+                {'success': False, 'message': f'{e}. Please try again shortly.', 'retry_after': e.retry_after},
+                status=429 if isinstance(e, KeyLimitReached) else 503,
             )
-            
-            # Check if distance is within the allowed radius
-            if distance > float(location.radius):
-                return JsonResponse({
-                    'success': False, 
-                    'message': f'You are not within the allowed location for attendance. Distance: {distance:.2f}m, Allowed: {location.radius}m'
-                })
+            response['Retry-After'] = str(e.retry_after)
+            return response
         
-        # Create attendance record
-        attendance_record = AttendanceRecord.objects.create(
-            user=request.user,
-            session=active_session,
-            latitude=float(latitude) if latitude else None,
-            longitude=float(longitude) if longitude else None,
-            verification_method='face'
-        )
-        
-        # Send attendance confirmation email
-        from .utils import send_attendance_email
-        send_attendance_email(request.user, attendance_record)
-        
-        return JsonResponse({
-            'success': True, 
-            'message': 'Attendance marked successfully!',
-            'timestamp': attendance_record.timestamp.isoformat()
-        })
+        response = JsonResponse(_attendance_job_payload(job), status=202)
+        response['Location'] = reverse('face:api_attendance_job_status', args=[job.id])
+        return response
         
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error processing attendance: {str(e)}")
-        print(f"Traceback: {error_details}")
-        return JsonResponse({'success': False, 'message': f'Error processing attendance: {str(e)}'})
+        print(f"Error submitting attendance: {str(e)}")
+        return JsonResponse({'success': False, 'message': f'Error submitting attendance: {str(e)}'})
+
+def api_attendance_job_status(request, job_id):
+    """
+    API endpoint for polling a submitted attendance job.
+    
+    With ?wait=<seconds> the request is held until the job finishes or the
+    wait runs out. The wait holds a server worker, so it is capped at
+    FACE_JOB_MAX_WAIT, a few seconds; clients poll again after it.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'message': 'Authentication required'})
+    
+    _fail_stale_attendance_jobs(AttendanceJob.objects.filter(id=job_id, user=request.user))
+    try:
+        job = AttendanceJob.objects.get(id=job_id, user=request.user)
+    except AttendanceJob.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Job not found'}, status=404)
+    
+    try:
+        wait = max(0, min(float(request.GET.get('wait', 0)), getattr(settings, 'FACE_JOB_MAX_WAIT', 5)))
+    except ValueError:
+        wait = 0
+    
+    deadline = time.monotonic() + wait
+    while not job.is_finished and time.monotonic() < deadline:
+        remaining = deadline - time.monotonic()
+        # Jobs queued by this process signal completion; others are polled
+        if not attendance_queue.wait(job.id, remaining):
+            time.sleep(min(0.5, max(remaining, 0)))
+        job.refresh_from_db(fields=['status', 'result', 'updated_at'])
+    
+    return JsonResponse(_attendance_job_payload(job))
 
 @csrf_exempt
 def api_faculty_mark_attendance(request):
@@ -1136,27 +1170,23 @@ def api_faculty_mark_attendance(request):
         print(f"Traceback: {error_details}")
         return JsonResponse({'success': False, 'message': f'Error processing attendance: {str(e)}'})
 
-@csrf_exempt
-def api_user_info(request):
-    """API endpoint for user information"""
-    # Check if user is authenticated
-    if not request.user.is_authenticated:
-        return JsonResponse({'success': False, 'message': 'Authentication required'})
-    
-    try:
-        return JsonResponse({
-            'success': True,
-            'user': {
-                'roll_number': request.user.roll_number,
-                'email': request.user.email,
-                'first_name': request.user.first_name,
-                'last_name': request.user.last_name,
-                'role': request.user.role.name if request.user.role else None,
-                'face_registered': bool(request.user.face_encoding)
-            }
-        })
-    except Exception as e:
-        return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
+def api_metrics(request):
+    """Face pipeline stage timing histograms in Prometheus text format, for local scrapers only"""
+    allowed_ips = getattr(settings, 'FACE_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.registry.render_prometheus(), content_type='text/plain; version=0.0.4')
+
+def healthz_ready(request):
+    """
+    Readiness probe for the load balancer: 503 until this worker has warmed
+    up its face models, including while a failed warm-up is being retried
+    (with its error). The first probe starts the warm-up if no server hook did.
+    """
+    if not cv.is_ready():
+        cv.start_warm_up()
+        return JsonResponse({'ready': False, 'error': cv.warm_up_error()}, status=503)
+    return JsonResponse({'ready': True})
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """
@@ -1469,6 +1499,139 @@ def api_mark_attendance_without_face_recognition(request):
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
 
+def _read_group_photos(request):
+    """
+    Read the classroom photos of a group attendance request: any number of
+    multipart file parts (named 'images' or 'image'), or one raw image/jpeg
+    or image/png body with the other fields in the query string.
+    Returns (list of image bytes, fields).
+    """
+    max_bytes = getattr(settings, 'FACE_MAX_IMAGE_BYTES', 8 * 1024 * 1024)
+    
+    if request.content_type == 'multipart/form-data':
+        uploads = request.FILES.getlist('images') + request.FILES.getlist('image')
+        for upload in uploads:
+            if upload.size > max_bytes:
+                raise ValueError(f'Photo {upload.name} exceeds the {max_bytes} byte limit')
+        return [upload.read() for upload in uploads], request.POST
+    
+    if request.content_type in IMAGE_CONTENT_TYPES:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if length > max_bytes:
+            raise ValueError(f'Image exceeds the {max_bytes} byte limit')
+        return ([request.read(length)] if length else []), request.GET
+    
+    raise ValueError('Send the photos as multipart/form-data image parts or as an image/jpeg request body')
+
+@csrf_exempt
+def api_mark_group_attendance(request):
+    """API endpoint for faculty to mark attendance for a whole class from classroom photos"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    try:
+        # Check if user is authenticated
+        if not request.user.is_authenticated:
+            return JsonResponse({'success': False, 'message': 'Authentication required'})
+        
+        # Check if user has faculty or admin role
+        user_role = request.user.role.name.lower() if request.user.role else ''
+        if user_role not in ['faculty', 'admin']:
+            return JsonResponse({'success': False, 'message': 'Faculty or Administrator privileges required'})
+        
+        photos, fields = _read_group_photos(request)
+        session_id = fields.get('session_id')
+        
+        if not photos:
+            return JsonResponse({'success': False, 'message': 'At least one photo is required'})
+        max_photos = getattr(settings, 'FACE_GROUP_MAX_PHOTOS', 5)
+        if len(photos) > max_photos:
+            return JsonResponse({'success': False, 'message': f'At most {max_photos} photos can be sent at once'})
+        if not session_id:
+            return JsonResponse({'success': False, 'message': 'Session ID is required'})
+        
+        try:
+            session = AttendanceSession.objects.get(id=session_id, is_active=True)
+        except (AttendanceSession.DoesNotExist, ValueError):
+            return JsonResponse({'success': False, 'message': 'No active attendance session found with the provided ID.'})
+        
+        # Check if faculty is authorized to mark attendance for this session
+        if user_role == 'faculty' and session.faculty_id != request.user.id:
+            return JsonResponse({'success': False, 'message': 'You are not authorized to mark attendance for this session'})
+        
+        # Template matrix of every student the session is for
+        roster = Roster.for_session(session)
+        if not len(roster):
+            return JsonResponse({'success': False, 'message': 'No students with a registered face are enrolled for this session'})
+        
+        # Classroom photos keep more resolution than selfies so distant faces stay detectable
+        max_dimension = getattr(settings, 'FACE_GROUP_MAX_IMAGE_DIMENSION', 2560)
+        max_faces = getattr(settings, 'FACE_GROUP_MAX_FACES', 100)
+        matched = {}
+        unmatched = []
+        faces_detected = 0
+        for photo_index, photo in enumerate(photos):
+            image, _ = decode_image_bytes(photo, max_dimension=max_dimension)
+            if image is None:
+                return JsonResponse({'success': False, 'message': f'Photo {photo_index + 1} is not a valid image'})
+            
+            faces = analyze_faces(image, max_faces=max_faces)
+            faces_detected += len(faces)
+            encoded = [face for face in faces if face.encoding is not None]
+            
+            # One-to-one within a photo: each face matches at most one student and vice versa
+            pairs = assign(roster.distances([face.encoding for face in encoded]), match_tolerance('identify', roster.encoder)) if encoded else []
+            assigned_faces = set()
+            for row, column, distance in pairs:
+                assigned_faces.add(id(encoded[row]))
+                user_id = int(roster.user_ids[column])
+                if user_id not in matched or distance < matched[user_id]['distance']:
+                    matched[user_id] = {'photo': photo_index, 'distance': round(distance, 4)}
+            
+            for face in faces:
+                if id(face) in assigned_faces:
+                    continue
+                unmatched.append({
+                    'photo': photo_index,
+                    'box': list(face.face_box),
+                    'reason': 'no_match' if face.encoding is not None else 'no_landmarks',
+                    'crop': image_to_base64(face.face_crop, max_dimension=160),
+                })
+        
+        # Students seen in the photos; those already marked are skipped
+        records = mark_present(session, matched, 'group_photo')
+        inserted = {record.user_id for record in records}
+        new_user_ids = [user_id for user_id in matched if user_id in inserted]
+        
+        # Queue confirmation emails for the records written here only
+        if records:
+            send_attendance_emails(records)
+        
+        students = {student['id']: student for student in User.objects.filter(id__in=matched).values('id', 'roll_number', 'first_name', 'last_name')}
+        def describe(user_id):
+            student = students[user_id]
+            return {
+                'roll_number': student['roll_number'],
+                'name': f"{student['first_name']} {student['last_name']}".strip(),
+                **matched[user_id],
+            }
+        
+        return JsonResponse({
+            'success': True,
+            'message': f'Marked {len(new_user_ids)} students present from {faces_detected} detected faces',
+            'roster_size': len(roster),
+            'faces_detected': faces_detected,
+            'marked': [describe(user_id) for user_id in new_user_ids],
+            'already_marked': [describe(user_id) for user_id in matched if user_id not in inserted],
+            'unmatched': unmatched,
+        })
+    
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    except Exception as e:
+        print(f"Error processing group attendance: {str(e)}")
+        return JsonResponse({'success': False, 'message': f'Error processing group attendance: {str(e)}'})
+
 @csrf_exempt
 def api_stop_session(request):
     """API endpoint for faculty/admin to stop an attendance session"""
@@ -1733,9 +1896,72 @@ def api_stop_session(request):
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error stopping session: {str(e)}'})
 
+def _run_report_job(job_id):
+    """Worker side of api_send_hod_attendance_report: queue the department's report emails"""
+    job = ReportJob.objects.get(id=job_id)
+    ReportJob.objects.filter(id=job_id).update(status='running', updated_at=timezone.now())
+    try:
+        queued, skipped, failed = send_department_report(job)
+        result = {
+            'success': True,
+            'message': f'Attendance reports sent successfully. {queued + skipped} emails sent, {failed} failed.',
+            'emails_sent': queued + skipped,
+            'emails_failed': failed,
+            'total_users': queued + skipped + failed
+        }
+    except Exception as e:
+        print(f"Error processing report job {job_id}: {str(e)}")
+        result = {'success': False, 'message': f'Error: {str(e)}'}
+    ReportJob.objects.filter(id=job_id).update(
+        status='succeeded' if result.get('success') else 'failed',
+        result=result,
+        updated_at=timezone.now(),
+    )
+
+report_queue = JobQueue(
+    'report_job',
+    _run_report_job,
+    maxsize=getattr(settings, 'REPORT_JOB_QUEUE_SIZE', 20),
+    workers=getattr(settings, 'REPORT_JOB_WORKERS', 1),
+)
+
+def _report_job_payload(job):
+    payload = {
+        'success': True,
+        'job_id': str(job.id),
+        'status': job.status,
+        'total_users': job.total_users,
+        'processed_users': job.processed_users,
+        # Delivery of the queued emails by the outbox worker
+        'delivery': {
+            status: count for status, count in
+            job.emails.values_list('status').annotate(count=Count('id')).order_by()
+        },
+    }
+    if job.is_finished:
+        payload['result'] = job.result
+    return payload
+
+def api_report_job_status(request, job_id):
+    """API endpoint for polling the progress of an HOD attendance report"""
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'message': 'Authentication required'})
+    
+    try:
+        job = ReportJob.objects.get(id=job_id, requested_by=request.user)
+    except ReportJob.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Job not found'}, status=404)
+    
+    return JsonResponse(_report_job_payload(job))
+
 @csrf_exempt
 def api_send_hod_attendance_report(request):
-    """API endpoint for HOD to send attendance report emails for a specific date"""
+    """
+    API endpoint for HOD to send attendance report emails for a specific date.
+    
+    Answers 202 with a job id; the emails are built and queued by a worker
+    thread and progress is read from api_report_job_status.
+    """
     if request.method != 'POST':
         return JsonResponse({'success': False, 'message': 'Invalid request method'})
     
@@ -1765,13 +1991,7 @@ def api_send_hod_attendance_report(request):
         if not hod_department:
             return JsonResponse({'success': False, 'message': 'HOD department not found'})
         
-        # Get all users in the HOD's department
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        department_users = User.objects.filter(department=hod_department, is_active=True)
-        
         # Get all sessions that started on the selected date
-        from .models import AttendanceSession, AttendanceRecord
         sessions = AttendanceSession.objects.filter(
             start_time__date=selected_datetime.date(),
             department=hod_department
@@ -1780,59 +2000,31 @@ def api_send_hod_attendance_report(request):
         if not sessions.exists():
             return JsonResponse({'success': False, 'message': 'No sessions found for the selected date'})
         
-        # Send attendance report emails to all users in the department
-        from .utils import send_attendance_report_email
-        success_count = 0
-        error_count = 0
-        total_users = department_users.count()
+        # A repeated request while the first one is still pending gets the same job back,
+        # unless that job has stopped making progress (e.g. its worker was restarted)
+        pending = ReportJob.objects.filter(
+            department=hod_department, report_date=selected_datetime.date(), status__in=['queued', 'running'],
+            updated_at__gte=timezone.now() - timedelta(minutes=10)
+        ).first()
+        if pending:
+            return JsonResponse(_report_job_payload(pending), status=202)
         
-        # Process each user once and collect all their session data
-        for user in department_users:
-            try:
-                # Prepare attendance data for this user
-                # Group sessions by name and keep only the latest one to avoid duplicates
-                session_groups = {}
-                for session in sessions:
-                    session_name = session.name
-                    # If this is the first session with this name, or if this session is newer
-                    if session_name not in session_groups or session.start_time > session_groups[session_name].start_time:
-                        session_groups[session_name] = session
-                
-                # Prepare consolidated attendance data with deduplicated sessions
-                user_attendance_data = []
-                for session_name, session in session_groups.items():
-                    # Check if user has attendance record for this session
-                    attendance_record = AttendanceRecord.objects.filter(
-                        user=user,
-                        session=session
-                    ).first()
-                    
-                    user_attendance_data.append({
-                        'session_name': session.name,
-                        'session_time': session.start_time.strftime("%Y-%m-%d %H:%M"),
-                        'attended': attendance_record is not None,
-                        # Convert timestamp to local timezone (Asia/Kolkata)
-                        'timestamp': attendance_record.timestamp.astimezone(pytz.timezone('Asia/Kolkata')).strftime("%Y-%m-%d %H:%M:%S") if attendance_record else None
-                    })
-                
-                # Send ONE email per user with all their session information
-                email_sent = send_attendance_report_email(user, selected_datetime.date(), user_attendance_data)
-                if email_sent:
-                    success_count += 1
-                else:
-                    error_count += 1
-                    
-            except Exception as e:
-                print(f"Error sending email to user {user.email}: {e}")
-                error_count += 1
+        # Build and queue the emails in the background; the HOD UI polls api_report_job_status
+        job = ReportJob.objects.create(requested_by=request.user, department=hod_department, report_date=selected_datetime.date())
+        try:
+            report_queue.submit(hod_department, job.id)
+        except QueueFull as e:
+            job.delete()
+            response = JsonResponse(
+                {'success': False, 'message': f'{e}. Please try again shortly.', 'retry_after': e.retry_after},
+                status=503,
+            )
+            response['Retry-After'] = str(e.retry_after)
+            return response
         
-        return JsonResponse({
-            'success': True,
-            'message': f'Attendance reports sent successfully. {success_count} emails sent, {error_count} failed.',
-            'emails_sent': success_count,
-            'emails_failed': error_count,
-            'total_users': total_users
-        })
+        response = JsonResponse(_report_job_payload(job), status=202)
+        response['Location'] = reverse('face:api_report_job_status', args=[job.id])
+        return response
         
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
@@ -2085,7 +2277,7 @@ def api_get_user_profile(request):
             'last_name': request.user.last_name,
             'role': request.user.role.name if request.user.role else None,
             'face_registered': bool(request.user.face_encoding),
-            'face_image': request.user.face_image,  # Include face image data
+            'face_image': request.user.face_image.to_base64() if request.user.face_image_id else None,  # Include face image data
             'is_active': request.user.is_active,
             'date_joined': request.user.date_joined.isoformat(),
             'year': request.user.year,  # Add year
@@ -2403,6 +2595,7 @@ def api_start_session(request):
                     level=original_session.level,  # Copy level from original session
                     department=original_session.department  # Copy department from original session
                 )
+                materialize_roster(new_session)
                 
                 return JsonResponse({
                     'success': True, 
@@ -2764,23 +2957,25 @@ def api_get_faculty_sessions_with_attendance(request):
             # For UG faculty, restrict students to their assigned department
             students = students.filter(department=request.user.department, level='UG')
         
+        # Students the requester may see; rosters already fix each session's year
+        visible_students = students
+        
         # Get year filter from query parameters
         target_year_filter = request.GET.get('target_year')
         print(f"Target year filter: {target_year_filter}")
+        year_student_ids = None
         if target_year_filter:
-            students = students.filter(year=target_year_filter)
-            print(f"Students after year filter: {students.count()}")
-        else:
-            print(f"No year filter applied, total students: {students.count()}")
-        
-        # If no year filter is applied, we still want to show all students but organized by year
-        # So we don't need to do anything special here - the grouping logic will handle it
+            # Sessions for every year only list the students of the selected one
+            year_student_ids = set(students.filter(year=target_year_filter).values_list('id', flat=True))
+            print(f"Students after year filter: {len(year_student_ids)}")
         
         # Organize data by year and level
         organized_data = {}
         
-        # Process sessions and organize by year/level
-        for session in sessions:
+        # Process sessions and organize by year/level, loading every session's roster and attendance at once
+        for report in load_session_attendance(sessions, visible=visible_students):
+            session = report.session
+            
             # Create key based on level and target year
             key = f"{session.level}_{session.target_year}" if session.level and session.target_year else "other"
             
@@ -2793,31 +2988,13 @@ def api_get_faculty_sessions_with_attendance(request):
                     'sessions': []
                 }
             
-            # Get attendance records for this session
-            attendance_records = AttendanceRecord.objects.filter(session=session)
-            
-            # Create a set of student IDs who attended this session
-            attended_student_ids = set(record.user.id for record in attendance_records)
-            
-            # Build attendance status for each student (only for students in this session's department and level)
-            student_attendance = []
-            # When no year filter is applied, we still want to filter students by the session's year
-            # When a year filter is applied, we've already filtered the students queryset
+            # Build attendance status for each of the session's students; a year filter selects the sessions of that year
+            student_attendance = report.student_attendance()
             if target_year_filter:
-                # Students are already filtered by year, so we just need to filter by session's level and department
-                session_students = students.filter(level=session.level, department=session.department)
-            else:
-                # No year filter, so we need to filter by session's year, level, and department
-                session_students = students.filter(year=session.target_year, level=session.level, department=session.department)
-            
-            for student in session_students:
-                is_present = student.id in attended_student_ids
-                student_attendance.append({
-                    'student_id': student.id,
-                    'student_roll_number': student.roll_number,
-                    'student_name': f"{student.first_name} {student.last_name}".strip(),
-                    'is_present': is_present
-                })
+                if session.target_year and session.target_year != target_year_filter:
+                    student_attendance = []
+                elif not session.target_year:
+                    student_attendance = [entry for entry in student_attendance if entry['student_id'] in year_student_ids]
             
             organized_data[key]['sessions'].append({
                 'id': session.id,
@@ -2956,6 +3133,7 @@ def api_faculty_start_session(request, session_id):
             level=original_session.level,  # Copy level from original session
             department=original_session.department  # Copy department from original session
         )
+        materialize_roster(new_session)
         
         # Debug logging
         print(f"Faculty API - Created new session: ID={new_session.id}, Name={new_session.name}, Start={new_session.start_time}, End={new_session.end_time}, Target Year={new_session.target_year}, Level={new_session.level}, Department={new_session.department}")
@@ -3232,45 +3410,16 @@ def api_get_faculty_session_attendance(request, session_id):
             if user_role == 'faculty' and session.faculty != request.user:
                 return JsonResponse({'success': False, 'message': 'You are not authorized to access this session'})
             
-            # Get students based on session's level, department, and target year
-            students = User.objects.filter(role__name='student')
-            
-            # Apply filters based on session attributes
-            if session.level:
-                students = students.filter(level=session.level)
-            if session.department:
-                students = students.filter(department=session.department)
-            if session.target_year:
-                students = students.filter(year=session.target_year)
-            
-            # Get attendance records for this session
-            attendance_records = AttendanceRecord.objects.filter(
-                session=session
-            ).select_related('user')
-            
-            # Create a set of student IDs who attended
-            attended_student_ids = set(record.user.id for record in attendance_records)
-            
-            # Build attendance data for filtered students
-            attendance_data = []
-            for student in students:
-                # Check if this student attended the session
-                is_present = student.id in attended_student_ids
-                
-                attendance_data.append({
-                    'student_id': student.id,
-                    'student_roll_number': student.roll_number,
-                    'student_name': f"{student.first_name} {student.last_name}".strip(),
-                    'is_present': is_present,
-                    'timestamp': next((record.timestamp.isoformat() for record in attendance_records if record.user.id == student.id), None)
-                })
+            # Get the session's roster and attendance
+            report = load_session_attendance([session])[0]
+            attendance_data = report.student_attendance()
             
             return JsonResponse({
                 'success': True,
                 'attendance_data': attendance_data,
                 'session_name': session.name,
-                'total_students': students.count(),
-                'attended_students': len(attended_student_ids)
+                'total_students': len(attendance_data),
+                'attended_students': len(report.attended)
             })
             
         except AttendanceSession.DoesNotExist:
@@ -3595,37 +3744,10 @@ def api_get_hod_filtered_sessions(request):
 
         sessions_data = []
 
-        for session in sessions:
-            # Get attendance records for this session
-            attendance_records = AttendanceRecord.objects.filter(session=session)
-            
-            # Create a set of student IDs who attended this session
-            attended_student_ids = set(record.user.id for record in attendance_records)
-            
-            # Get students based on session's level, department, and target year
-            students = User.objects.filter(role__name='student')
-            
-            # Apply filters based on session attributes
-            if session.level:
-                students = students.filter(level=session.level)
-            if session.department:
-                students = students.filter(department=session.department)
-            if session.target_year:
-                students = students.filter(year=session.target_year)
-            
-            # Build attendance data for filtered students
-            student_attendance = []
-            for student in students:
-                # Check if this student attended the session
-                is_present = student.id in attended_student_ids
-                
-                student_attendance.append({
-                    'student_id': student.id,
-                    'student_roll_number': student.roll_number,
-                    'student_name': f"{student.first_name} {student.last_name}".strip(),
-                    'is_present': is_present,
-                    'timestamp': next((record.timestamp.isoformat() for record in attendance_records if record.user.id == student.id), None)
-                })
+        # Load every session's roster and attendance at once
+        for report in load_session_attendance(sessions.select_related('location_constraint')):
+            session = report.session
+            student_attendance = report.student_attendance()
             
             sessions_data.append({
                 'id': session.id,
@@ -3645,7 +3767,7 @@ def api_get_hod_filtered_sessions(request):
                 'level': session.level,
                 'department': session.department,
                 'student_attendance': student_attendance,
-                'total_students': students.count(),
+                'total_students': len(student_attendance),
                 'attended_students': len([s for s in student_attendance if s['is_present']])
             })
         
@@ -3802,25 +3924,10 @@ def api_get_faculty_daily_attendance(request):
         # Prepare data structure
         sessions_data = []
         
-        # Build sessions with attendance data
-        for session in sessions:
-            # Get attendance records for this session
-            attendance_records = AttendanceRecord.objects.filter(session=session)
-            
-            # Create a set of student IDs who attended this session
-            attended_student_ids = set(record.user.id for record in attendance_records)
-            
-            # Build attendance status for each student
-            student_attendance = []
-            for student in students:
-                is_present = student.id in attended_student_ids
-                student_attendance.append({
-                    'student_id': student.id,
-                    'student_roll_number': student.roll_number,
-                    'student_name': f"{student.first_name} {student.last_name}".strip(),
-                    'is_present': is_present,
-                    'timestamp': next((record.timestamp.isoformat() for record in attendance_records if record.user.id == student.id), None)
-                })
+        # Build sessions with attendance data, loading every session's attendance at once
+        for report in load_session_attendance(sessions, students=students):
+            session = report.session
+            student_attendance = report.student_attendance()
             
             sessions_data.append({
                 'id': session.id,
@@ -3829,15 +3936,15 @@ def api_get_faculty_daily_attendance(request):
                 'end_time': session.end_time.isoformat() if session.end_time else None,
                 'is_active': session.is_active,
                 'student_attendance': student_attendance,
-                'total_students': students.count(),
-                'attended_students': len(attended_student_ids)
+                'total_students': len(student_attendance),
+                'attended_students': len(report.attended)
             })
         
         return JsonResponse({
             'success': True,
             'date': target_date.isoformat(),
             'sessions': sessions_data,
-            'total_sessions': sessions.count()
+            'total_sessions': len(sessions_data)
         })
             
     except Exception as e:
@@ -3916,11 +4023,9 @@ def api_get_filtered_faculty_daily_attendance(request):
             if hasattr(request.user, 'department') and request.user.department:
                 students = students.filter(department=request.user.department)
             
-            # Apply filters based on level and year
+            # Apply filters based on level
             if level:
                 students = students.filter(level=level)
-            if year:
-                students = students.filter(year=year)
         elif user_role == 'faculty' and request.user.level == 'UG' and request.user.department:
             # For UG faculty, restrict to their assigned department when viewing UG level
             if level == 'UG':
@@ -3928,59 +4033,30 @@ def api_get_filtered_faculty_daily_attendance(request):
                 # Apply this restriction regardless of other filters
                 print(f"UG faculty {request.user.roll_number} viewing UG level, restricting to department: {request.user.department}")
                 students = students.filter(department=request.user.department, level='UG')
-                # Apply year filter if provided
-                if year:
-                    students = students.filter(year=year)
             elif level == 'PG':
                 # UG faculty viewing PG level - they can select any PG department
                 if department_provided and department:
                     students = students.filter(department=department, level='PG')
                 else:
                     students = students.filter(level='PG')
-                # Apply year filter if provided
-                if year:
-                    students = students.filter(year=year)
             else:
                 # No level selected - default to faculty's assigned department and UG level
                 students = students.filter(department=request.user.department, level='UG')
-                # Apply year filter if provided
-                if year:
-                    students = students.filter(year=year)
         else:
             # For PG faculty or when no specific restrictions apply, use the provided filters
             if level:
                 students = students.filter(level=level)
             if department_provided and department:
                 students = students.filter(department=department)
-            if year:
-                students = students.filter(year=year)
         
         # Prepare data structure
         sessions_data = []
         
-        # Build sessions with attendance data
-        for session in sessions:
-            # Get attendance records for this session
-            attendance_records = AttendanceRecord.objects.filter(session=session)
-            
-            # Create a set of student IDs who attended this session
-            attended_student_ids = set(record.user.id for record in attendance_records)
-            
-            # Build attendance status for each student
-            # Only include students who belong to this session's department and level
-            student_attendance = []
-            for student in students:
-                # For UG faculty viewing UG level, we've already filtered students to their department
-                # For all cases, ensure students match the session's level and department
-                if student.level == session.level and student.department == session.department:
-                    is_present = student.id in attended_student_ids
-                    student_attendance.append({
-                        'student_id': student.id,
-                        'student_roll_number': student.roll_number,
-                        'student_name': f"{student.first_name} {student.last_name}".strip(),
-                        'is_present': is_present,
-                        'timestamp': next((record.timestamp.isoformat() for record in attendance_records if record.user.id == student.id), None)
-                    })
+        # Build sessions with attendance data, loading every session's roster and attendance at once.
+        # Each lists the students it expects that the requester may see; the year filter applies to sessions
+        for report in load_session_attendance(sessions, visible=students):
+            session = report.session
+            student_attendance = report.student_attendance()
             
             sessions_data.append({
                 'id': session.id,
@@ -4274,7 +4350,9 @@ def api_delete_user(request, user_id):
                 return JsonResponse({'success': False, 'message': 'Cannot delete your own admin account'})
             
             roll_number = user.roll_number
+            user_pk = user.id
             user.delete()
+            face_index.remove(user_pk)
             
             return JsonResponse({
                 'success': True, 
@@ -4351,14 +4429,21 @@ def api_get_registered_faces(request):
             return JsonResponse({'success': False, 'message': 'Administrator or HOD privileges required'})
         
         # Get all users with registered faces
-        users_with_faces = User.objects.exclude(face_encoding__isnull=True).exclude(face_encoding='')
+        users_with_faces = User.objects.exclude(face_encoding__isnull=True)
         
         # For HOD users, filter by their department
         if user_role == 'hod' and hasattr(request.user, 'department'):
             users_with_faces = users_with_faces.filter(department=request.user.department)
         
+        # Face images live in their own table; clients fetch them one at a time from
+        # api_get_face_image, and only ?include_images=1 embeds them here in one query
+        include_images = request.GET.get('include_images') == '1'
+        users_with_faces = list(users_with_faces)
+        images = FaceImage.objects.in_bulk([user.face_image_id for user in users_with_faces if user.face_image_id]) if include_images else {}
+        
         faces_data = []
         for user in users_with_faces:
+            face_image = images.get(user.face_image_id)
             faces_data.append({
                 'user_id': user.id,
                 'roll_number': user.roll_number,
@@ -4366,7 +4451,7 @@ def api_get_registered_faces(request):
                 'last_name': user.last_name,
                 'email': user.email,
                 'date_registered': user.date_joined.isoformat(),
-                'face_image': user.face_image,  # Include face image data
+                'face_image': face_image.to_base64() if face_image else None,  # Include face image data
                 'department': user.department,  # Include department information
                 'level': user.level,  # Include level information
                 'year': user.year,  # Include year information
@@ -4380,6 +4465,35 @@ def api_get_registered_faces(request):
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
 
+@csrf_exempt
+def api_get_face_image(request, user_id):
+    """API endpoint to fetch a single user's stored face image as raw bytes"""
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    try:
+        # Check if user is authenticated
+        if not request.user.is_authenticated:
+            return JsonResponse({'success': False, 'message': 'Authentication required'})
+        
+        # Users may fetch their own image; admin and HOD may fetch anyone's
+        user_role = request.user.role.name.lower() if request.user.role else ''
+        if user_role not in ['admin', 'hod'] and request.user.id != user_id:
+            return JsonResponse({'success': False, 'message': 'Administrator or HOD privileges required'})
+        
+        face_image_id = User.objects.filter(id=user_id).values_list('face_image_id', flat=True).first()
+        if not face_image_id:
+            return JsonResponse({'success': False, 'message': 'No face image registered for this user'})
+        
+        face_image = FaceImage.objects.get(sha256=face_image_id)
+        response = HttpResponse(bytes(face_image.data), content_type=face_image.content_type)
+        response['ETag'] = f'"{face_image.sha256}"'
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
+            
+    except Exception as e:
+        return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
+
 @csrf_exempt
 def api_get_hod_filtered_registered_faces(request):
     """API endpoint for HOD to get registered faces with filtering by level and year"""
@@ -4402,7 +4516,7 @@ def api_get_hod_filtered_registered_faces(request):
         department = request.GET.get('department')
         
         # Get users with registered faces
-        users_with_faces = User.objects.exclude(face_encoding__isnull=True).exclude(face_encoding='')
+        users_with_faces = User.objects.exclude(face_encoding__isnull=True)
         
         # Get all users (for counting unregistered users)
         all_users = User.objects.all()
@@ -4428,8 +4542,15 @@ def api_get_hod_filtered_registered_faces(request):
         total_count = all_users.count()
         unregistered_count = total_count - registered_count
         
+        # Face images live in their own table; clients fetch them one at a time from
+        # api_get_face_image, and only ?include_images=1 embeds them here in one query
+        include_images = request.GET.get('include_images') == '1'
+        users_with_faces = list(users_with_faces)
+        images = FaceImage.objects.in_bulk([user.face_image_id for user in users_with_faces if user.face_image_id]) if include_images else {}
+        
         faces_data = []
         for user in users_with_faces:
+            face_image = images.get(user.face_image_id)
             faces_data.append({
                 'user_id': user.id,
                 'roll_number': user.roll_number,
@@ -4437,7 +4558,7 @@ def api_get_hod_filtered_registered_faces(request):
                 'last_name': user.last_name,
                 'email': user.email,
                 'date_registered': user.date_joined.isoformat(),
-                'face_image': user.face_image,
+                'face_image': face_image.to_base64() if face_image else None,
                 'department': user.department,
                 'level': user.level,
                 'year': user.year,
@@ -4502,71 +4623,6 @@ def api_get_all_sessions(request):
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
 
-@csrf_exempt
-def api_get_active_sessions(request):
-    """API endpoint to get active sessions only"""
-    if request.method != 'GET':
-        return JsonResponse({'success': False, 'message': 'Invalid request method'})
-    
-    try:
-        # Check if user is authenticated
-        if not request.user.is_authenticated:
-            return JsonResponse({'success': False, 'message': 'Authentication required'})
-        
-        # Get only active sessions ordered by start time
-        sessions = AttendanceSession.objects.filter(is_active=True).order_by('-start_time')
-        
-        # Filter sessions based on user's role, level, year, and department
-        user_role = request.user.role.name.lower() if request.user.role else ''
-        
-        # For students, only show sessions targeted to their level, year, and department
-        if user_role == 'student':
-            # Filter by level if available
-            if request.user.level:
-                sessions = sessions.filter(level=request.user.level)
-            
-            # Filter by year if available
-            if request.user.year:
-                sessions = sessions.filter(target_year=request.user.year)
-            
-            # Filter by department if available
-            if request.user.department:
-                sessions = sessions.filter(department=request.user.department)
-        
-        sessions_data = []
-        for session in sessions:
-            sessions_data.append({
-                'id': session.id,
-                'name': session.name,
-                'start_time': session.start_time.isoformat() if session.start_time else None,
-                'end_time': session.end_time.isoformat() if session.end_time else None,
-                'is_active': session.is_active,
-                'faculty': {
-                    'id': session.faculty.id,
-                    'name': f"{session.faculty.first_name} {session.faculty.last_name}".strip() if session.faculty else "Unknown"
-                } if session.faculty else None,
-                'location_constraint': {
-                    'id': session.location_constraint.id,
-                    'name': session.location_constraint.name,
-                    'latitude': str(session.location_constraint.latitude),
-                    'longitude': str(session.location_constraint.longitude),
-                    'radius': str(session.location_constraint.radius)
-                },
-
-                
-                'target_year': session.target_year,  # Include target year
-                'level': session.level,  # Include level
-                'department': session.department  # Include department
-            })
-        
-        return JsonResponse({
-            'success': True,
-            'sessions': sessions_data
-        })
-            
-    except Exception as e:
-        return JsonResponse({'success': False, 'message': f'Error: {str(e)}'})
-
 @csrf_exempt
 def api_get_all_roles(request):
     """API endpoint to get all roles"""
@@ -4623,9 +4679,16 @@ def api_delete_user_face(request, user_id):
             return JsonResponse({'success': False, 'message': 'User not found'})
         
         # Delete the face encoding and face image
+        face_image_id = user.face_image_id
         user.face_encoding = None
         user.face_image = None
         user.save()
+        clear_templates(user)
+        face_index.remove(user.id)
+        
+        # Drop the stored image unless another user shares the same photo
+        if face_image_id:
+            FaceImage.objects.filter(sha256=face_image_id, users__isnull=True).delete()
         
         return JsonResponse({
             'success': True, 
@@ -4637,7 +4700,7 @@ def api_delete_user_face(request, user_id):
 
 @csrf_exempt
 def api_calculate_monthly_attendance(request):
-    """API endpoint to calculate monthly attendance for a user"""
+    """API endpoint to get the monthly attendance report of a user"""
     if request.method != 'POST':
         return JsonResponse({'success': False, 'message': 'Invalid request method'})
     
@@ -4650,51 +4713,9 @@ def api_calculate_monthly_attendance(request):
         year = int(data.get('year'))
         month = int(data.get('month'))
         
-        # Get the first and last day of the month
-        from datetime import datetime, timedelta
-        import calendar
-        
-        start_date = datetime(year, month, 1)
-        last_day = calendar.monthrange(year, month)[1]
-        end_date = datetime(year, month, last_day, 23, 59, 59)
-        
-        # Get all sessions in this month
-        monthly_sessions = AttendanceSession.objects.filter(
-            start_time__gte=start_date,
-            start_time__lte=end_date
-        )
-        
-        # Get user's attendance records for these sessions
-        user_attendance = AttendanceRecord.objects.filter(
-            user=request.user,
-            session__in=monthly_sessions
-        )
-        
-        # Calculate attendance percentage
-        total_sessions = monthly_sessions.count()
-        attended_sessions = user_attendance.count()
-        
-        attendance_percentage = 0
-        if total_sessions > 0:
-            attendance_percentage = (attended_sessions / total_sessions) * 100
-        
-        # Create or update monthly report
-        from .models import MonthlyReport
-        report, created = MonthlyReport.objects.get_or_create(
-            user=request.user,
-            month=start_date.date().replace(day=1),
-            defaults={
-                'total_sessions': total_sessions,
-                'attended_sessions': attended_sessions,
-                'attendance_percentage': attendance_percentage
-            }
-        )
-        
-        if not created:
-            report.total_sessions = total_sessions
-            report.attended_sessions = attended_sessions
-            report.attendance_percentage = attendance_percentage
-            report.save()
+        # Reports are kept current as sessions and attendance change, see monthly.py
+        from datetime import date
+        report = monthly_report(request.user, date(year, month, 1))
         
         return JsonResponse({
             'success': True,
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings, picked up automatically when gunicorn is started from the
+project directory:
+
+    gunicorn Frs.wsgi
+"""
+import os
+
+
+def post_fork(server, worker):
+    """
+    Start warming up the face models as soon as a worker is forked, so they
+    are loaded before its first face request. Models are built per thread, so
+    this covers every thread that runs face analysis: the async views'
+    inference pool and the attendance job workers. /healthz/ready answers
+    503 until the warm-up has succeeded; a failed one is retried.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Frs.settings")
+
+    import django
+
+    django.setup()
+
+    from face import cv
+    from face.async_views import inference_executor, inference_workers
+    from face.views import attendance_queue
+
+    cv.start_warm_up(inference_executor, inference_workers, job_queues=[attendance_queue])